@@ -1,13 +1,32 @@
-from flask import Flask, request, redirect, url_for, render_template, after_this_request, flash, send_file
+from flask import Flask, request, redirect, url_for, render_template, flash, send_file, jsonify, Response
 from flask_login import LoginManager, login_required, current_user, UserMixin, login_user
 from app.forms import PeriodForm
-import requests
-from app.report_generator import ReportGenerator
+from app.report_generator import ReportGenerator, MS_API_URL, REPORT_SOURCE, MAP_PROJECT_AGENT
+from app.batch import build_batch_file
+from app.precompute import PrecomputedReports, ReportScheduler, PRECOMPUTE_ENABLED
+from app.webhooks import WebhookProcessor, WEBHOOK_TOKEN
+from app.profiling import profile_report, PROFILE_TOKEN, PROFILE_KIND
+from app.assortment_cache import get_assortment_cache
+from app.commission_index import get_commission_index
+from app.report_cache import get_report_cache
+from app.report_store import get_report_store, SharedReportStore, REPORT_GC_INTERVAL
+from app.flat_writer import REPORT_FORMATS
+from app.replica import ReplicaSync, get_replica, REPLICA_SYNC_INTERVAL
+from app.project_cache import ProjectCache
+from app.cache_generation import get_cache_generation
+from app.summary_cache import SummaryCache
+from app.jobs import JobQueue, Job, QueueFullError
+from app.excel_writer import get_template_layout, TEMPLATE_PATH
+from app.metrics import REGISTRY
+from app.ms_client import get_ms_client, response_json
 from datetime import datetime, time
 from app.logger import setup_logger
 from dotenv import load_dotenv
 import os
 import sys
+import tempfile
+import hmac
+import threading
 
 logger = setup_logger(__name__)
 
@@ -30,35 +49,177 @@ app.secret_key = os.environ.get("SECRET_FOR_FORM")
 
 token_ms = os.environ.get("TOKEN_MS")
 
+# Разбираем шаблон отчёта один раз при старте, дальше он перечитывается только при изменении файла
+get_template_layout(TEMPLATE_PATH)
+
+# Отчёты из локальной реплики: реплика догружается в фоне, отчёт в МС не ходит
+if REPORT_SOURCE == "replica":
+    ReplicaSync(token=token_ms).start(interval=REPLICA_SYNC_INTERVAL)
+
+# Отчёты за типовые периоды (вчера, прошлая неделя, прошлый месяц), подготовленные заранее
+precomputed_reports = PrecomputedReports()
+if PRECOMPUTE_ENABLED:
+    ReportScheduler(token=token_ms, store=precomputed_reports).start()
+
+# Готовые отчёты для скачивания: хранятся REPORT_TTL секунд, старые убираются в фоне
+report_store = get_report_store()
+report_store.start(interval=REPORT_GC_INTERVAL)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Необходимо выполнить вход'
 
 
-def fill_projects():
-    projects = []
-    r = requests.get(
-        url="https://api.moysklad.ru/api/remap/1.2/entity/project",
+def load_projects():
+    url = f"{MS_API_URL}/entity/project"
+
+    # Через общий клиент: соединения переиспользуются, лимит МС общий с формируемыми отчётами
+    r = get_ms_client().get(
+        url=url,
         headers={
             "Authorization": f"Bearer {token_ms}",
         }
     )
 
-    if r.status_code != 200:
-        return {"error": "Ошибка запроса в мой склад"}
+    body = response_json(r, url)
+    return [(project.get("meta").get("href"), project.get("name")) for project in body["rows"]]
 
-    try:
-        body = r.json()
-        for project in body.get("rows"):
-            curr_proj = (project.get("meta").get("href"), project.get("name"))
-            projects.append(curr_proj)
 
-        return projects
+# Время жизни кэша проектов в секундах
+PROJECTS_CACHE_TTL = int(os.environ.get("PROJECTS_CACHE_TTL", 300))
+
+project_cache = ProjectCache(loader=load_projects, ttl=PROJECTS_CACHE_TTL, generation=get_cache_generation())
+
+
+# Время жизни итогов отчёта в кэше, сек
+SUMMARY_CACHE_TTL = int(os.environ.get("SUMMARY_CACHE_TTL", 300))
+
+summary_cache = SummaryCache(ttl=SUMMARY_CACHE_TTL, generation=get_cache_generation())
+
+
+# События вебхуков мой склад сбрасывают затронутые записи кэшей
+webhook_processor = WebhookProcessor(
+    token=token_ms,
+    project_cache=project_cache,
+    assortment_cache=get_assortment_cache(),
+    report_cache=get_report_cache(),
+    summary_cache=summary_cache,
+    precomputed=precomputed_reports,
+    commission_index=get_commission_index(),
+    replica=get_replica() if REPORT_SOURCE == "replica" else None,
+    generation=get_cache_generation()
+)
+
+
+def fill_projects():
+    try:
+        return project_cache.get()
     except Exception as e:
         logger.exception(f"Ошибка заполнения проектов от МС {e}")
-        return {"error": "Ошибка обработки ответа"}
+        return {"error": "Ошибка запроса в мой склад"}
+
+
+def build_report(job):
+    """Выполняется в потоке-исполнителе очереди отчётов"""
+    params = job.params
+
+    # Пакет по нескольким проектам - один zip
+    if "projects" in params:
+        return build_batch_file(token_ms, params["projects"], params["from_date"], params["to_date"],
+                                aggregate=params["aggregate"], progress_callback=job.set_progress,
+                                report_format=params.get("report_format", "xlsx"), store=report_store)
+
+    # Под профилировщиком отчёт строится в отдельном процессе, остальные отчёты профилировщик не замедляет
+    if params.get("profile"):
+        job.set_progress("Отчёт под профилировщиком", 0)
+        report, artifacts = profile_report(token_ms, params, report_store)
+        job.artifacts = [artifact["id"] for artifact in artifacts]
+        return report["id"]
+
+    rg = ReportGenerator(token=token_ms, progress_callback=job.set_progress)
+    rg.set_urls(project=params["project_href"], from_date=params["from_date"], to_date=params["to_date"])
+    report_format = params.get("report_format", "xlsx")
 
+    def write(output):
+        return rg.generate_report(project=params["project_name"], aggregate=params["aggregate"], output=output,
+                                  report_format=report_format)
+
+    metadata = report_store.save(write, report_format, project=params["project_name"],
+                                 from_date=params["from_date"], to_date=params["to_date"], report_format=report_format)
+    return metadata["id"]
+
+
+def profiling_requested():
+    """Отчёт под профилировщиком - только администратору: секрет PROFILE_TOKEN в заголовке X-Profile-Token или ?profile="""
+    if not PROFILE_TOKEN:
+        return False
+
+    token = request.headers.get("X-Profile-Token") or request.args.get("profile") or ""
+    return hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+# Число параллельно формируемых отчётов и максимальная длина очереди
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", 2))
+REPORT_QUEUE_SIZE = int(os.environ.get("REPORT_QUEUE_SIZE", 10))
+
+# В общем хранилище отчётов лежат и статусы заданий: опрос может прийти на любой воркер
+job_queue = JobQueue(handler=build_report, workers=REPORT_WORKERS, max_size=REPORT_QUEUE_SIZE,
+                     state=report_store if isinstance(report_store, SharedReportStore) else None)
+
+# Тип содержимого отчёта по расширению файла
+REPORT_MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'zip': 'application/zip',
+}
+
+
+def report_mimetype(filename):
+    return REPORT_MIMETYPES.get(filename.rsplit('.', 1)[-1], 'application/octet-stream')
+
+# Прямая выдача отчёта в ответе: сколько таких отчётов строится одновременно (остальные уходят в очередь)
+DIRECT_REPORT_SLOTS = int(os.environ.get("DIRECT_REPORT_SLOTS", REPORT_WORKERS))
+# До какого размера книга держится в памяти, больше - во временном файле
+DIRECT_SPOOL_MAX_SIZE = int(os.environ.get("DIRECT_SPOOL_MAX_SIZE", 16 * 1024 * 1024))
+DIRECT_CHUNK_SIZE = 64 * 1024
+
+direct_report_slots = threading.BoundedSemaphore(DIRECT_REPORT_SLOTS)
+
+
+def direct_report_response(project_href, project_name, from_date, to_date, aggregate, report_format="xlsx"):
+    """
+    Строит отчёт в буфер (SpooledTemporaryFile) и отдаёт его телом ответа частями (chunked),
+    без записи в app/temp и второго запроса за файлом
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=DIRECT_SPOOL_MAX_SIZE)
+    try:
+        rg = ReportGenerator(token=token_ms)
+        rg.set_urls(project=project_href, from_date=from_date, to_date=to_date)
+        filename = rg.generate_report(project=project_name, aggregate=aggregate, output=buffer,
+                                      report_format=report_format)
+    except Exception:
+        buffer.close()
+        raise
+
+    buffer.seek(0)
+
+    def chunks():
+        try:
+            while True:
+                chunk = buffer.read(DIRECT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            buffer.close()
+
+    return Response(
+        chunks(),
+        mimetype=report_mimetype(filename),
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
 
 
 class User(UserMixin):
@@ -71,6 +232,16 @@ def load_user(user_id):
     return User(user_id)
 
 
+@login_manager.unauthorized_handler
+def unauthorized():
+    """Браузер без входа уходит на страницу входа, API-клиент получает 401 в JSON"""
+    if request.accept_mimetypes.best_match(["application/json", "text/html"]) == "text/html":
+        flash(login_manager.login_message)
+        return redirect(url_for(login_manager.login_view, next=request.full_path))
+
+    return jsonify({"error": "Необходимо выполнить вход"}), 401
+
+
 VALID_USERNAME = os.environ.get("VALID_USERNAME")
 VALID_PASSWORD = os.environ.get("VALID_PASSWORD")
 
@@ -113,8 +284,12 @@ def generate_report():
 
     generated_link = None
     selected_project_name = None
+    job_id = None
 
     if form.validate_on_submit():
+        # Администратор может попросить профиль отчёта: тогда отчёт всегда строится через очередь
+        profile = profiling_requested()
+
         try:
             # Получаем данные из формы
             project_href = form.projects.data
@@ -127,63 +302,296 @@ def generate_report():
                     selected_project_name = name
                     break
 
-            # ФОРМИРУЕМ ССЫЛКУ
-            base_url = os.environ.get("BASE_URL")
-
-            rg = ReportGenerator(token=token_ms)
-            rg.set_urls(project=project_href, from_date=str(date_from), to_date=str(date_to))
-
-            file_name = rg.generate_report(project=selected_project_name)
-
-            generated_link = f"{base_url}/download_report/{file_name}"
-
-            logger.info(f"Сгенерирована ссылка: {generated_link}")
-            logger.info(f"Выбран проект: {selected_project_name}")
-            logger.info(f"Период: с {date_from} по {date_to}")
+            # Отчёт за типовой период уже подготовлен планировщиком - отдаём сразу
+            prepared = None
+            if not profile and not form.batch.data and not form.aggregate.data and form.report_format.data == "xlsx":
+                prepared = precomputed_reports.find(project_href, date_from, date_to)
+
+            if prepared:
+                logger.info(f"Готовый отчёт: {selected_project_name}, с {date_from} по {date_to}")
+                return send_file(
+                    prepared,
+                    as_attachment=True,
+                    download_name=f"report_{date_from:%Y%m%d}_{date_to:%Y%m%d}.xlsx",
+                    mimetype=report_mimetype(prepared)
+                )
+
+            # Все проекты маркетплейсов одним архивом
+            if form.batch.data:
+                batch_projects = [(href, name) for href, name in projects if href in MAP_PROJECT_AGENT]
+                selected_project_name = ", ".join(name for href, name in batch_projects)
+
+                job = job_queue.submit(
+                    projects=batch_projects,
+                    project_name=selected_project_name,
+                    from_date=str(date_from),
+                    to_date=str(date_to),
+                    aggregate=form.aggregate.data,
+                    report_format=form.report_format.data
+                )
+                job_id = job.id
+                logger.info(f"Задание {job_id} на пакет отчётов: {selected_project_name}, с {date_from} по {date_to}")
+
+            # Прямая выдача, если есть свободный слот, иначе - обычная очередь со ссылкой
+            elif form.download.data and not profile and direct_report_slots.acquire(blocking=False):
+                try:
+                    logger.info(f"Отчёт в ответе: {selected_project_name}, с {date_from} по {date_to}")
+                    return direct_report_response(
+                        project_href, selected_project_name, str(date_from), str(date_to), form.aggregate.data,
+                        form.report_format.data
+                    )
+                finally:
+                    direct_report_slots.release()
+
+            # Ставим отчёт в очередь, ссылку страница получит из статуса задания
+            else:
+                job = job_queue.submit(
+                    project_href=project_href,
+                    project_name=selected_project_name,
+                    from_date=str(date_from),
+                    to_date=str(date_to),
+                    aggregate=form.aggregate.data,
+                    report_format=form.report_format.data,
+                    profile=profile
+                )
+                job_id = job.id
+
+                logger.info(f"Задание {job_id} на отчёт" + (" (с профилированием)" if profile else ""))
+                logger.info(f"Выбран проект: {selected_project_name}")
+                logger.info(f"Период: с {date_from} по {date_to}")
+        except QueueFullError as e:
+            minutes = max(1, round(e.wait_seconds / 60))
+            flash(f"Сейчас формируется слишком много отчётов. Повторите попытку примерно через {minutes} мин.", "warning")
         except Exception as e:
-            logger.exception("Ошибка при генерации отчёта")
+            logger.exception("Ошибка при формировании отчёта")
             flash("Произошла ошибка при генерации отчёта", "error")
 
     return render_template(
         "main.html",
         form=form,
         generated_link=generated_link,
-        selected_project=selected_project_name
+        selected_project=selected_project_name,
+        job_id=job_id,
+        # Секрет профилирования остаётся в адресе формы и статуса задания, только если администратор его передал
+        profile=PROFILE_TOKEN if profiling_requested() else None
     )
 
 
-@app.route('/download_report/<filename>')
+@app.route('/jobs/<job_id>')
 @login_required
-def download_report(filename):
-    """Скачивание файла с автоматическим удалением после отправки"""
+def job_status(job_id):
+    """Статус задания на отчёт, по готовности - ссылка на скачивание"""
+    data = job_queue.status(job_id)
+    if data is None:
+        return jsonify({"error": "Задание не найдено"}), 404
+
+    result = data.pop("result", None)
+    artifacts = data.get("artifacts")
+
+    if data["status"] == Job.DONE:
+        base_url = os.environ.get("BASE_URL")
+        data["download_link"] = f"{base_url}/download_report/{result}"
+        stored = report_store.get(result)
+        if stored is not None:
+            data["size"] = stored[0]["size"]
+            data["expires_at"] = stored[0]["expires_at"]
+        # Ссылки на профиль - только тому, кто знает секрет, и с ним же (для скачивания из браузера)
+        if artifacts and profiling_requested():
+            data["profile_links"] = [
+                {
+                    "name": stored[0]["filename"],
+                    "link": f"{base_url}{url_for('download_profile', artifact_id=stored[0]['id'], profile=PROFILE_TOKEN)}",
+                }
+                for stored in map(report_store.get, artifacts) if stored is not None
+            ]
+
+    return jsonify(data)
+
+
+@app.route('/batch_report', methods=['POST'])
+@login_required
+def batch_report():
+    """
+    Пакет отчётов по нескольким проектам за один период (JSON или форма):
+    date_from, date_to, projects - список ссылок (по умолчанию все из MAP_PROJECT_AGENT), aggregate,
+    format - xlsx (по умолчанию), csv или jsonl.
+    Возвращает задание, по готовности в его статусе будет ссылка на zip.
+    """
+    data = request.get_json(silent=True) or request.form
+    date_from = data.get("date_from")
+    date_to = data.get("date_to")
+    if not date_from or not date_to:
+        return jsonify({"error": "Нужны date_from и date_to"}), 400
 
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+    try:
+        date_from = datetime.fromisoformat(date_from)
+        date_to = datetime.fromisoformat(date_to)
+    except ValueError:
+        return jsonify({"error": "Даты - в формате 2026-01-31 23:59:00"}), 400
 
-    filepath = os.path.join(BASE_DIR, "temp", filename)
+    report_format = data.get("format", "xlsx")
+    if report_format not in REPORT_FORMATS:
+        return jsonify({"error": f"Формат - один из: {', '.join(REPORT_FORMATS)}"}), 400
 
-    # Проверяем, существует ли файл
-    if not os.path.exists(filepath):
-        flash('Файл не найден или уже был скачан', 'error')
-        return redirect(url_for('generate_report'))
+    hrefs = data.getlist("projects") if hasattr(data, "getlist") else data.get("projects")
+    hrefs = hrefs or list(MAP_PROJECT_AGENT)
+
+    projects = fill_projects()
+    names = dict(projects) if isinstance(projects, list) else dict()
+
+    try:
+        job = job_queue.submit(
+            projects=[(href, names.get(href, href.rsplit("/", 1)[-1])) for href in hrefs],
+            project_name=", ".join(names.get(href, href) for href in hrefs),
+            from_date=str(date_from),
+            to_date=str(date_to),
+            aggregate=str(data.get("aggregate", "")).lower() in ("1", "true", "on", "y"),
+            report_format=report_format
+        )
+    except QueueFullError as e:
+        return jsonify({"error": str(e), "wait_seconds": int(e.wait_seconds)}), 503
+
+    logger.info(f"Задание {job.id} на пакет отчётов по {len(hrefs)} проектам, с {date_from} по {date_to}")
+    return jsonify({"job_id": job.id, "status_url": url_for('job_status', job_id=job.id)}), 202
+
+
+@app.route('/api/report/summary')
+@login_required
+def report_summary():
+    """
+    Итоги отчёта без книги Excel: количество и сумма по отгрузкам, продажам и возвратам по отчётам комиссионера,
+    возвратам покупателей и число документов. Параметры: project (ссылка на проект), date_from, date_to.
+    Повторный запрос того же периода отдаётся из кэша.
+    """
+    project_href = request.args.get("project")
+    date_from = request.args.get("date_from")
+    date_to = request.args.get("date_to")
+    if not project_href or not date_from or not date_to:
+        return jsonify({"error": "Нужны project, date_from и date_to"}), 400
+
+    try:
+        date_from = datetime.fromisoformat(date_from)
+        date_to = datetime.fromisoformat(date_to)
+    except ValueError:
+        return jsonify({"error": "Даты - в формате 2026-01-31 23:59:00"}), 400
+
+    started = datetime.now()
+    key = (project_href, str(date_from), str(date_to))
+
+    summary = summary_cache.get(key)
+    cached = summary is not None
+
+    if not cached:
+        # Итоги загружают те же данные, что и отчёт: считаются в тех же слотах, что и «Скачать сразу»
+        if not direct_report_slots.acquire(blocking=False):
+            wait_seconds = max(1, int(job_queue.estimated_wait()))
+            return jsonify({"error": "Все слоты заняты, повторите позже", "wait_seconds": wait_seconds}), 503, \
+                {"Retry-After": str(wait_seconds)}
 
-    # Регистрируем функцию, которая выполнится ПОСЛЕ отправки ответа
-    @after_this_request
-    def remove_file(response):
-        """Удаляем файл после того, как он был отправлен клиенту"""
         try:
-            if os.path.exists(filepath):
-                os.remove(filepath)
-                logger.info(f"Файл {filename} успешно удален")
-        except Exception as e:
-            logger.exception(f"Ошибка при удалении файла {filename}: {e}")
-        return response
+            rg = ReportGenerator(token=token_ms)
+            rg.set_urls(project=project_href, from_date=str(date_from), to_date=str(date_to))
+            summary = rg.generate_summary()
+        except Exception:
+            logger.exception("Ошибка при расчёте итогов отчёта")
+            return jsonify({"error": "Ошибка при расчёте итогов отчёта"}), 502
+        finally:
+            direct_report_slots.release()
+
+        summary_cache.put(key, summary)
+
+    projects = fill_projects()
+    names = dict(projects) if isinstance(projects, list) else dict()
+
+    return jsonify({
+        "project": names.get(project_href, project_href),
+        "from_date": str(date_from),
+        "to_date": str(date_to),
+        "sections": summary["sections"],
+        "documents": summary["documents"],
+        "cached": cached,
+        "seconds": round((datetime.now() - started).total_seconds(), 3),
+    })
+
+
+@app.route('/webhooks/moysklad', methods=['POST'])
+def moysklad_webhook():
+    """
+    Приём вебхуков мой склад. Вход по секрету в урле (?token=) или заголовку X-Webhook-Token;
+    без WEBHOOK_TOKEN маршрут выключен. События обрабатываются в фоне, ответ - сразу.
+    """
+    if not WEBHOOK_TOKEN:
+        return jsonify({"error": "Вебхуки не настроены"}), 404
+
+    token = request.args.get("token") or request.headers.get("X-Webhook-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_TOKEN):
+        return jsonify({"error": "Неверный токен вебхука"}), 403
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"error": "Ожидается JSON с полем events"}), 400
+
+    accepted = webhook_processor.submit(payload)
+    return jsonify({"accepted": accepted})
+
+
+@app.route('/projects/invalidate', methods=['POST'])
+@login_required
+def invalidate_projects():
+    """Сброс кэша проектов, список обновится из мой склад в фоне"""
+    project_cache.invalidate()
+    flash('Список проектов будет обновлён', 'success')
+    return redirect(url_for('generate_report'))
+
+
+@app.route('/metrics')
+def metrics():
+    """Метрики в формате Prometheus. Если задан METRICS_TOKEN - нужен заголовок Authorization: Bearer <токен>"""
+    metrics_token = os.environ.get("METRICS_TOKEN")
+    if metrics_token and request.headers.get("Authorization") != f"Bearer {metrics_token}":
+        return "Unauthorized", 401
+
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@app.route('/profiles/<artifact_id>')
+@login_required
+def download_profile(artifact_id):
+    """Файлы профилирования отчёта из хранилища отчётов (только администратору, см. PROFILE_TOKEN)"""
+    if not profiling_requested():
+        return "Forbidden", 403
+
+    stored = report_store.get(artifact_id)
+    if stored is None or stored[0].get("kind") != PROFILE_KIND:
+        flash("Файл профиля не найден или срок его хранения истёк", "error")
+        return redirect(url_for('generate_report'))
+
+    metadata, path = stored
+    return send_file(path, as_attachment=True, download_name=metadata["filename"],
+                     mimetype="application/octet-stream")
+
+
+@app.route('/download_report/<report_id>')
+@login_required
+def download_report(report_id):
+    """
+    Скачивание отчёта из хранилища. Файл не удаляется после отправки (его уберёт уборка по REPORT_TTL),
+    поэтому работают повторное скачивание, докачка по Range и If-None-Match / If-Modified-Since
+    """
+    stored = report_store.get(report_id)
+    # Файлы профиля отдаёт только /profiles (с секретом)
+    if stored is None or stored[0].get("kind") == PROFILE_KIND:
+        flash('Отчёт не найден или срок его хранения истёк', 'error')
+        return redirect(url_for('generate_report'))
 
-    # Отправляем файл клиенту
+    metadata, path = stored
     return send_file(
-        filepath,
+        path,
         as_attachment=True,  # Принудительное скачивание
-        download_name=filename,  # Имя для скачивания
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        download_name=metadata["filename"],  # Имя для скачивания
+        mimetype=report_mimetype(metadata["filename"]),
+        conditional=True,
+        etag=metadata["id"]
     )
 
 
@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import threading
+import time
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Файл кэша карточек товаров, общий для всех отчётов
+ASSORTMENT_CACHE_PATH = os.environ.get("ASSORTMENT_CACHE_PATH", os.path.join(BASE_DIR, "cache", "assortment.sqlite"))
+# Через сколько секунд карточка считается устаревшей и запрашивается заново
+ASSORTMENT_CACHE_TTL = int(os.environ.get("ASSORTMENT_CACHE_TTL", 24 * 60 * 60))
+# Максимальное число карточек в кэше, самые давно использованные вытесняются (LRU)
+ASSORTMENT_CACHE_MAX_ENTRIES = int(os.environ.get("ASSORTMENT_CACHE_MAX_ENTRIES", 50000))
+
+
+class AssortmentCache:
+    """
+    Кэш карточек товаров (артикул, наименование) в SQLite.
+    Ключ - meta.href ассортимента из позиции документа.
+    """
+
+    def __init__(self, path=ASSORTMENT_CACHE_PATH, ttl=ASSORTMENT_CACHE_TTL, max_entries=ASSORTMENT_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS assortment ("
+            "href TEXT PRIMARY KEY, article TEXT, name TEXT, updated_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS assortment_last_used ON assortment (last_used)")
+        self._conn.commit()
+
+    def get_many(self, hrefs):
+        """Возвращает {href: (article, name)} только для свежих карточек"""
+        hrefs = list(hrefs)
+        found = dict()
+        if not hrefs:
+            return found
+
+        now = time.time()
+        with self._lock:
+            # SQLite ограничивает число параметров в запросе, идём пачками
+            for i in range(0, len(hrefs), 500):
+                chunk = hrefs[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT href, article, name FROM assortment WHERE href IN ({placeholders}) AND updated_at >= ?",
+                    (*chunk, now - self.ttl)
+                ).fetchall()
+                for href, article, name in rows:
+                    found[href] = (article, name)
+
+            if found:
+                self._conn.executemany(
+                    "UPDATE assortment SET last_used = ? WHERE href = ?",
+                    [(now, href) for href in found]
+                )
+                self._conn.commit()
+
+        return found
+
+    def peek(self, href):
+        """Карточка (article, name) независимо от срока жизни, без отметки об использовании; None, если её нет"""
+        with self._lock:
+            row = self._conn.execute("SELECT article, name FROM assortment WHERE href = ?", (href,)).fetchone()
+
+        return tuple(row) if row else None
+
+    def put_many(self, cards):
+        """cards - {href: (article, name)}"""
+        if not cards:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO assortment (href, article, name, updated_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                [(href, article, name, now, now) for href, (article, name) in cards.items()]
+            )
+            self.__evict()
+            self._conn.commit()
+
+    def invalidate(self, hrefs=None):
+        """Удаляет указанные карточки, без аргументов - весь кэш"""
+        with self._lock:
+            if hrefs is None:
+                self._conn.execute("DELETE FROM assortment")
+            else:
+                self._conn.executemany("DELETE FROM assortment WHERE href = ?", [(href,) for href in hrefs])
+            self._conn.commit()
+
+    def __evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM assortment").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM assortment WHERE href IN (SELECT href FROM assortment ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+            logger.info(f"Из кэша карточек вытеснено записей: {excess}")
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def get_assortment_cache():
+    """Общий на процесс экземпляр кэша карточек"""
+    global _shared_cache
+
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = AssortmentCache()
+
+    return _shared_cache
@@ -0,0 +1,171 @@
+"""
+Пакет отчётов по нескольким проектам за один период.
+Отчёты строятся параллельно, делят общий клиент мой склад (пул соединений и лимиты) и общий справочник карточек,
+результат - один zip с отчётом на каждый проект.
+
+Запуск из корня проекта (по умолчанию - все проекты из MAP_PROJECT_AGENT):
+    python -m app.batch --from "2026-01-01 00:00:00" --to "2026-01-31 23:59:00" --output reports.zip
+    python -m app.batch --from ... --to ... --project <ссылка на проект> --project <ссылка> --aggregate
+"""
+import argparse
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from app.report_generator import ReportGenerator, MAP_PROJECT_AGENT, MS_API_URL
+from app.ms_client import get_ms_client, response_json
+from app.flat_writer import REPORT_FORMATS
+from app.report_store import get_report_store
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Сколько отчётов пакета строится одновременно
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", 3))
+# До какого размера отчёт пакета держится в памяти до упаковки в zip
+BATCH_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+
+def batch_filename():
+    return f"reports_{int(time.time())}_{uuid.uuid4().hex}.zip"
+
+
+def report_name(project_name, from_date, to_date, report_format="xlsx"):
+    """Имя отчёта в архиве: проект и даты периода"""
+    safe_name = re.sub(r'[\\/:*?"<>|]+', "_", project_name or "project")
+    return f"{safe_name}_{str(from_date)[:10]}_{str(to_date)[:10]}.{report_format}"
+
+
+def build_batch_report(token, projects, from_date, to_date, output, aggregate=False, progress_callback=None,
+                       max_workers=BATCH_WORKERS, report_format="xlsx"):
+    """
+    projects - [(ссылка на проект, название)], output - путь или файловый объект для zip.
+    Общее время близко к времени самого долгого проекта, а не к сумме.
+    Отчёт проекта, который не удалось построить, заменяется в архиве файлом с ошибкой;
+    если не построился ни один - пакет завершается ошибкой, архив не пишется.
+    """
+    # Общий справочник карточек: товар, встреченный в одном проекте, в других уже не запрашивается
+    assortment = dict()
+    assortment_lock = threading.Lock()
+
+    progress = dict()
+    progress_lock = threading.Lock()
+
+    def project_progress(project_name):
+        def callback(stage, documents):
+            with progress_lock:
+                progress[project_name] = documents
+                total = sum(progress.values())
+            if progress_callback:
+                progress_callback(f"{project_name}: {stage}", total)
+        return callback
+
+    def build(project):
+        """Буфер с отчётом проекта или исключение, с которым он не построился"""
+        project_href, project_name = project
+        buffer = tempfile.SpooledTemporaryFile(max_size=BATCH_SPOOL_MAX_SIZE)
+        try:
+            rg = ReportGenerator(token=token, progress_callback=project_progress(project_name),
+                                 assortment=assortment, assortment_lock=assortment_lock)
+            rg.set_urls(project=project_href, from_date=from_date, to_date=to_date)
+            rg.generate_report(project=project_name, aggregate=aggregate, output=buffer, report_format=report_format)
+        except Exception as e:
+            buffer.close()
+            logger.exception(f"Не удалось построить отчёт пакета: {project_name}: {e}")
+            return e
+
+        logger.info(f"Отчёт пакета готов: {project_name}, этапы: {rg.timings}")
+        return buffer
+
+    started = time.perf_counter()
+    results = list()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(len(projects), max_workers))) as executor:
+            results = list(executor.map(build, projects))
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors and len(errors) == len(results):
+            raise RuntimeError(f"Не удалось построить ни один отчёт пакета: {errors[0]}") from errors[0]
+
+        # xlsx уже сжат, в архив кладём без повторного сжатия; CSV и JSON Lines - текст, их сжимаем
+        compression = ZIP_STORED if report_format == "xlsx" else ZIP_DEFLATED
+        with ZipFile(output, "w", compression=compression) as archive:
+            for (project_href, project_name), result in zip(projects, results):
+                name = report_name(project_name, from_date, to_date, report_format)
+                if isinstance(result, Exception):
+                    archive.writestr(f"{name.rsplit('.', 1)[0]}_ОШИБКА.txt",
+                                     f"Отчёт по проекту {project_name} не построен: {result}\n",
+                                     compress_type=ZIP_DEFLATED)
+                    continue
+
+                result.seek(0)
+                with archive.open(name, "w") as target:
+                    shutil.copyfileobj(result, target)
+    except Exception:
+        # Недописанный архив по пути не оставляем (файловый объект убирает вызывающий)
+        if isinstance(output, str) and os.path.exists(output):
+            os.remove(output)
+        raise
+    finally:
+        for result in results:
+            if not isinstance(result, Exception):
+                result.close()
+
+    logger.info(f"Пакет отчётов по {len(projects)} проектам готов за {time.perf_counter() - started:.2f} с, "
+                f"с ошибкой: {len(errors)}")
+
+
+def build_batch_file(token, projects, from_date, to_date, aggregate=False, progress_callback=None,
+                     report_format="xlsx", store=None):
+    """Пакет в хранилище отчётов, возвращает id для /download_report"""
+    store = store or get_report_store()
+
+    def write(output):
+        build_batch_report(token, projects, from_date, to_date, output, aggregate=aggregate,
+                           progress_callback=progress_callback, report_format=report_format)
+        return batch_filename()
+
+    metadata = store.save(write, "zip", project=", ".join(name for href, name in projects),
+                          from_date=str(from_date), to_date=str(to_date), report_format=report_format)
+    return metadata["id"]
+
+
+def project_names(token, api_url=MS_API_URL):
+    """Ссылка на проект -> название из мой склад"""
+    url = f"{api_url}/entity/project"
+    body = response_json(get_ms_client().get(url, headers={"Authorization": f"Bearer {token}"}), url)
+
+    return {project.get("meta").get("href"): project.get("name") for project in body["rows"]}
+
+
+def main():
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--from", dest="from_date", required=True, help="начало периода, 2026-01-01 00:00:00")
+    parser.add_argument("--to", dest="to_date", required=True, help="конец периода, 2026-01-31 23:59:00")
+    parser.add_argument("--project", action="append", help="ссылка на проект (по умолчанию - все из MAP_PROJECT_AGENT)")
+    parser.add_argument("--aggregate", action="store_true", help="свернуть позиции по артикулу")
+    parser.add_argument("--format", dest="report_format", choices=REPORT_FORMATS, default="xlsx", help="формат отчётов")
+    parser.add_argument("--output", default="reports.zip", help="куда сохранить zip")
+    args = parser.parse_args()
+
+    load_dotenv()
+    token = os.environ.get("TOKEN_MS")
+
+    hrefs = args.project or list(MAP_PROJECT_AGENT)
+    names = project_names(token)
+    projects = [(href, names.get(href, href.rsplit("/", 1)[-1])) for href in hrefs]
+
+    build_batch_report(token, projects, args.from_date, args.to_date, args.output, aggregate=args.aggregate,
+                       report_format=args.report_format)
+    print(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Поколения событий вебхуков, общие для всех воркеров: кэши в памяти процесса (снимки данных отчётов, итоги,
+список проектов) сбрасывает только воркер, принявший вебхук, остальные узнают о событии по счётчику в файле.
+
+Счётчики по видам событий: documents - документы, products - карточки товаров, projects - проекты.
+Воркер, заметивший новое поколение, сбрасывает свои кэши целиком (см. GenerationWatch), принявший вебхук
+отмечает своё поколение учтённым (acknowledge) и сохраняет точечный сброс.
+"""
+import fcntl
+import json
+import os
+import threading
+import uuid
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Файл поколений; для нескольких контейнеров - в общей папке (например, в REPORT_STORE_DIR)
+CACHE_GENERATION_PATH = os.environ.get("CACHE_GENERATION_PATH", os.path.join(BASE_DIR, "cache", "generation.json"))
+
+GENERATION_KINDS = ("documents", "products", "projects")
+
+
+class CacheGeneration:
+    """Счётчики событий в json-файле: запись под блокировкой и через переименование, чтение без блокировки"""
+
+    def __init__(self, path=CACHE_GENERATION_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def current(self):
+        """{вид события: номер поколения}"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = dict()
+
+        return {kind: int(state.get(kind, 0)) for kind in GENERATION_KINDS}
+
+    def bump(self, kind):
+        """Новое поколение событий kind, возвращает (прежнее состояние, новое)"""
+        with open(f"{self.path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            old = self.current()
+            new = dict(old, **{kind: old[kind] + 1})
+
+            temp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(new, f)
+            os.replace(temp_path, self.path)
+
+        return old, new
+
+
+class GenerationWatch:
+    """Поколение, которое кэш процесса уже учёл"""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self._seen = generation.current()
+        self._lock = threading.Lock()
+
+    def changes(self):
+        """Виды событий, поколение которых сменилось после прошлой проверки (их принял другой воркер)"""
+        current = self.generation.current()
+        with self._lock:
+            changed = {kind for kind in GENERATION_KINDS if current[kind] != self._seen[kind]}
+            self._seen = current
+
+        return changed
+
+    def acknowledge(self, old, new):
+        """
+        Событие, сменившее поколение old на new, кэш уже учёл сам. Если между ними было чужое событие
+        (old - не то, что видел кэш), отметка не сдвигается - его заметит changes().
+        """
+        with self._lock:
+            if self._seen == old:
+                self._seen = new
+
+
+_shared_generation = None
+_shared_lock = threading.Lock()
+
+
+def get_cache_generation():
+    """Общий на процесс экземпляр"""
+    global _shared_generation
+
+    with _shared_lock:
+        if _shared_generation is None:
+            _shared_generation = CacheGeneration()
+
+    return _shared_generation
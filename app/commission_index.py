@@ -0,0 +1,145 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Файл индекса заголовков отчётов комиссионера
+COMMISSION_INDEX_PATH = os.environ.get(
+    "COMMISSION_INDEX_PATH",
+    os.path.join(BASE_DIR, "cache", "commission_index.sqlite")
+)
+
+
+def normalize_moment(value):
+    """Приводит дату МС или datetime к строке, которую можно сравнивать лексикографически"""
+    if value is None:
+        return None
+
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace(" ", "T"))
+
+    return value.isoformat(sep=" ", timespec="milliseconds")
+
+
+class CommissionIndex:
+    """
+    Локальный индекс заголовков отчётов комиссионера по контрагентам.
+    Хранит периоды отчётов, чтобы при формировании отчёта выбирать только пересекающиеся с периодом,
+    и дополняется инкрементально по полю updated.
+    """
+
+    def __init__(self, path=COMMISSION_INDEX_PATH):
+        self.path = path
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS commission_reports ("
+            "href TEXT PRIMARY KEY, agent TEXT NOT NULL, name TEXT, "
+            "period_start TEXT, period_end TEXT, updated TEXT, header TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS commission_reports_period "
+            "ON commission_reports (agent, period_end, period_start)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS watermarks (agent TEXT PRIMARY KEY, updated TEXT NOT NULL)")
+        self._conn.commit()
+
+    def watermark(self, agent):
+        """Максимальный updated среди проиндексированных отчётов контрагента"""
+        with self._lock:
+            row = self._conn.execute("SELECT updated FROM watermarks WHERE agent = ?", (agent,)).fetchone()
+
+        return row[0] if row else None
+
+    def update(self, agent, reports):
+        """Добавляет/обновляет заголовки отчётов и сдвигает водяной знак"""
+        if not reports:
+            return
+
+        records = list()
+        max_updated = self.watermark(agent)
+
+        for report in reports:
+            updated = normalize_moment(report.get("updated"))
+            if updated and (max_updated is None or updated > max_updated):
+                max_updated = updated
+
+            # Позиции в индексе не храним, только ссылки на них
+            header = {key: value for key, value in report.items()
+                      if key not in ("positions", "returnToCommissionerPositions")}
+            for key in ("positions", "returnToCommissionerPositions"):
+                if report.get(key):
+                    header[key] = {"meta": report.get(key).get("meta")}
+
+            records.append((
+                report.get("meta").get("href"),
+                agent,
+                report.get("name"),
+                normalize_moment(report.get("commissionPeriodStart")),
+                normalize_moment(report.get("commissionPeriodEnd")),
+                updated,
+                json.dumps(header, ensure_ascii=False)
+            ))
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO commission_reports "
+                "(href, agent, name, period_start, period_end, updated, header) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                records
+            )
+            if max_updated:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO watermarks (agent, updated) VALUES (?, ?)",
+                    (agent, max_updated)
+                )
+            self._conn.commit()
+
+        logger.info(f"Индекс отчётов комиссионера обновлён, записей: {len(records)}")
+
+    def overlapping(self, agent, from_date, to_date):
+        """Заголовки отчётов, период которых пересекается с [from_date, to_date], в порядке name desc"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT header FROM commission_reports "
+                "WHERE agent = ? AND period_end >= ? AND period_start <= ? ORDER BY name DESC",
+                (agent, normalize_moment(from_date), normalize_moment(to_date))
+            ).fetchall()
+
+        return [json.loads(header) for header, in rows]
+
+    def header(self, href):
+        """Заголовок отчёта из индекса или None"""
+        with self._lock:
+            row = self._conn.execute("SELECT header FROM commission_reports WHERE href = ?", (href,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def remove(self, hrefs):
+        with self._lock:
+            self._conn.executemany("DELETE FROM commission_reports WHERE href = ?", [(href,) for href in hrefs])
+            self._conn.commit()
+
+
+_shared_index = None
+_shared_lock = threading.Lock()
+
+
+def get_commission_index():
+    """Общий на процесс экземпляр индекса"""
+    global _shared_index
+
+    with _shared_lock:
+        if _shared_index is None:
+            _shared_index = CommissionIndex()
+
+    return _shared_index
@@ -1,7 +1,9 @@
 import openpyxl
+import time
 from openpyxl import load_workbook
 from copy import copy
 from openpyxl.styles import PatternFill, Font, Border
+from app.metrics import REPORT_PHASE_SECONDS
 
 
 def clear_borders(ws, row, start_col, end_col):
@@ -39,6 +41,8 @@ def insert_block(ws, start_row, data_length, template_row, max_col):
 
 
 def fill_excel_report(template_path, output_path, sections, project_name, from_date, to_date):
+    build_started = time.perf_counter()
+
     wb = load_workbook(template_path)
     ws = wb['Товары WB на реализации']
 
@@ -116,7 +120,10 @@ def fill_excel_report(template_path, output_path, sections, project_name, from_d
     for i in range(len(data_d)):
         ws.cell(row=start_d + i, column=2, value=data_d[i])
 
-    wb.save(output_path)
+    REPORT_PHASE_SECONDS.observe(time.perf_counter() - build_started, phase="excel_build")
+
+    with REPORT_PHASE_SECONDS.time(phase="excel_save"):
+        wb.save(output_path)
 
 
 # =====================================================
@@ -0,0 +1,349 @@
+import os
+import threading
+import time
+from itertools import zip_longest
+from copy import copy
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import NamedStyle, PatternFill, Font, Border
+from app.metrics import REPORT_PHASE_SECONDS
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TEMPLATE_PATH = os.path.join(BASE_DIR, 'шаблон.xlsx')
+SHEET_NAME = 'Товары WB на реализации'
+
+# Метки шаблона, после которых начинаются секции: (колонка, текст)
+SECTION_AB_LABEL = (1, 'Артикул')
+SECTION_C_LABEL = (2, 'данные из отгрузок:')
+SECTION_D_LABEL = (2, 'данные из отчетов и возвратов:')
+
+# Сколько колонок занимают строки секций (A-B: 9 колонок, C и D: 3)
+MAX_COL_AB = 9
+MAX_COL_CD = 3
+
+
+class TemplateLayout:
+    """
+    Разметка шаблона отчёта: значения и стили ячеек по строкам, высоты строк,
+    ширины колонок, объединённые ячейки и строки начала секций.
+    Строится один раз на шаблон, см. get_template_layout.
+    """
+
+    def __init__(self, template_path, sheet_name=SHEET_NAME):
+        wb = load_workbook(template_path)
+        ws = wb[sheet_name]
+
+        self.sheet_name = sheet_name
+        self.max_row = ws.max_row
+        self.max_col = max(ws.max_column, MAX_COL_AB)
+
+        # Стили ячеек: имя стиля -> кортеж объектов стиля, одинаковые ячейки делят один стиль
+        self.styles = dict()
+        self._style_names = dict()
+        # Строки шаблона: номер строки -> {колонка: (значение, имя стиля)}
+        self.rows = dict()
+
+        for row in ws.iter_rows(min_row=1, max_row=self.max_row, max_col=self.max_col):
+            cells = dict()
+            for cell in row:
+                style_key = self.__style_name(cell) if cell.has_style else None
+                if cell.value is not None or style_key is not None:
+                    cells[cell.column] = (cell.value, style_key)
+            self.rows[row[0].row] = cells
+
+        self.row_heights = {idx: dim.height for idx, dim in ws.row_dimensions.items() if dim.height}
+        self.column_widths = {key: dim.width for key, dim in ws.column_dimensions.items() if dim.width}
+        self.merged = [str(cell_range) for cell_range in ws.merged_cells.ranges]
+
+        # Первые строки секций: A и B идут параллельно со строки после заголовка таблицы
+        start_ab = self.__row_after(SECTION_AB_LABEL)
+        self.anchors = {
+            'A': start_ab,
+            'B': start_ab,
+            'C': self.__row_after(SECTION_C_LABEL),
+            'D': self.__row_after(SECTION_D_LABEL),
+        }
+
+        self.sheet_format = copy(ws.sheet_format)
+        self.sheet_view = copy(ws.sheet_view)
+        self.page_margins = copy(ws.page_margins)
+        self.print_options = copy(ws.print_options)
+
+        wb.close()
+
+    def __row_after(self, label):
+        col, text = label
+        for row_idx, cells in self.rows.items():
+            value = cells.get(col, (None, None))[0]
+            if isinstance(value, str) and value.strip() == text:
+                return row_idx + 1
+
+        raise ValueError(f"В шаблоне не найдена метка секции '{text}'")
+
+    def __style_name(self, cell):
+        key = (
+            copy(cell.font), copy(cell.border), copy(cell.fill),
+            cell.number_format, copy(cell.protection), copy(cell.alignment)
+        )
+        if key not in self._style_names:
+            name = f"report_style_{len(self._style_names)}"
+            self._style_names[key] = name
+            self.styles[name] = key
+
+        return self._style_names[key]
+
+
+_layouts = dict()
+_layouts_lock = threading.Lock()
+
+
+def get_template_layout(template_path=TEMPLATE_PATH):
+    """
+    Разобранный шаблон из кэша процесса.
+    Шаблон перечитывается только при изменении файла (mtime).
+    """
+    mtime = os.path.getmtime(template_path)
+
+    with _layouts_lock:
+        cached = _layouts.get(template_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+    layout = TemplateLayout(template_path)
+
+    with _layouts_lock:
+        _layouts[template_path] = (mtime, layout)
+
+    return layout
+
+
+class StreamingReportWriter:
+    """
+    Пишет отчёт за один проход сверху вниз в write-only книгу.
+    Стили ячеек шаблона регистрируются один раз как именованные и переиспользуются.
+    """
+
+    def __init__(self, layout):
+        self.layout = layout
+
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet(layout.sheet_name)
+
+        # Имя стиля шаблона -> имя зарегистрированного именованного стиля
+        self.style_names = dict()
+        # Тот же стиль без рамок (пустые ячейки секций A/B)
+        self.clear_style_names = dict()
+        # Стиль отметки НСП
+        self.nsp_style_names = dict()
+        self._style_arrays = dict()
+
+        for key, style in layout.styles.items():
+            font, border, fill, number_format, protection, alignment = style
+            self.style_names[key] = self.__register(key, font, border, fill, number_format, protection, alignment)
+            self.clear_style_names[key] = self.__register(
+                key + "_clear", font, Border(), fill, number_format, protection, alignment
+            )
+            self.nsp_style_names[key] = self.__register(
+                key + "_nsp", Font(size=8, bold=True), border,
+                PatternFill(start_color='FF0000', end_color='FF0000', fill_type='solid'),
+                number_format, protection, alignment
+            )
+        self.nsp_default_style = self.__register(
+            "report_style_nsp", Font(size=8, bold=True), Border(),
+            PatternFill(start_color='FF0000', end_color='FF0000', fill_type='solid'),
+            'General', None, None
+        )
+
+        for key, width in layout.column_widths.items():
+            self.ws.column_dimensions[key].width = width
+
+        for cell_range in layout.merged:
+            self.ws.merged_cells.add(cell_range)
+
+        self.ws.sheet_format = copy(layout.sheet_format)
+        self.ws.views.sheetView[0] = copy(layout.sheet_view)
+        self.ws.page_margins = copy(layout.page_margins)
+        self.ws.print_options = copy(layout.print_options)
+
+        self.row_idx = 0
+
+    def __register(self, name, font, border, fill, number_format, protection, alignment):
+        style = NamedStyle(name=name, font=copy(font), border=copy(border), fill=copy(fill),
+                           number_format=number_format)
+        if protection is not None:
+            style.protection = copy(protection)
+        if alignment is not None:
+            style.alignment = copy(alignment)
+
+        self.wb.add_named_style(style)
+
+        # Готовый набор индексов стиля: новым ячейкам он копируется без поиска стиля по имени
+        sample = WriteOnlyCell(self.ws)
+        sample.style = name
+        self._style_arrays[name] = sample._style
+
+        return name
+
+    def __cell(self, value, style_name):
+        cell = WriteOnlyCell(self.ws, value=value)
+        if style_name is not None:
+            cell._style = copy(self._style_arrays[style_name])
+        return cell
+
+    def __append(self, cells, template_row):
+        self.row_idx += 1
+
+        # Высота берётся у строки шаблона, по образцу которой пишется строка
+        height = self.layout.row_heights.get(template_row)
+        if height:
+            self.ws.row_dimensions[self.row_idx].height = height
+
+        self.ws.append(cells)
+
+        # Размеры строки write-only лист читает в момент записи, дальше они не нужны:
+        # иначе на каждую строку отчёта в памяти остаётся объект RowDimension
+        if height:
+            del self.ws.row_dimensions[self.row_idx]
+
+    def write_template_row(self, template_row, values=None):
+        """Строка шаблона как есть, values - {колонка: значение} для подстановки"""
+        values = values or {}
+        template_cells = self.layout.rows.get(template_row, {})
+
+        cells = [None] * self.layout.max_col
+        for col, (value, style_key) in template_cells.items():
+            cells[col - 1] = self.__cell(values.get(col, value), self.style_names.get(style_key))
+        for col, value in values.items():
+            if col not in template_cells:
+                cells[col - 1] = WriteOnlyCell(self.ws, value=value)
+
+        self.__append(cells, template_row)
+
+    def write_block_row(self, template_row, index, max_col, values, cleared=(), nsp_col=None):
+        """
+        Строка секции по образцу строки шаблона.
+        Первая строка секции - сама строка шаблона, следующие получают стиль только в колонках 1..max_col.
+        cleared - колонки, в которых убираются рамки.
+        """
+        template_cells = self.layout.rows.get(template_row, {})
+        last_col = self.layout.max_col if index == 0 else max_col
+
+        cells = [None] * self.layout.max_col
+        for col in range(1, last_col + 1):
+            value, style_key = template_cells.get(col, (None, None))
+            value = values.get(col, value if index == 0 else None)
+
+            if col == nsp_col:
+                style_name = self.nsp_style_names.get(style_key, self.nsp_default_style)
+            elif col in cleared:
+                style_name = self.clear_style_names.get(style_key)
+            else:
+                style_name = self.style_names.get(style_key)
+
+            if value is not None or style_name is not None:
+                cells[col - 1] = self.__cell(value, style_name)
+
+        self.__append(cells, template_row)
+
+    def save(self, output_path):
+        self.wb.save(output_path)
+
+
+def write_excel_report(template_path, output_path, sections, project_name, from_date, to_date):
+    """
+    Заполнение отчёта без insert_rows: секции A-D выкладываются за один проход сверху вниз
+    в потоковую (write-only) книгу. Результат совпадает с разметкой шаблона и fill_excel_report.
+    Данные секций A и B можно передать генераторами. Возвращает число записанных строк по секциям.
+    """
+    build_started = time.perf_counter()
+
+    layout = get_template_layout(template_path)
+    writer = StreamingReportWriter(layout)
+
+    start_ab = sections['A']['start_row']
+    start_c = sections['C']['start_row']
+    start_d = sections['D']['start_row']
+
+    # --- Шапка ---
+    for template_row in range(1, start_ab):
+        values = {1: project_name, 3: f"{from_date} - {to_date}"} if template_row == 1 else None
+        writer.write_template_row(template_row, values)
+
+    # =====================================================
+    # СЕКЦИИ A и B (идут параллельно)
+    # Данные могут быть и генераторами: строки пишутся по мере поступления
+    # =====================================================
+    count_a = count_b = 0
+
+    for i, (item_a, item_b) in enumerate(zip_longest(sections['A']['data'], sections['B']['data'])):
+        values = dict()
+        cleared = list()
+        nsp_col = None
+
+        # -------- A (1-4) --------
+        if item_a is not None:
+            values[1] = item_a.get('art', '')
+            values[2] = item_a.get('name', '')
+            values[3] = item_a.get('quantity', 0)
+            values[4] = item_a.get('price', 0)
+            count_a += 1
+        else:
+            cleared.extend(range(1, 5))
+
+        # -------- B (5-9) --------
+        if item_b is not None:
+            values[5] = item_b.get('art', '')
+            values[6] = item_b.get('name', '')
+            values[7] = item_b.get('quantity', 0)
+            values[8] = item_b.get('price', 0)
+
+            if item_b.get('NSP'):
+                values[9] = item_b.get('NSP')
+                nsp_col = 9
+            count_b += 1
+        else:
+            cleared.extend(range(5, 10))
+
+        writer.write_block_row(start_ab, i, MAX_COL_AB, values, cleared=cleared, nsp_col=nsp_col)
+
+    if count_a == 0 and count_b == 0:
+        writer.write_template_row(start_ab)
+
+    for template_row in range(start_ab + 1, start_c):
+        writer.write_template_row(template_row)
+
+    # =====================================================
+    # СЕКЦИЯ C
+    # =====================================================
+    data_c = sections['C']['data']
+
+    if not data_c:
+        writer.write_template_row(start_c)
+
+    for i, number in enumerate(data_c):
+        writer.write_block_row(start_c, i, MAX_COL_CD, {2: number})
+
+    for template_row in range(start_c + 1, start_d):
+        writer.write_template_row(template_row)
+
+    # =====================================================
+    # СЕКЦИЯ D
+    # =====================================================
+    data_d = sections['D']['data']
+
+    if not data_d:
+        writer.write_template_row(start_d)
+
+    for i, number in enumerate(data_d):
+        writer.write_block_row(start_d, i, MAX_COL_CD, {2: number})
+
+    for template_row in range(start_d + 1, layout.max_row + 1):
+        writer.write_template_row(template_row)
+
+    REPORT_PHASE_SECONDS.observe(time.perf_counter() - build_started, phase="excel_build")
+
+    with REPORT_PHASE_SECONDS.time(phase="excel_save"):
+        writer.save(output_path)
+
+    return {'A': count_a, 'B': count_b, 'C': len(data_c), 'D': len(data_d)}
@@ -0,0 +1,78 @@
+import csv
+import io
+import json
+
+# Форматы отчёта: xlsx - книга по шаблону, csv и jsonl - строки позиций для импорта в другие системы
+REPORT_FORMATS = ("xlsx", "csv", "jsonl")
+
+# Колонки плоского отчёта: секция, документ (только у строк секции document), позиция и отметка НСП
+FLAT_COLUMNS = ("section", "document", "art", "name", "quantity", "price", "nsp")
+
+# CSV с BOM: кириллица корректно открывается и в Excel
+CSV_ENCODING = "utf-8-sig"
+
+
+class CsvRowWriter:
+    def __init__(self, stream):
+        self.writer = csv.writer(stream)
+        self.writer.writerow(FLAT_COLUMNS)
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+
+class JsonLinesRowWriter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, row):
+        self.stream.write(json.dumps(dict(zip(FLAT_COLUMNS, row)), ensure_ascii=False))
+        self.stream.write("\n")
+
+
+ROW_WRITERS = {
+    "csv": (CsvRowWriter, CSV_ENCODING),
+    "jsonl": (JsonLinesRowWriter, "utf-8"),
+}
+
+
+def write_flat_report(report_format, output_path, positions, documents):
+    """
+    Отчёт строками, без openpyxl и шаблона: одна строка на позицию и на номер документа.
+    positions - [(секция, позиции)], позиции можно передать генераторами, строки пишутся по мере поступления;
+    documents - номера документов, пишутся последними (в потоковом конвейере они копятся при чтении позиций).
+    output_path - путь или двоичный файловый объект. Возвращает число записанных строк по секциям.
+    """
+    writer_class, encoding = ROW_WRITERS[report_format]
+
+    if hasattr(output_path, "write"):
+        stream = io.TextIOWrapper(output_path, encoding=encoding, newline="")
+    else:
+        stream = open(output_path, "w", encoding=encoding, newline="")
+
+    rows = dict()
+    try:
+        writer = writer_class(stream)
+
+        for section, items in positions:
+            count = 0
+            for item in items:
+                writer.write((section, None, item.get('art', ''), item.get('name', ''),
+                              item.get('quantity', 0), item.get('price', 0), item.get('NSP')))
+                count += 1
+            rows[section] = count
+
+        count = 0
+        for number in documents:
+            writer.write(("document", number, None, None, None, None, None))
+            count += 1
+        rows["document"] = count
+    finally:
+        if hasattr(output_path, "write"):
+            # Файловый объект остаётся открытым: его отдаёт вызывающий
+            stream.flush()
+            stream.detach()
+        else:
+            stream.close()
+
+    return rows
@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import SelectField, DateTimeLocalField, SubmitField
+from wtforms import SelectField, DateTimeLocalField, SubmitField, BooleanField
 from wtforms.validators import DataRequired, ValidationError
 
 
@@ -14,7 +14,24 @@ class PeriodForm(FlaskForm):
     date_from = DateTimeLocalField('Дата ОТ', format='%Y-%m-%dT%H:%M', validators=[DataRequired()])
     date_to = DateTimeLocalField('Дата ДО', format='%Y-%m-%dT%H:%M', validators=[DataRequired()])
 
+    aggregate = BooleanField('Свернуть позиции по артикулу')
+
+    # CSV и JSON Lines пишутся без шаблона Excel - быстрее, для импорта в другие системы
+    report_format = SelectField(
+        'Формат',
+        choices=[
+            ('xlsx', 'Excel по шаблону'),
+            ('csv', 'CSV'),
+            ('jsonl', 'JSON Lines'),
+        ],
+        default='xlsx'
+    )
+
     submit = SubmitField('Отправить')
+    # Отчёт собирается сразу в ответе, без ссылки и очереди
+    download = SubmitField('Скачать сразу')
+    # Отчёты по всем маркетплейсам за период одним архивом
+    batch = SubmitField('Все маркетплейсы архивом')
 
 
 def validate_date_to(form, field):
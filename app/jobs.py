@@ -0,0 +1,211 @@
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Оценка длительности отчёта, пока нет ни одного завершённого
+DEFAULT_JOB_DURATION = 60.0
+# Не чаще скольких секунд сохранять прогресс задания во внешнее хранилище
+PROGRESS_SAVE_INTERVAL = 1.0
+
+
+class QueueFullError(Exception):
+    def __init__(self, wait_seconds):
+        super().__init__(f"Очередь отчётов заполнена, ожидание около {int(wait_seconds)} сек.")
+        self.wait_seconds = wait_seconds
+
+
+class Job:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = Job.QUEUED
+
+        # Прогресс: сколько документов уже загружено и на каком этапе
+        self.stage = None
+        self.documents_fetched = 0
+
+        self.result = None
+        self.error = None
+        # Файлы профилирования, если отчёт строился под профилировщиком
+        self.artifacts = list()
+
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        # Вызывается при изменении прогресса (сохранение статуса для других воркеров)
+        self.on_progress = None
+
+    def set_progress(self, stage, documents_fetched):
+        self.stage = stage
+        self.documents_fetched = documents_fetched
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "documents_fetched": self.documents_fetched,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "artifacts": self.artifacts,
+            "result": self.result,
+        }
+
+
+class JobQueue:
+    """
+    Ограниченная очередь заданий на отчёты и пул потоков-исполнителей.
+    handler(job) строит отчёт и возвращает результат (id отчёта).
+    state - внешнее хранилище статусов (put_job/get_job, см. SharedReportStore): статус задания видят все воркеры,
+    а не только принявший его.
+    """
+
+    def __init__(self, handler, workers=2, max_size=10, history_size=200, state=None):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.history_size = history_size
+        self.state = state
+        self._saved_at = dict()
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._running = 0
+        self._durations = list()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        for i in range(self.workers):
+            threading.Thread(target=self.__worker, name=f"report-worker-{i}", daemon=True).start()
+
+    def submit(self, **params):
+        self.start()
+
+        job = Job(params)
+        job.on_progress = self.__progress
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFullError(self.estimated_wait())
+
+        with self._lock:
+            self._jobs[job.id] = job
+            # Старые задания забываем, начиная с самых ранних
+            while len(self._jobs) > self.history_size:
+                forgotten, _ = self._jobs.popitem(last=False)
+                self._saved_at.pop(forgotten, None)
+
+        self.__save(job)
+
+        logger.info(f"Задание {job.id} поставлено в очередь")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id):
+        """
+        Статус задания словарём (см. Job.to_dict, для ожидающих - место в очереди и оценка ожидания)
+        или None. Задание другого воркера берётся из внешнего хранилища статусов.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return self.state.get_job(job_id) if self.state is not None else None
+
+        return self.__status(job)
+
+    def __status(self, job):
+        data = job.to_dict()
+        if job.status == Job.QUEUED:
+            ahead = self.position(job)
+            data["queue_position"] = ahead + 1
+            data["estimated_wait"] = round(self.estimated_wait(queued=ahead))
+        return data
+
+    def __save(self, job, force=True):
+        """Сохраняет статус во внешнее хранилище; прогресс - не чаще PROGRESS_SAVE_INTERVAL"""
+        if self.state is None:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._saved_at.get(job.id, 0) < PROGRESS_SAVE_INTERVAL:
+                return
+            self._saved_at[job.id] = now
+
+        try:
+            self.state.put_job(self.__status(job))
+        except Exception as e:
+            logger.exception(f"Не удалось сохранить статус задания {job.id}: {e}")
+
+    def __progress(self, job):
+        self.__save(job, force=False)
+
+    def position(self, job):
+        """Сколько заданий стоит в очереди перед указанным"""
+        with self._lock:
+            queued = [j for j in self._jobs.values() if j.status == Job.QUEUED]
+
+        return queued.index(job) if job in queued else 0
+
+    def estimated_wait(self, queued=None):
+        """
+        Оценка ожидания в секундах по средней длительности последних отчётов.
+        queued - сколько заданий в очереди впереди, по умолчанию вся очередь.
+        """
+        with self._lock:
+            durations = self._durations[-20:]
+            running = self._running
+
+        average = sum(durations) / len(durations) if durations else DEFAULT_JOB_DURATION
+        if queued is None:
+            queued = self._queue.qsize()
+
+        return average * (queued + running) / self.workers
+
+    def __worker(self):
+        while True:
+            job = self._queue.get()
+
+            with self._lock:
+                self._running += 1
+
+            job.status = Job.RUNNING
+            job.started_at = time.time()
+            self.__save(job)
+            try:
+                job.result = self.handler(job)
+                job.status = Job.DONE
+            except Exception as e:
+                logger.exception(f"Ошибка выполнения задания {job.id}")
+                job.error = str(e)
+                job.status = Job.FAILED
+            finally:
+                job.finished_at = time.time()
+                with self._lock:
+                    self._running -= 1
+                    self._durations.append(job.finished_at - job.started_at)
+                    del self._durations[:-100]
+                self.__save(job)
+                self._queue.task_done()
@@ -0,0 +1,169 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы корзин гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+
+        def escape(value):
+            return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = dict()
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{self._format_labels(key)} {value}" for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Ключ меток -> [счётчики по корзинам, сумма, количество]
+        self._values = dict()
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: (list(state[0]), state[1], state[2]) for key, state in self._values.items()}
+
+        lines = list()
+        for key, (counts, total, count) in sorted(values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', f'{bound:g}'))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = list()
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = list()
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REPORTS = REGISTRY.register(Counter(
+    "report_app_reports_total", "Сформированные отчёты по результату", ("status",)))
+REPORT_SECONDS = REGISTRY.register(Histogram(
+    "report_app_report_seconds", "Длительность формирования отчёта целиком"))
+REPORT_PHASE_SECONDS = REGISTRY.register(Histogram(
+    "report_app_report_phase_seconds", "Длительность этапов отчёта: demands, commission, refounds, excel (excel_build + excel_save)",
+    ("phase",)))
+ROWS_WRITTEN = REGISTRY.register(Counter(
+    "report_app_rows_written_total", "Строки, записанные в секции отчёта", ("section",)))
+
+MS_REQUESTS = REGISTRY.register(Counter(
+    "report_app_moysklad_requests_total", "Запросы в мой склад", ("endpoint", "status")))
+MS_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "report_app_moysklad_request_seconds", "Длительность запросов в мой склад", ("endpoint",),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)))
+MS_RESPONSE_BYTES = REGISTRY.register(Counter(
+    "report_app_moysklad_response_bytes_total", "Объём ответов мой склад (тело после распаковки), байт", ("endpoint",)))
+MS_RETRIES = REGISTRY.register(Counter(
+    "report_app_moysklad_retries_total", "Повторы запросов в мой склад после 429 и 5xx", ("status",)))
+MS_THROTTLE_SECONDS = REGISTRY.register(Counter(
+    "report_app_moysklad_throttle_seconds_total", "Суммарное ожидание запросов в регуляторе лимитов, сек"))
+
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "report_app_cache_requests_total", "Обращения к кэшам по результату (hit/miss/stale)", ("cache", "result")))
+
+
+def endpoint_label(url):
+    """
+    Метка эндпоинта без идентификаторов и параметров:
+    .../entity/demand/<id>/positions?limit=100 -> entity/demand/{id}/positions
+    """
+    path = url.split("?", 1)[0]
+    if "/entity/" not in path:
+        return path.rsplit("/", 1)[-1]
+
+    parts = path.split("/entity/", 1)[1].split("/")
+    label = ["entity", parts[0]]
+    if len(parts) > 1:
+        label.append("{id}")
+    label.extend(parts[2:])
+    return "/".join(label)
+
+
+def observe_request(url, response, seconds):
+    endpoint = endpoint_label(url)
+    MS_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    MS_REQUEST_SECONDS.observe(seconds, endpoint=endpoint)
+    MS_RESPONSE_BYTES.inc(len(response.content), endpoint=endpoint)
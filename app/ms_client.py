@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from app.rate_limiter import get_rate_limiter, MS_MAX_PARALLEL
+from app.metrics import observe_request, MS_RETRIES
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Базовый урл JSON API мой склад (для замеров можно указать локальную заглушку)
+MS_API_URL = os.environ.get("MS_API_URL", "https://api.moysklad.ru/api/remap/1.2")
+
+# Таймауты запросов в мой склад, сек: установка соединения и ожидание ответа
+MS_CONNECT_TIMEOUT = float(os.environ.get("MS_CONNECT_TIMEOUT", 5))
+MS_READ_TIMEOUT = float(os.environ.get("MS_READ_TIMEOUT", 60))
+# Сколько раз повторять запрос после обрыва соединения или таймаута
+MS_NETWORK_RETRIES = int(os.environ.get("MS_NETWORK_RETRIES", 2))
+
+# Соединений в пуле: одновременных запросов не бывает больше, чем пропускает регулятор
+POOL_SIZE = MS_MAX_PARALLEL * 2
+
+# Размер страницы выборки МС: без expand до 1000 строк, с expand - не более 100
+PAGE_LIMIT = 1000
+PAGE_LIMIT_EXPAND = 100
+
+
+class MoySkladError(RuntimeError):
+    """Мой склад ответил ошибкой (неверный токен, нет прав, ошибка в фильтре, повторы исчерпаны)"""
+
+    def __init__(self, status_code, url, message=None):
+        details = f": {message}" if message else ""
+        super().__init__(f"Ошибка запроса в мой склад, статус {status_code}{details}: {url}")
+        self.status_code = status_code
+
+
+def response_json(response, url):
+    """
+    Тело ответа мой склад. Любой статус, кроме 200, - MoySkladError с текстом errors из тела:
+    страница ошибки не должна превращаться в пустую выборку.
+    """
+    if response.status_code != 200:
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        errors = body.get("errors") if isinstance(body, dict) else None
+        message = "; ".join(str(error.get("error")) for error in errors or [] if isinstance(error, dict)) or None
+        raise MoySkladError(response.status_code, url, message)
+
+    return response.json()
+
+
+def get_json(client, url, headers):
+    """GET в мой склад через client (MoySkladClient или совместимый), тело ответа или MoySkladError"""
+    return response_json(client.request(method="GET", url=url, headers=headers), url)
+
+
+def with_params(url, **params):
+    """Добавляет к урлу параметры запроса, пропуская None"""
+    query = "&".join(f"{key}={value}" for key, value in params.items() if value is not None)
+    if not query:
+        return url
+
+    return url + ("&" if "?" in url else "?") + query
+
+
+def meta_href(entity):
+    """meta.href сущности или None"""
+    if not entity:
+        return None
+
+    return entity.get("meta", {}).get("href")
+
+
+def iter_pages(client, url, headers, expand=None):
+    """
+    Постранично обходит коллекцию МС по meta.nextHref.
+    Отдаёт строки (rows) каждой страницы по мере загрузки; ошибка на любой странице - MoySkladError.
+    """
+    limit = PAGE_LIMIT_EXPAND if expand else PAGE_LIMIT
+    next_url = with_params(url, limit=limit, expand=expand)
+
+    while next_url:
+        page = get_json(client, next_url, headers)
+
+        yield page["rows"]
+
+        next_url = page.get("meta", {}).get("nextHref")
+
+
+def inline_rows(block):
+    """Строки блока позиций документа (positions и т.п.), если expand вложил их целиком, иначе None"""
+    block = block or {}
+    rows = block.get("rows")
+    size = block.get("meta", {}).get("size")
+
+    return rows if rows is not None and (size is None or len(rows) >= size) else None
+
+
+def resolve_blocks(blocks, get_rows, max_workers=1):
+    """
+    Строки блоков позиций документов в том же порядке, что и блоки (порядок документов сохраняется).
+    Вложенные целиком берутся из документа, остальные догружаются get_rows(ссылка на блок),
+    при max_workers > 1 - параллельно.
+    """
+    result = [inline_rows(block) for block in blocks]
+    missing = [i for i, rows in enumerate(result) if rows is None]
+    urls = [meta_href(blocks[i]) for i in missing]
+
+    if max_workers > 1 and len(urls) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetched = list(executor.map(get_rows, urls))
+    else:
+        fetched = [get_rows(url) for url in urls]
+
+    for i, rows in zip(missing, fetched):
+        result[i] = rows
+
+    return result
+
+
+class MoySkladClient:
+    """
+    Общий на процесс HTTP-клиент мой склад: пул keep-alive соединений, сжатые ответы (gzip), таймауты.
+    Каждый запрос проходит через регулятор лимитов и учитывается в метриках.
+    """
+
+    def __init__(self, rate_limiter=None, connect_timeout=MS_CONNECT_TIMEOUT, read_timeout=MS_READ_TIMEOUT,
+                 network_retries=MS_NETWORK_RETRIES, pool_size=POOL_SIZE):
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.timeout = (connect_timeout, read_timeout)
+        self.network_retries = network_retries
+
+        self.session = Session()
+        # Повторы делает регулятор, у адаптера они выключены
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept-Encoding": "gzip",
+            "Connection": "keep-alive",
+        })
+
+    def request(self, method, url, headers=None, body=None):
+        """Возвращает requests.Response; 429 и 5xx уже повторены регулятором"""
+        attempt = 0
+        while True:
+            try:
+                return self.rate_limiter.call(lambda: self.__send(method, url, headers, body))
+            except (ConnectionError, Timeout) as e:
+                if attempt >= self.network_retries:
+                    raise
+
+                attempt += 1
+                MS_RETRIES.inc(status=type(e).__name__)
+                logger.warning(f"Сбой соединения с мой склад ({type(e).__name__}), повтор {attempt}: {url}")
+
+    def get(self, url, headers=None):
+        return self.request("GET", url, headers=headers)
+
+    def __send(self, method, url, headers, body):
+        started = time.perf_counter()
+        response = self.session.request(method=method, url=url, headers=headers, data=body, timeout=self.timeout)
+        observe_request(url, response, time.perf_counter() - started)
+
+        return response
+
+
+_shared_client = None
+_shared_lock = threading.Lock()
+
+
+def get_ms_client():
+    """Общий на процесс клиент: соединения переиспользуются между отчётами и запросами проектов"""
+    global _shared_client
+
+    with _shared_lock:
+        if _shared_client is None:
+            _shared_client = MoySkladClient()
+
+    return _shared_client
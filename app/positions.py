@@ -0,0 +1,105 @@
+import sys
+from collections.abc import Sequence
+
+
+class Position:
+    """
+    Строка позиции отчёта. Компактнее словаря: __slots__ и общие (interned) строки артикула и наименования.
+    Для писателей Excel поддерживает чтение по ключам, как у словаря: art, name, price, quantity, NSP.
+    """
+
+    __slots__ = ("art", "name", "price", "quantity", "nsp")
+
+    _keys = {"art": "art", "name": "name", "price": "price", "quantity": "quantity", "NSP": "nsp"}
+
+    def __init__(self, art, name, price, quantity, nsp=None):
+        self.art = art
+        self.name = name
+        self.price = price
+        self.quantity = quantity
+        self.nsp = nsp
+
+    def get(self, key, default=None):
+        attr = self._keys.get(key)
+        if attr is None:
+            return default
+
+        value = getattr(self, attr)
+        return default if value is None else value
+
+    def __repr__(self):
+        return f"Position(art={self.art!r}, name={self.name!r}, price={self.price}, quantity={self.quantity}, nsp={self.nsp!r})"
+
+
+def intern_text(value):
+    """Одинаковые артикулы и наименования хранятся одной строкой на процесс"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ChainedSequence(Sequence):
+    """Несколько списков как одна последовательность, без копирования (секция B отчёта)"""
+
+    def __init__(self, *parts):
+        self.parts = parts
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+
+        for part in self.parts:
+            if index < len(part):
+                return part[index]
+            index -= len(part)
+
+        raise IndexError(index)
+
+    def __iter__(self):
+        for part in self.parts:
+            yield from part
+
+
+def aggregate_by_article(positions):
+    """
+    Сворачивает позиции по артикулу и наименованию за один проход:
+    количество и сумма складываются, цена - средняя (сумма / количество).
+    Порядок - по первому появлению артикула. Знак цены и количества сохраняется (возвраты отрицательные).
+    """
+    totals = dict()
+
+    for position in positions:
+        key = (position.art, position.name, position.nsp)
+        amount = position.price * abs(position.quantity)
+
+        total = totals.get(key)
+        if total is None:
+            totals[key] = [position.quantity, amount]
+        else:
+            total[0] += position.quantity
+            total[1] += amount
+
+    result = list()
+    for (art, name, nsp), (quantity, amount) in totals.items():
+        price = amount / abs(quantity) if quantity else 0.0
+        result.append(Position(art, name, round(price, 2), quantity, nsp))
+
+    return result
+
+
+def summarize_positions(positions):
+    """
+    Итоги группы позиций за один проход: число строк, количество и сумма (цена * количество).
+    Позиции можно передать генератором. Возвраты дают отрицательные количество и сумму.
+    """
+    count = 0
+    quantity = 0.0
+    amount = 0.0
+
+    for position in positions:
+        count += 1
+        quantity += position.quantity
+        amount += position.price * abs(position.quantity)
+
+    return {"positions": count, "quantity": quantity, "amount": round(amount, 2)}
@@ -0,0 +1,251 @@
+"""
+Заранее подготовленные отчёты за типовые периоды: вчера, прошлая неделя, прошлый месяц
+по каждому проекту из MAP_PROJECT_AGENT. Планировщик строит их в тихие часы,
+форма /generate_report отдаёт готовый файл сразу, если запрошенный период совпадает с подготовленным.
+Данные закрытого периода ещё меняются (отчёты комиссионера приходят позже), поэтому готовый отчёт живёт
+PRECOMPUTE_MAX_AGE секунд: каждый запуск перестраивает устаревшие, а форма устаревший не отдаёт.
+При нескольких воркерах отчёты строит один из них - тот, что взял файл блокировки в папке отчётов.
+
+Подготовить отчёты вручную (например, из cron) из корня проекта:
+    python -m app.precompute
+"""
+import argparse
+import fcntl
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from app.report_generator import ReportGenerator, MAP_PROJECT_AGENT
+from app.batch import project_names
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Включить планировщик в приложении
+PRECOMPUTE_ENABLED = os.environ.get("PRECOMPUTE_ENABLED", "0") == "1"
+# Время запуска (местное), ЧЧ:ММ
+PRECOMPUTE_AT = os.environ.get("PRECOMPUTE_AT", "05:00")
+# Какие периоды готовить: yesterday, last_week, last_month
+PRECOMPUTE_PERIODS = [
+    period.strip() for period in os.environ.get("PRECOMPUTE_PERIODS", "yesterday,last_week,last_month").split(",")
+    if period.strip()
+]
+# Папка готовых отчётов
+PRECOMPUTE_DIR = os.environ.get("PRECOMPUTE_DIR", os.path.join(BASE_DIR, "cache", "precomputed"))
+# Сколько секунд готовый отчёт считается актуальным (по умолчанию чуть меньше суток - перестраивается каждый запуск)
+PRECOMPUTE_MAX_AGE = int(os.environ.get("PRECOMPUTE_MAX_AGE", 20 * 3600))
+
+# Формат даты в имени файла
+FILE_DATE_FORMAT = "%Y%m%dT%H%M"
+# Файл блокировки запуска и окончание временных файлов отчётов
+LOCK_FILENAME = ".lock"
+TEMP_SUFFIX = ".tmp"
+
+
+def precompute_periods(today, periods=None):
+    """
+    Границы типовых периодов относительно дня today: {название: (начало, конец)}.
+    Конец - 23:59 последнего дня, как его выставляет форма.
+    """
+    periods = PRECOMPUTE_PERIODS if periods is None else periods
+    day = datetime.combine(today, datetime.min.time())
+
+    bounds = dict()
+    for period in periods:
+        if period == "yesterday":
+            start, end = day - timedelta(days=1), day
+        elif period == "last_week":
+            monday = day - timedelta(days=day.weekday())
+            start, end = monday - timedelta(days=7), monday
+        elif period == "last_month":
+            first = day.replace(day=1)
+            start, end = (first - timedelta(days=1)).replace(day=1), first
+        else:
+            raise ValueError(f"Неизвестный период для подготовки отчётов: {period}")
+
+        bounds[period] = (start, end - timedelta(minutes=1))
+
+    return bounds
+
+
+class PrecomputedReports:
+    """
+    Готовые отчёты на диске: один файл на (проект, начало, конец периода).
+    Файл пишется во временный и переименовывается, так что читатель не увидит недописанный отчёт.
+    """
+
+    def __init__(self, directory=PRECOMPUTE_DIR, max_age=PRECOMPUTE_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, project_href, from_date, to_date):
+        project_id = project_href.rsplit("/", 1)[-1]
+        return os.path.join(
+            self.directory,
+            f"{project_id}_{from_date.strftime(FILE_DATE_FORMAT)}_{to_date.strftime(FILE_DATE_FORMAT)}.xlsx"
+        )
+
+    def fresh(self, path):
+        """Отчёт есть и построен не раньше max_age секунд назад"""
+        try:
+            return time.time() - os.path.getmtime(path) < self.max_age
+        except FileNotFoundError:
+            return False
+
+    def find(self, project_href, from_date, to_date):
+        """Путь к актуальному готовому отчёту или None"""
+        path = self.path(project_href, from_date, to_date)
+        return path if self.fresh(path) else None
+
+    def build(self, token, project_href, project_name, from_date, to_date):
+        path = self.path(project_href, from_date, to_date)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}{TEMP_SUFFIX}"
+
+        rg = ReportGenerator(token=token)
+        rg.set_urls(project=project_href, from_date=str(from_date), to_date=str(to_date))
+        try:
+            with open(temp_path, "wb") as f:
+                rg.generate_report(project=project_name, output=f)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        return path
+
+    def invalidate(self, periods):
+        """
+        Удаляет отчёты, затронутые изменением: periods(id проекта, начало, конец) -> True.
+        Такие периоды форма построит заново обычным путём. Возвращает число удалённых отчётов.
+        """
+        removed = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".xlsx"):
+                continue
+
+            project_id, from_date, to_date = filename[:-len(".xlsx")].rsplit("_", 2)
+            if periods(project_id, datetime.strptime(from_date, FILE_DATE_FORMAT),
+                       datetime.strptime(to_date, FILE_DATE_FORMAT)):
+                os.remove(os.path.join(self.directory, filename))
+                removed += 1
+
+        return removed
+
+    def lock(self):
+        """
+        Файл блокировки запуска, взятый без ожидания, или None, если отчёты сейчас строит другой процесс.
+        Блокировку снимает закрытие файла (и завершение процесса).
+        """
+        lock_file = open(os.path.join(self.directory, LOCK_FILENAME), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+
+        return lock_file
+
+    def remove_except(self, keep):
+        """
+        Удаляет отчёты за периоды, которые больше не готовятся. Блокировку и недописанные файлы не трогает:
+        временный файл удаляется, только если он старше max_age (брошен упавшим процессом).
+        """
+        removed = 0
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename == LOCK_FILENAME or (filename.endswith(TEMP_SUFFIX) and self.fresh(path)):
+                continue
+            if path not in keep:
+                os.remove(path)
+                removed += 1
+
+        return removed
+
+
+class ReportScheduler:
+    """Раз в сутки в PRECOMPUTE_AT готовит отчёты за типовые периоды по всем проектам MAP_PROJECT_AGENT"""
+
+    def __init__(self, token, store=None, at=PRECOMPUTE_AT, periods=None, projects=None):
+        self.token = token
+        self.store = store or PrecomputedReports()
+        self.at = datetime.strptime(at, "%H:%M").time()
+        self.periods = PRECOMPUTE_PERIODS if periods is None else periods
+        self.projects = list(MAP_PROJECT_AGENT) if projects is None else projects
+
+    def run_once(self, today=None):
+        """
+        Готовит отчёты за периоды относительно today (по умолчанию - сегодня): отсутствующие и устаревшие.
+        Если отчёты уже строит другой воркер или процесс, ничего не делает.
+        """
+        lock = self.store.lock()
+        if lock is None:
+            logger.info("Отчёты за типовые периоды уже готовит другой процесс, запуск пропущен")
+            return
+
+        try:
+            self.__build_all(today)
+        finally:
+            lock.close()
+
+    def __build_all(self, today):
+        started = time.perf_counter()
+        bounds = precompute_periods(today or datetime.now().date(), self.periods)
+
+        try:
+            names = project_names(self.token)
+        except Exception as e:
+            logger.warning(f"Не удалось получить названия проектов, в отчётах будут ссылки: {e}")
+            names = dict()
+
+        keep = set()
+        for project_href in self.projects:
+            for period, (from_date, to_date) in bounds.items():
+                path = self.store.path(project_href, from_date, to_date)
+                keep.add(path)
+                if self.store.fresh(path):
+                    continue
+
+                try:
+                    self.store.build(self.token, project_href, names.get(project_href, project_href),
+                                     from_date, to_date)
+                except Exception as e:
+                    logger.exception(f"Не удалось подготовить отчёт {period} по проекту {project_href}: {e}")
+
+        removed = self.store.remove_except(keep)
+        logger.info(f"Отчёты за типовые периоды подготовлены за {time.perf_counter() - started:.2f} с, "
+                    f"удалено устаревших: {removed}")
+
+    def next_run(self, now=None):
+        now = now or datetime.now()
+        run_at = datetime.combine(now.date(), self.at)
+        return run_at if run_at > now else run_at + timedelta(days=1)
+
+    def start(self):
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def __run(self):
+        while True:
+            time.sleep(max(0.0, (self.next_run() - datetime.now()).total_seconds()))
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.exception(f"Не удалось подготовить отчёты за типовые периоды: {e}")
+
+
+def main():
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--date", help="день, относительно которого считаются периоды (по умолчанию - сегодня)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    today = datetime.fromisoformat(args.date).date() if args.date else None
+    ReportScheduler(token=os.environ.get("TOKEN_MS")).run_once(today)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Профилирование одного отчёта по запросу: cProfile (где уходит время) и tracemalloc (кто выделяет память).
+Результаты: profile_<id>.prof (для pstats/snakeviz), profile_<id>.txt (функции по суммарному и собственному времени)
+и allocations_<id>.txt (крупнейшие выделения).
+
+Профилируемый отчёт строится в отдельном процессе, в одном потоке и без кэша данных отчётов: так в профиль попадает
+вся работа - сеть, разбор JSON, заполнение позиций и запись Excel, а tracemalloc не замедляет остальные отчёты
+приложения. Отчёт и файлы профиля сохраняются в хранилище отчётов и убираются вместе с отчётами по REPORT_TTL.
+
+Из командной строки (из корня проекта):
+    python -m app.profiling --project <ссылка на проект> --from "2026-01-01 00:00:00" --to "2026-01-31 23:59:00"
+"""
+import argparse
+import cProfile
+import io
+import multiprocessing
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Секрет администратора: с ним /generate_report строит отчёт под профилировщиком; без него профилирование выключено
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+# Сколько строк в текстовых сводках
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", 40))
+# Глубина стека, запоминаемая tracemalloc для каждого выделения
+PROFILE_TRACE_FRAMES = 10
+
+# Метка файлов профиля в хранилище отчётов
+PROFILE_KIND = "profile"
+
+# Профилируется один отчёт за раз
+_profile_lock = threading.Lock()
+
+
+@contextmanager
+def profile_run(name="report", directory=None):
+    """
+    Выполняет блок под cProfile и tracemalloc. Отдаёт список, в который после выхода из блока
+    попадают пути сохранённых файлов (по умолчанию - в текущей папке).
+    tracemalloc считает память всего процесса: в приложении блок выполняется только в отдельном процессе.
+    """
+    directory = directory or os.getcwd()
+    artifacts = list()
+
+    profiler = cProfile.Profile()
+    tracemalloc.start(PROFILE_TRACE_FRAMES)
+    started = time.perf_counter()
+
+    profiler.enable()
+    try:
+        yield artifacts
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - started
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        artifacts.extend(save_artifacts(directory, name, profiler, snapshot, elapsed, peak))
+        logger.info(f"Профиль {name} сохранён: {', '.join(artifacts)}")
+
+
+def save_artifacts(directory, name, profiler, snapshot, elapsed, peak):
+    os.makedirs(directory, exist_ok=True)
+    run_id = f"{int(time.time())}_{uuid.uuid4().hex[:12]}"
+
+    profile_path = os.path.join(directory, f"profile_{run_id}.prof")
+    profiler.dump_stats(profile_path)
+
+    stream = io.StringIO()
+    stream.write(f"{name}: {elapsed:.2f} с\n\n")
+    stats = pstats.Stats(profiler, stream=stream).strip_dirs()
+    stream.write("=== По суммарному времени (cumulative) ===\n")
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP)
+    stream.write("=== По собственному времени (tottime) ===\n")
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILE_TOP)
+
+    summary_path = os.path.join(directory, f"profile_{run_id}.txt")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        f.write(stream.getvalue())
+
+    # Выделения самого tracemalloc и импорта модулей в сводку не попадают
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+
+    allocations_path = os.path.join(directory, f"allocations_{run_id}.txt")
+    with open(allocations_path, "w", encoding="utf-8") as f:
+        f.write(f"{name}: пик {peak / 1024 / 1024:.1f} МБ за время профилирования\n\n")
+
+        f.write("=== Удерживаемая память по строкам кода ===\n")
+        for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+            f.write(f"{stat}\n")
+
+        f.write("\n=== Крупнейшие выделения со стеком ===\n")
+        for stat in snapshot.statistics("traceback")[:min(PROFILE_TOP, 10)]:
+            f.write(f"\n{stat.count} блоков, {stat.size / 1024:.1f} КБ\n")
+            for line in stat.traceback.format():
+                f.write(f"{line}\n")
+
+    return [profile_path, summary_path, allocations_path]
+
+
+def build_profiled_report(token, params, directory):
+    """
+    Выполняется в отдельном процессе: строит отчёт под профилировщиком в directory.
+    Возвращает (имя отчёта для скачивания, путь к отчёту, пути файлов профиля).
+    """
+    from app.report_generator import ReportGenerator
+
+    rg = ReportGenerator(token=token, concurrent=False, use_result_cache=False)
+    rg.set_urls(project=params["project_href"], from_date=params["from_date"], to_date=params["to_date"])
+
+    output = os.path.join(directory, "report")
+    with profile_run(f"Отчёт {params['project_name']}, {params['from_date']} - {params['to_date']}",
+                     directory) as artifacts:
+        with open(output, "wb") as f:
+            filename = rg.generate_report(project=params["project_name"], aggregate=params["aggregate"], output=f,
+                                          report_format=params.get("report_format", "xlsx"))
+
+    return filename, output, artifacts
+
+
+def profile_report(token, params, store):
+    """
+    Отчёт под профилировщиком в отдельном процессе; отчёт и файлы профиля сохраняются в store.
+    Возвращает (метаданные отчёта, [метаданные файлов профиля]).
+    """
+    with _profile_lock, tempfile.TemporaryDirectory() as directory:
+        # spawn: дочерний процесс не наследует потоки и соединения приложения
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            filename, output, artifacts = executor.submit(build_profiled_report, token, params, directory).result()
+
+        report_format = params.get("report_format", "xlsx")
+        report = store.save(copy_from(output, filename), report_format, project=params["project_name"],
+                            from_date=params["from_date"], to_date=params["to_date"], report_format=report_format)
+
+        saved = [store.save(copy_from(path, os.path.basename(path)), path.rsplit(".", 1)[-1], kind=PROFILE_KIND)
+                 for path in artifacts]
+
+    return report, saved
+
+
+def copy_from(path, filename):
+    """write для ReportStore.save: копирует готовый файл"""
+    def write(output):
+        with open(path, "rb") as source:
+            shutil.copyfileobj(source, output)
+        return filename
+    return write
+
+
+def main():
+    from dotenv import load_dotenv
+    from app.report_generator import ReportGenerator
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--project", required=True, help="ссылка на проект")
+    parser.add_argument("--from", dest="from_date", required=True, help="начало периода, 2026-01-01 00:00:00")
+    parser.add_argument("--to", dest="to_date", required=True, help="конец периода, 2026-01-31 23:59:00")
+    parser.add_argument("--aggregate", action="store_true", help="свернуть позиции по артикулу")
+    parser.add_argument("--format", dest="report_format", choices=("xlsx", "csv", "jsonl"), default="xlsx")
+    parser.add_argument("--output", help="куда сохранить отчёт (по умолчанию - app/temp)")
+    parser.add_argument("--dir", default=".", help="папка для файлов профиля (по умолчанию - текущая)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    rg = ReportGenerator(token=os.environ.get("TOKEN_MS"), concurrent=False, use_result_cache=False)
+    rg.set_urls(project=args.project, from_date=args.from_date, to_date=args.to_date)
+
+    with profile_run(f"Отчёт {args.project}, {args.from_date} - {args.to_date}", args.dir) as artifacts:
+        if args.output:
+            with open(args.output, "wb") as f:
+                rg.generate_report(project=args.project, aggregate=args.aggregate, output=f,
+                                   report_format=args.report_format)
+        else:
+            rg.generate_report(project=args.project, aggregate=args.aggregate, report_format=args.report_format)
+
+    for path in artifacts:
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
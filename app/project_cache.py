@@ -0,0 +1,88 @@
+import threading
+import time
+from app.cache_generation import GenerationWatch
+from app.metrics import CACHE_REQUESTS
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class ProjectCache:
+    """
+    Кэш списка проектов МС в памяти процесса.
+    Пока снимок свежий - отдаётся сразу. Устаревший снимок тоже отдаётся сразу,
+    а обновление запускается в фоне (stale-while-revalidate).
+    Если МС недоступен - продолжаем отдавать последний удачный снимок.
+    Событие проекта, принятое другим воркером (поколение generation), тоже запускает обновление.
+    """
+
+    def __init__(self, loader, ttl=300, generation=None):
+        self.loader = loader
+        self.ttl = ttl
+        self._watch = GenerationWatch(generation) if generation is not None else None
+
+        self._projects = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self):
+        if self._watch is not None and "projects" in self._watch.changes():
+            with self._lock:
+                self._loaded_at = 0.0
+
+        with self._lock:
+            projects = self._projects
+            expired = time.monotonic() - self._loaded_at >= self.ttl
+
+        # Первый запрос - снимка ещё нет, ждём загрузку
+        if projects is None:
+            CACHE_REQUESTS.inc(cache="projects", result="miss")
+            return self.refresh()
+
+        if expired:
+            CACHE_REQUESTS.inc(cache="projects", result="stale")
+            self.refresh_in_background()
+        else:
+            CACHE_REQUESTS.inc(cache="projects", result="hit")
+
+        return projects
+
+    def refresh(self):
+        projects = self.loader()
+
+        with self._lock:
+            self._projects = projects
+            self._loaded_at = time.monotonic()
+
+        logger.info(f"Список проектов обновлён, проектов: {len(projects)}")
+        return projects
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        threading.Thread(target=self.__background_refresh, daemon=True).start()
+
+    def invalidate(self):
+        """Помечает снимок устаревшим и сразу запускает фоновое обновление"""
+        with self._lock:
+            self._loaded_at = 0.0
+
+        self.refresh_in_background()
+
+    def acknowledge(self, old, new):
+        """Событие, сменившее поколение old на new, уже учтено (принято этим воркером)"""
+        if self._watch is not None:
+            self._watch.acknowledge(old, new)
+
+    def __background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.exception(f"Не удалось обновить список проектов, используется последний снимок: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
@@ -0,0 +1,168 @@
+import os
+import random
+import threading
+import time
+from app.metrics import MS_RETRIES, MS_THROTTLE_SECONDS
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Лимиты мой склад на аккаунт: не более 45 запросов за 3 секунды и 5 параллельных запросов
+MS_RATE_LIMIT_REQUESTS = int(os.environ.get("MS_RATE_LIMIT_REQUESTS", 45))
+MS_RATE_LIMIT_WINDOW = float(os.environ.get("MS_RATE_LIMIT_WINDOW", 3))
+MS_MAX_PARALLEL = int(os.environ.get("MS_MAX_PARALLEL", 5))
+# Сколько раз повторять запрос после 429 и 5xx
+MS_MAX_RETRIES = int(os.environ.get("MS_MAX_RETRIES", 8))
+
+# Доля лимита, которую расходуем сами: запас на окно МС (скользящее, а не ведро) и на соседние процессы
+RATE_SAFETY = 0.9
+
+# Статусы, после которых запрос повторяется
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Пауза после 429, если МС не прислал X-Lognex-Retry-TimeInterval, сек
+DEFAULT_RETRY_PAUSE = 1.0
+# Экспоненциальная пауза после 5xx: 0.5, 1, 2 ... не больше 15 секунд
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 15.0
+
+# Через сколько удачных ответов подряд разрешаем ещё один параллельный запрос
+INCREASE_AFTER = 20
+
+
+class RateLimiter:
+    """
+    Общий на процесс регулятор запросов в мой склад.
+    Ведро токенов держит темп чуть ниже лимита МС, число одновременных запросов подстраивается на ходу:
+    после 429 уменьшается вдвое, после серии удачных ответов растёт на единицу до MS_MAX_PARALLEL.
+    Заголовки ответа МС учитываются: X-RateLimit-Remaining ограничивает запас токенов,
+    X-Lognex-Retry-TimeInterval (мс) приостанавливает все запросы процесса.
+    """
+
+    def __init__(self, requests=MS_RATE_LIMIT_REQUESTS, window=MS_RATE_LIMIT_WINDOW, max_parallel=MS_MAX_PARALLEL,
+                 max_retries=MS_MAX_RETRIES):
+        self.rate = requests * RATE_SAFETY / window
+        # Всплеск не больше числа параллельных запросов, иначе в скользящем окне МС выйдет больше лимита
+        self.capacity = max(1, max_parallel)
+        self.max_parallel = max(1, max_parallel)
+        self.max_retries = max_retries
+
+        self.parallel = self.max_parallel
+
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._active = 0
+        self._paused_until = 0.0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def call(self, send):
+        """
+        Выполняет send() (запрос, возвращающий requests.Response) с учётом лимитов.
+        429 и 5xx повторяются; если попытки кончились - возвращается последний ответ.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            response = None
+            try:
+                response = send()
+            finally:
+                self.release(response)
+
+            if response.status_code not in RETRY_STATUSES:
+                return response
+
+            if attempt >= self.max_retries:
+                logger.error(f"Мой склад вернул {response.status_code}, попытки исчерпаны: {response.url}")
+                return response
+
+            MS_RETRIES.inc(status=response.status_code)
+            attempt += 1
+
+            # После 429 общая пауза уже выставлена в release, её выдержит acquire
+            if response.status_code != 429:
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                logger.warning(f"Мой склад вернул {response.status_code}, повтор {attempt} через {delay:.1f} с")
+                time.sleep(delay)
+
+    def acquire(self):
+        started = time.monotonic()
+
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self.__refill(now)
+
+                if now < self._paused_until:
+                    timeout = self._paused_until - now
+                elif self._active >= self.parallel:
+                    timeout = None
+                elif self._tokens < 1:
+                    timeout = (1 - self._tokens) / self.rate
+                else:
+                    self._tokens -= 1
+                    self._active += 1
+                    break
+
+                self._condition.wait(timeout)
+
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            MS_THROTTLE_SECONDS.inc(waited)
+
+    def release(self, response=None):
+        with self._condition:
+            self._active -= 1
+
+            if response is not None:
+                self.__observe(response)
+
+            self._condition.notify_all()
+
+    def __refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def __observe(self, response):
+        headers = response.headers
+
+        remaining = headers.get("X-RateLimit-Remaining")
+        if remaining is not None and remaining.isdigit():
+            self.__refill(time.monotonic())
+            self._tokens = min(self._tokens, float(remaining))
+
+        if response.status_code == 429:
+            retry_ms = headers.get("X-Lognex-Retry-TimeInterval") or headers.get("X-Lognex-Retry-After")
+            pause = int(retry_ms) / 1000 if retry_ms and retry_ms.isdigit() else DEFAULT_RETRY_PAUSE
+
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            self._tokens = 0.0
+            self._successes = 0
+
+            parallel = max(1, self.parallel // 2)
+            if parallel != self.parallel:
+                logger.info(f"Мой склад ограничил запросы, параллельных запросов: {self.parallel} -> {parallel}")
+            self.parallel = parallel
+            return
+
+        if response.status_code < 400 and self.parallel < self.max_parallel:
+            self._successes += 1
+            if self._successes >= INCREASE_AFTER:
+                self._successes = 0
+                self.parallel += 1
+
+
+_shared_limiter = None
+_shared_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Общий на процесс регулятор: все отчёты и запрос проектов делят один лимит аккаунта"""
+    global _shared_limiter
+
+    with _shared_lock:
+        if _shared_limiter is None:
+            _shared_limiter = RateLimiter()
+
+    return _shared_limiter
@@ -0,0 +1,424 @@
+"""
+Локальная реплика документов мой склад в SQLite: отгрузки, возвраты покупателей и отчёты комиссионера
+вместе с позициями (артикул и наименование товара сохраняются в позиции вместе со ссылкой на товар,
+вебхук изменения товара обновляет их во всех позициях - update_card).
+
+Синхронизация инкрементальная - по водяному знаку updated для каждой сущности.
+Удалённые в МС документы инкрементально не видны: фоновая синхронизация раз в REPLICA_RECONCILE_EVERY проходов
+сверяет ссылки документов реплики со списком в МС (без позиций) и удаляет исчезнувшие,
+вебхуки удаления убирают документ сразу. Полная синхронизация (--full) загружает всё заново.
+
+Запуск синхронизации вручную из корня проекта:
+    python -m app.replica
+    python -m app.replica --reconcile
+    python -m app.replica --full
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from app.assortment_cache import get_assortment_cache
+from app.commission_index import normalize_moment
+from app.ms_client import get_ms_client, get_json, with_params, meta_href, iter_pages, resolve_blocks, MS_API_URL
+from app.rate_limiter import MS_MAX_PARALLEL
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Файл реплики документов
+REPLICA_PATH = os.environ.get("REPLICA_PATH", os.path.join(BASE_DIR, "cache", "replica.sqlite"))
+# Как часто фоновая синхронизация догружает изменения, сек
+REPLICA_SYNC_INTERVAL = int(os.environ.get("REPLICA_SYNC_INTERVAL", 300))
+# Раз в сколько проходов синхронизации сверять реплику со списком документов МС
+REPLICA_RECONCILE_EVERY = int(os.environ.get("REPLICA_RECONCILE_EVERY", 12))
+
+# Сущность -> поля документа с позициями
+ENTITY_POSITIONS = {
+    "demand": ("positions",),
+    "salesreturn": ("positions",),
+    "commissionreportin": ("positions", "returnToCommissionerPositions"),
+}
+
+
+class Replica:
+    """Хранилище реплики: заголовки документов, позиции и водяные знаки синхронизации"""
+
+    def __init__(self, path=REPLICA_PATH):
+        self.path = path
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "href TEXT PRIMARY KEY, entity TEXT NOT NULL, name TEXT, moment TEXT, updated TEXT, "
+            "project TEXT, agent TEXT, period_start TEXT, period_end TEXT, synced_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS documents_project ON documents (entity, project, moment)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS documents_period ON documents (entity, agent, period_end)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS positions ("
+            "document TEXT NOT NULL, kind TEXT NOT NULL, seq INTEGER NOT NULL, "
+            "article TEXT, name TEXT, price REAL, quantity REAL, assortment TEXT, PRIMARY KEY (document, kind, seq))"
+        )
+        # Реплика, созданная до появления ссылки на товар в позиции: водяные знаки сбрасываются,
+        # следующая синхронизация перезапишет документы вместе со ссылками
+        if "assortment" not in {column[1] for column in self._conn.execute("PRAGMA table_info(positions)")}:
+            self._conn.execute("ALTER TABLE positions ADD COLUMN assortment TEXT")
+            self._conn.execute("DELETE FROM watermarks")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS positions_assortment ON positions (assortment)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks (entity TEXT PRIMARY KEY, updated TEXT, synced_at REAL)"
+        )
+        self._conn.commit()
+
+    def watermark(self, entity):
+        """Максимальный updated среди синхронизированных документов сущности"""
+        with self._lock:
+            row = self._conn.execute("SELECT updated FROM watermarks WHERE entity = ?", (entity,)).fetchone()
+
+        return row[0] if row else None
+
+    def synced_at(self, entity):
+        """Время (unix) последней завершённой синхронизации сущности или None"""
+        with self._lock:
+            row = self._conn.execute("SELECT synced_at FROM watermarks WHERE entity = ?", (entity,)).fetchone()
+
+        return row[0] if row else None
+
+    def upsert(self, entity, documents, synced_at):
+        """
+        Сохраняет документы вместе с позициями (позиции документа заменяются целиком) и сдвигает водяной знак.
+        documents - словари с ключами href, name, moment, updated, project, agent, period_start, period_end
+        и positions: {поле документа: [(артикул, наименование, цена в копейках, количество, ссылка на товар), ...]}
+        """
+        if not documents:
+            return
+
+        max_updated = self.watermark(entity)
+        for document in documents:
+            if document["updated"] and (max_updated is None or document["updated"] > max_updated):
+                max_updated = document["updated"]
+
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO documents "
+                    "(href, entity, name, moment, updated, project, agent, period_start, period_end, synced_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(document["href"], entity, document["name"], document["moment"], document["updated"],
+                      document["project"], document["agent"], document["period_start"], document["period_end"],
+                      synced_at) for document in documents]
+                )
+                self._conn.executemany("DELETE FROM positions WHERE document = ?",
+                                       [(document["href"],) for document in documents])
+                self._conn.executemany(
+                    "INSERT INTO positions (document, kind, seq, article, name, price, quantity, assortment) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(document["href"], kind, seq) + tuple(row)
+                     for document in documents
+                     for kind, rows in document["positions"].items()
+                     for seq, row in enumerate(rows)]
+                )
+                self._conn.execute(
+                    "INSERT INTO watermarks (entity, updated) VALUES (?, ?) "
+                    "ON CONFLICT (entity) DO UPDATE SET updated = excluded.updated",
+                    (entity, max_updated)
+                )
+
+    def mark_synced(self, entity, synced_at):
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO watermarks (entity, synced_at) VALUES (?, ?) "
+                    "ON CONFLICT (entity) DO UPDATE SET synced_at = excluded.synced_at",
+                    (entity, synced_at)
+                )
+
+    def remove_stale(self, entity, synced_before):
+        """Удаляет документы, не попавшие в полную синхронизацию (удалены в МС)"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM positions WHERE document IN "
+                    "(SELECT href FROM documents WHERE entity = ? AND synced_at < ?)",
+                    (entity, synced_before)
+                )
+                removed = self._conn.execute(
+                    "DELETE FROM documents WHERE entity = ? AND synced_at < ?", (entity, synced_before)
+                ).rowcount
+
+        return removed
+
+    def update_card(self, href, article, name):
+        """
+        Новые артикул и наименование товара href во всех позициях.
+        Возвращает затронутые документы: [(сущность, проект, moment, контрагент, начало и конец периода отчёта)]
+        """
+        with self._lock:
+            with self._conn:
+                documents = self._conn.execute(
+                    "SELECT entity, project, moment, agent, period_start, period_end FROM documents "
+                    "WHERE href IN (SELECT document FROM positions WHERE assortment = ?)",
+                    (href,)
+                ).fetchall()
+                self._conn.execute("UPDATE positions SET article = ?, name = ? WHERE assortment = ?",
+                                   (article, name, href))
+
+        return documents
+
+    def document(self, href):
+        """Проект и момент документа из реплики: (ссылка на проект, moment) или None"""
+        with self._lock:
+            return self._conn.execute("SELECT project, moment FROM documents WHERE href = ?", (href,)).fetchone()
+
+    def remove_missing(self, entity, hrefs, synced_before):
+        """
+        Удаляет документы сущности, которых нет среди hrefs (список документов МС).
+        Документы, записанные после synced_before, не трогаются: списка на момент их записи ещё не было.
+        """
+        with self._lock:
+            known = [href for href, in self._conn.execute(
+                "SELECT href FROM documents WHERE entity = ? AND synced_at < ?", (entity, synced_before)
+            )]
+
+        return self.remove([href for href in known if href not in hrefs])
+
+    def remove(self, hrefs):
+        """Удаляет документы с позициями по ссылкам, возвращает число удалённых"""
+        if not hrefs:
+            return 0
+
+        with self._lock:
+            with self._conn:
+                self._conn.executemany("DELETE FROM positions WHERE document = ?", [(href,) for href in hrefs])
+                removed = sum(
+                    self._conn.execute("DELETE FROM documents WHERE href = ?", (href,)).rowcount for href in hrefs
+                )
+
+        return removed
+
+    def documents(self, entity, project, from_date, to_date):
+        """Документы проекта за период в порядке name desc: [(номер, {поле: позиции}), ...]"""
+        return self.__select(
+            "d.entity = ? AND d.project = ? AND d.moment >= ? AND d.moment <= ?",
+            (entity, project, normalize_moment(from_date), normalize_moment(to_date))
+        )
+
+    def commission_reports(self, agent, from_date, to_date):
+        """Отчёты комиссионера контрагента, период которых пересекается с [from_date, to_date], в порядке name desc"""
+        return self.__select(
+            "d.entity = 'commissionreportin' AND d.agent = ? AND d.period_end >= ? AND d.period_start <= ?",
+            (agent, normalize_moment(from_date), normalize_moment(to_date))
+        )
+
+    def __select(self, where, params):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT d.href, d.name, p.kind, p.article, p.name, p.price, p.quantity "
+                "FROM documents d LEFT JOIN positions p ON p.document = d.href "
+                f"WHERE {where} ORDER BY d.name DESC, d.href, p.kind, p.seq",
+                params
+            ).fetchall()
+
+        documents = list()
+        current_href = None
+        for href, name, kind, article, product_name, price, quantity in rows:
+            if href != current_href:
+                current_href = href
+                documents.append((name, dict()))
+            if kind is not None:
+                documents[-1][1].setdefault(kind, []).append((article, product_name, price, quantity))
+
+        return documents
+
+
+class ReplicaSync:
+    """Догружает в реплику документы, изменённые в МС после последней синхронизации"""
+
+    def __init__(self, token, replica=None, client=None, api_url=MS_API_URL, max_workers=MS_MAX_PARALLEL,
+                 assortment_cache=None):
+        self.replica = replica or get_replica()
+        self.client = client or get_ms_client()
+        self.api_url = api_url
+        self.max_workers = max_workers
+        # Карточки, которые пришли без развёрнутых полей, - через общий кэш карточек
+        self.assortment_cache = assortment_cache or get_assortment_cache()
+        self.headers = {
+            "Authorization": f"Bearer {token}",
+        }
+
+        self._lock = threading.Lock()
+
+    def sync(self, full=False):
+        """Синхронизирует все сущности, возвращает число загруженных документов по сущностям"""
+        with self._lock:
+            counts = dict()
+            for entity, fields in ENTITY_POSITIONS.items():
+                counts[entity] = self.__sync_entity(entity, fields, full)
+
+        logger.info(f"Реплика синхронизирована{' полностью' if full else ''}, документов: {counts}")
+        return counts
+
+    def reconcile(self):
+        """
+        Удаляет из реплики документы, которых больше нет в МС: список ссылок загружается без позиций,
+        по 1000 на страницу. Возвращает число удалённых документов по сущностям.
+        """
+        with self._lock:
+            counts = dict()
+            for entity in ENTITY_POSITIONS:
+                started = time.time()
+                hrefs = set()
+                for rows in iter_pages(self.client, f"{self.api_url}/entity/{entity}", self.headers):
+                    hrefs.update(meta_href(row) for row in rows)
+
+                counts[entity] = self.replica.remove_missing(entity, hrefs, started)
+
+        logger.info(f"Реплика сверена со списком документов МС, удалено: {counts}")
+        return counts
+
+    def start(self, interval=REPLICA_SYNC_INTERVAL, reconcile_every=REPLICA_RECONCILE_EVERY):
+        """Фоновая синхронизация раз в interval секунд, сверка удалённых - раз в reconcile_every проходов"""
+        threading.Thread(target=self.__run, args=(interval, reconcile_every), daemon=True).start()
+
+    def __run(self, interval, reconcile_every):
+        passes = 0
+        while True:
+            try:
+                self.sync()
+                # Первая сверка - сразу после запуска: за время простоя документы могли удалить
+                if reconcile_every > 0 and passes % reconcile_every == 0:
+                    self.reconcile()
+                passes += 1
+            except Exception as e:
+                logger.exception(f"Не удалось синхронизировать реплику: {e}")
+            time.sleep(interval)
+
+    def __sync_entity(self, entity, fields, full):
+        started = time.time()
+
+        url = f"{self.api_url}/entity/{entity}"
+        watermark = None if full else self.replica.watermark(entity)
+        if watermark:
+            # Фильтр МС принимает время с точностью до секунды, граничные документы просто перезапишутся
+            url += f"?filter=updated>={watermark[:19]}"
+
+        expand = ",".join(f"{field}.assortment" for field in fields)
+
+        count = 0
+        for page in iter_pages(self.client, with_params(url, order="updated"), self.headers, expand=expand):
+            self.replica.upsert(entity, self.__documents(page, fields), started)
+            count += len(page)
+
+        if full:
+            removed = self.replica.remove_stale(entity, started)
+            if removed:
+                logger.info(f"Из реплики удалено документов {entity}: {removed}")
+
+        self.replica.mark_synced(entity, started)
+        return count
+
+    def __documents(self, page, fields):
+        # Позиции, не поместившиеся в документ, догружаем параллельно
+        blocks = iter(resolve_blocks([row.get(field) for row in page for field in fields], self.__get_positions,
+                                     self.max_workers))
+        resolved = [{field: next(blocks) for field in fields} for row in page]
+        cards = self.__cards(position.get("assortment") for row_blocks in resolved
+                             for rows in row_blocks.values() for position in rows)
+
+        documents = list()
+        for row, row_blocks in zip(page, resolved):
+            positions = {field.lower(): [self.__position(position, cards) for position in rows]
+                         for field, rows in row_blocks.items()}
+
+            documents.append({
+                "href": meta_href(row),
+                "name": row.get("name"),
+                "moment": normalize_moment(row.get("moment")),
+                "updated": normalize_moment(row.get("updated")),
+                "project": (row.get("project") or {}).get("meta", {}).get("href"),
+                "agent": (row.get("agent") or {}).get("meta", {}).get("href"),
+                "period_start": normalize_moment(row.get("commissionPeriodStart")),
+                "period_end": normalize_moment(row.get("commissionPeriodEnd")),
+                "positions": positions,
+            })
+
+        return documents
+
+    @staticmethod
+    def __position(row, cards):
+        assortment = row.get("assortment") or {}
+
+        if "name" in assortment:
+            article, name = assortment.get("article"), assortment.get("name")
+        else:
+            article, name = cards.get(meta_href(assortment), (None, None))
+
+        return article, name, row.get("price"), row.get("quantity"), meta_href(assortment)
+
+    def __cards(self, assortments):
+        """Карточки товаров, пришедших без развёрнутых полей: {href: (артикул, наименование)} - из кэша или МС"""
+        hrefs = {meta_href(assortment) for assortment in assortments
+                 if assortment and "name" not in assortment and meta_href(assortment)}
+        if not hrefs:
+            return dict()
+
+        cards = self.assortment_cache.get_many(hrefs)
+        fetched = dict()
+        for href in hrefs - set(cards):
+            entity = get_json(self.client, href, self.headers)
+            fetched[href] = (entity.get("article"), entity.get("name"))
+
+        self.assortment_cache.put_many(fetched)
+        cards.update(fetched)
+        return cards
+
+    def __get_positions(self, url):
+        if url is None:
+            return []
+
+        positions = list()
+        for rows in iter_pages(self.client, url, self.headers, expand="assortment"):
+            positions.extend(rows)
+
+        return positions
+
+
+_shared_replica = None
+_shared_lock = threading.Lock()
+
+
+def get_replica():
+    """Общий на процесс экземпляр реплики"""
+    global _shared_replica
+
+    with _shared_lock:
+        if _shared_replica is None:
+            _shared_replica = Replica()
+
+    return _shared_replica
+
+
+def main():
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="полная синхронизация с удалением исчезнувших документов")
+    parser.add_argument("--reconcile", action="store_true", help="после синхронизации удалить исчезнувшие в МС документы")
+    args = parser.parse_args()
+
+    load_dotenv()
+    replica_sync = ReplicaSync(token=os.environ.get("TOKEN_MS"))
+    replica_sync.sync(full=args.full)
+    if args.reconcile and not args.full:
+        replica_sync.reconcile()
+
+
+if __name__ == "__main__":
+    main()
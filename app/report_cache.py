@@ -0,0 +1,207 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from app.cache_generation import GenerationWatch, get_cache_generation
+from app.metrics import CACHE_REQUESTS
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Кэш данных отчётов: повторный отчёт за тот же проект и период догружает только изменённые документы
+REPORT_CACHE_ENABLED = os.environ.get("REPORT_CACHE_ENABLED", "1") == "1"
+# Сколько периодов (проект, начало, конец) держать в памяти
+REPORT_CACHE_ENTRIES = int(os.environ.get("REPORT_CACHE_ENTRIES", 16))
+# Сколько позиций всего держать в снимках (около 100 байт на позицию); снимок больше предела не кэшируется
+REPORT_CACHE_MAX_POSITIONS = int(os.environ.get("REPORT_CACHE_MAX_POSITIONS", 200000))
+# Изменения приходят вебхуками мой склад (/webhooks/moysklad): группы документов без событий
+# отдаются из кэша без перепроверки в МС
+REPORT_CACHE_TRUST_WEBHOOKS = os.environ.get("REPORT_CACHE_TRUST_WEBHOOKS", "0") == "1"
+
+
+class _Flight:
+    """Расчёт снимка, который сейчас выполняется: остальные запросы того же ключа ждут его"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.snapshot = None
+        self.error = None
+
+
+def snapshot_positions(snapshot):
+    """Число позиций в снимке: документы групп - (номер, href, updated, позиции[, возвраты])"""
+    return sum(len(positions) for documents in snapshot.values() for document in documents
+               for positions in document[3:])
+
+
+class ReportCache:
+    """
+    Снимки данных отчётов в памяти процесса: ключ - (проект, начало, конец периода),
+    снимок - документы по группам с отметкой updated и готовыми позициями.
+    Одинаковые одновременные запросы делят один расчёт (single-flight),
+    при переполнении (по числу периодов или позиций) вытесняются самые давно запрошенные периоды.
+    События вебхуков помечают группы снимка устаревшими (mark_stale). О событиях, принятых другими воркерами,
+    кэш узнаёт по поколению (generation, см. app/cache_generation.py): после событий документов все группы
+    перепроверяются по updated, после событий товаров снимки сбрасываются.
+    """
+
+    def __init__(self, max_entries=REPORT_CACHE_ENTRIES, trust_webhooks=REPORT_CACHE_TRUST_WEBHOOKS,
+                 max_positions=REPORT_CACHE_MAX_POSITIONS, generation=None):
+        self.max_entries = max_entries
+        self.max_positions = max_positions
+        self.trust_webhooks = trust_webhooks
+        self._watch = GenerationWatch(generation) if generation is not None else None
+
+        self._snapshots = OrderedDict()
+        # Ключ -> число позиций в снимке и их сумма по всем снимкам
+        self._sizes = dict()
+        self._positions = 0
+        # Ключ -> группы документов, по которым после прошлого расчёта пришли события
+        self._stale = dict()
+        self._flights = dict()
+        self._lock = threading.Lock()
+
+    def load(self, key, revalidate):
+        """
+        revalidate(предыдущий снимок или None, группы без изменений) -> новый снимок.
+        Группы без изменений известны только при доверии вебхукам, иначе перепроверяется всё.
+        Если такой же расчёт уже идёт, ждём его и возвращаем его результат.
+        """
+        if self._watch is not None:
+            self.__catch_up(self._watch.changes())
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                previous = self._snapshots.get(key)
+                # События, пришедшие во время расчёта, попадут в новый набор и учтутся в следующий раз
+                stale = self._stale.pop(key, set())
+
+        if not leader:
+            CACHE_REQUESTS.inc(cache="report", result="shared")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.snapshot
+
+        unchanged = set()
+        if previous is not None and self.trust_webhooks:
+            unchanged = set(previous) - stale
+
+        CACHE_REQUESTS.inc(cache="report", result="miss" if previous is None else "stale")
+        try:
+            flight.snapshot = revalidate(previous, unchanged)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.error is not None:
+                    self._stale.setdefault(key, set()).update(stale)
+                else:
+                    self.__store(key, flight.snapshot)
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.snapshot
+
+    def __catch_up(self, kinds):
+        """Учитывает события, принятые другими воркерами: kinds - виды событий со сменившимся поколением"""
+        if "products" in kinds:
+            self.invalidate()
+        elif "documents" in kinds:
+            with self._lock:
+                for key, snapshot in self._snapshots.items():
+                    self._stale.setdefault(key, set()).update(snapshot)
+
+    def acknowledge(self, old, new):
+        """Событие, сменившее поколение old на new, уже учтено точечно (принято этим воркером)"""
+        if self._watch is not None:
+            self._watch.acknowledge(old, new)
+
+    def __store(self, key, snapshot):
+        """Сохраняет снимок и вытесняет старые сверх пределов; вызывается под self._lock"""
+        self.__drop(key)
+
+        size = snapshot_positions(snapshot)
+        if size > self.max_positions:
+            logger.info(f"Снимок {key} не кэшируется: {size} позиций больше предела {self.max_positions}")
+            return
+
+        self._snapshots[key] = snapshot
+        self._sizes[key] = size
+        self._positions += size
+
+        while len(self._snapshots) > self.max_entries or self._positions > self.max_positions:
+            self.__drop(next(iter(self._snapshots)))
+
+    def __drop(self, key):
+        if self._snapshots.pop(key, None) is not None:
+            self._positions -= self._sizes.pop(key)
+
+    def mark_stale(self, group, periods=None, documents=None):
+        """
+        Помечает группу документов устаревшей в затронутых снимках.
+        periods(проект, начало, конец) - периоды, в которые мог попасть документ (новый или перенесённый):
+        группа перепроверяется, появившиеся документы догрузятся.
+        documents(документ снимка) - документы, которые нужно загрузить заново, даже если updated не изменился
+        (например, после изменения карточки товара). Возвращает число затронутых снимков.
+        """
+        affected = 0
+        with self._lock:
+            for key, snapshot in self._snapshots.items():
+                hit = periods is not None and periods(key[0], datetime.fromisoformat(key[1]),
+                                                      datetime.fromisoformat(key[2]))
+
+                if documents is not None and group in snapshot:
+                    cached = snapshot[group]
+                    # updated = None - при перепроверке документ будет загружен заново
+                    marked = [document[:2] + (None,) + document[3:] if documents(document) else document
+                              for document in cached]
+                    if any(a is not b for a, b in zip(marked, cached)):
+                        snapshot[group] = marked
+                        hit = True
+
+                if hit:
+                    self._stale.setdefault(key, set()).add(group)
+                    affected += 1
+
+        return affected
+
+    def periods_with(self, group, href=None, documents=None):
+        """
+        Периоды снимков, в группе которых есть документ href (или документ, для которого documents(документ) - True):
+        {(id проекта, начало, конец)}
+        """
+        matches = documents or (lambda document: document[1] == href)
+        with self._lock:
+            return {
+                (key[0].rsplit("/", 1)[-1], datetime.fromisoformat(key[1]), datetime.fromisoformat(key[2]))
+                for key, snapshot in self._snapshots.items()
+                if any(matches(document) for document in snapshot.get(group, ()))
+            }
+
+    def invalidate(self, project=None):
+        """Сбрасывает снимки проекта (по умолчанию - все)"""
+        with self._lock:
+            for key in [key for key in self._snapshots if project is None or key[0] == project]:
+                self.__drop(key)
+                self._stale.pop(key, None)
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def get_report_cache():
+    """Общий на процесс кэш данных отчётов"""
+    global _shared_cache
+
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = ReportCache(generation=get_cache_generation())
+
+    return _shared_cache
@@ -1,7 +1,24 @@
-from requests import Session
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import chain
+from operator import itemgetter
+import heapq
+import math
+import threading
 import time
+import uuid
 from app.excel_filler import fill_excel_report
+from app.excel_writer import write_excel_report, get_template_layout, TEMPLATE_PATH
+from app.flat_writer import write_flat_report, REPORT_FORMATS
+from app.assortment_cache import get_assortment_cache
+from app.commission_index import get_commission_index
+from app.replica import get_replica, ENTITY_POSITIONS
+from app.report_cache import get_report_cache, REPORT_CACHE_ENABLED
+from app.ms_client import (get_ms_client, get_json, with_params, meta_href, iter_pages, inline_rows, resolve_blocks,
+                           MS_API_URL)
+from app.positions import Position, ChainedSequence, aggregate_by_article, summarize_positions, intern_text
+from app.metrics import REPORTS, REPORT_SECONDS, REPORT_PHASE_SECONDS, ROWS_WRITTEN, CACHE_REQUESTS
 from app.logger import setup_logger
 import os
 
@@ -17,20 +34,99 @@ MAP_PROJECT_AGENT = {
         "https://api.moysklad.ru/api/remap/1.2/entity/counterparty/c15d626b-1189-11f1-0a80-0338004494a9" # YANDEX
 }
 
+# Мой склад допускает не более 5 параллельных запросов с одного аккаунта
+MAX_PARALLEL_REQUESTS = 5
+
+# Выбирать отчёты комиссионера через локальный индекс периодов (иначе - фильтром периода в запросе к МС)
+COMMISSION_INDEX_ENABLED = os.environ.get("COMMISSION_INDEX_ENABLED", "1") == "1"
+
+# Длинные периоды делятся на подпериоды примерно по столько документов, подпериоды загружаются параллельно
+REPORT_RANGE_DOCUMENTS = int(os.environ.get("REPORT_RANGE_DOCUMENTS", 500))
+# Самый короткий подпериод, дни
+REPORT_RANGE_MIN_DAYS = float(os.environ.get("REPORT_RANGE_MIN_DAYS", 1))
+
+# Формат даты в фильтре МС
+MS_MOMENT_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Конвейер отчёта: collect - данные собираются целиком, затем пишутся в Excel;
+# stream - страницы из МС сразу уходят в потоковую запись xlsx, память не растёт с числом позиций
+REPORT_PIPELINE = os.environ.get("REPORT_PIPELINE", "collect")
+
+# Источник данных отчёта: api - запросы в МС, replica - локальная реплика документов (app/replica.py)
+REPORT_SOURCE = os.environ.get("REPORT_SOURCE", "api")
+
+# Движок записи Excel: stream - потоковая запись за один проход, openpyxl - вставка строк в шаблон
+EXCEL_ENGINE = os.environ.get("EXCEL_ENGINE", "stream")
+
+# Группы позиций отчёта: отгрузки (секция A), продажи и возвраты по отчётам комиссионера, возвраты покупателей (секция B)
+SECTION_NAMES = ("demand", "commission", "commission_return", "customer_return")
+
+# Сколько карточек запрашивать одним запросом filter=id=...;id=...
+ASSORTMENT_BATCH_SIZE = 100
+
+
+def split_period(from_date, to_date, parts):
+    """
+    Делит [from_date, to_date] на parts подпериодов одинаковой длины (с точностью до секунды).
+    Соседние подпериоды делят границу, документы на ней отсеиваются при слиянии.
+    """
+    step = (to_date - from_date) / max(1, parts)
+    bounds = [(from_date + step * i).replace(microsecond=0) for i in range(parts)] + [to_date]
+
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
 
 class ReportGenerator:
-    def __init__(self, token):
+    def __init__(self, token, concurrent=True, max_workers=MAX_PARALLEL_REQUESTS, assortment_cache=None,
+                 commission_index=None, use_commission_index=COMMISSION_INDEX_ENABLED, progress_callback=None,
+                 api_url=MS_API_URL, client=None, replica=None, use_replica=REPORT_SOURCE == "replica",
+                 pipeline=REPORT_PIPELINE, assortment=None, assortment_lock=None, result_cache=None,
+                 use_result_cache=REPORT_CACHE_ENABLED):
         self.token = token
-        self.base_url_demand = "https://api.moysklad.ru/api/remap/1.2/entity/demand"
-        self.base_url_comission_report = "https://api.moysklad.ru/api/remap/1.2/entity/comission_report"
-        self.base_url_refound = "https://api.moysklad.ru/api/remap/1.2/entity/salesreturn"
-
-        self.session = Session()
+        # progress_callback(этап, загружено документов) - для отображения прогресса задания
+        self.progress_callback = progress_callback
+        self.documents_fetched = 0
+        self._progress_lock = threading.Lock()
+        # Кэш карточек товаров, общий для всех отчётов процесса
+        self.assortment_cache = assortment_cache or get_assortment_cache()
+        # Карточки, уже использованные в этом отчёте: href -> (артикул, наименование).
+        # Пакет отчётов по нескольким проектам передаёт общий справочник и его блокировку
+        self.assortment = assortment if assortment is not None else dict()
+        # Подпериоды загружаются параллельно, одни и те же карточки не запрашиваем дважды
+        self._assortment_lock = assortment_lock or threading.Lock()
+        # Индекс заголовков отчётов комиссионера по периодам
+        self.commission_index = None
+        if use_commission_index:
+            self.commission_index = commission_index or get_commission_index()
+        # Реплика документов: если задана, секции строятся из неё, без запросов в МС
+        self.replica = None
+        if use_replica:
+            self.replica = replica or get_replica()
+        # collect или stream (см. REPORT_PIPELINE)
+        self.pipeline = pipeline
+        # Кэш данных отчётов по (проект, период): повторный отчёт догружает только изменённые документы
+        self.result_cache = None
+        # Потоковый конвейер держит память постоянной - снимки с позициями для него не собираются
+        if use_result_cache and pipeline != "stream":
+            self.result_cache = result_cache or get_report_cache()
+        # Параллельная загрузка позиций документов (ограничена лимитом МС)
+        self.concurrent = concurrent
+        self.max_workers = max(1, min(max_workers, MAX_PARALLEL_REQUESTS))
+        self.api_url = api_url
+        self.base_url_demand = f"{api_url}/entity/demand"
+        self.base_url_comission_report = f"{api_url}/entity/commissionreportin"
+        self.base_url_refound = f"{api_url}/entity/salesreturn"
+
+        # Общий на процесс клиент МС: пул соединений и регулятор лимитов (лимит считается на аккаунт, а не на отчёт)
+        self.client = client or get_ms_client()
 
         self.url_filtered_demands = ""
         self.url_comission_report = ""
         self.url_filtered_refounds = ""
 
+        self.project_url = None
+        self.agent_url = None
+
         self.headers = {
             "Authorization": f"Bearer {self.token}",
         }
@@ -48,223 +144,736 @@ class ReportGenerator:
         self.curr_from_date = ""
         self.curr_to_date = ""
 
+        # Длительность этапов формирования отчёта в секундах
+        self.timings = dict()
+        # Сколько строк записано в секции A-D
+        self.rows_written = dict()
+
     def set_urls(self, project=None, from_date=None, to_date=None):
         agent_url = MAP_PROJECT_AGENT.get(project)
+        self.project_url = project
         # Устанавливаем урл для всех получения всех отгрузок
-        self.url_filtered_demands = self.base_url_demand + "?filter=project=" + project + \
-        ";moment>=" + from_date + ";moment<=" + to_date + "&order=name,desc"
+        self.url_filtered_demands = self.__period_url(self.base_url_demand, from_date, to_date)
 
-        # Устанавливаем урл для получения отчётов
-        self.url_comission_report = \
-            f"https://api.moysklad.ru/api/remap/1.2/entity/commissionreportin?filter=agent={agent_url}&order=name,desc"
+        # Устанавливаем урл для получения отчётов, пересечение с периодом фильтруем на стороне МС
+        self.agent_url = agent_url
+        self.url_comission_report = self.base_url_comission_report + f"?filter=agent={agent_url}" + \
+            f";commissionPeriodEnd>={from_date};commissionPeriodStart<={to_date}&order=name,desc"
 
         # Устанавливаем урл для получения возвратов покупателей
-        self.url_filtered_refounds = self.base_url_refound + "?filter=project=" + project + \
-        ";moment>=" + from_date + ";moment<=" + to_date + "&order=name,desc"
+        self.url_filtered_refounds = self.__period_url(self.base_url_refound, from_date, to_date)
 
         # Устанавливаем даты
         self.curr_from_date = datetime.fromisoformat(from_date)
         self.curr_to_date = datetime.fromisoformat(to_date)
 
-    def __make_request(self, method, url, headers, body=None):
-        r = self.session.request(method=method, url=url, headers=headers, data=body)
+    def __period_url(self, base_url, from_date, to_date, updated_from=None):
+        # updated_from - только документы, изменённые с этого момента (догрузка в кэш отчётов)
+        updated = f";updated>={updated_from}" if updated_from else ""
+        return base_url + "?filter=project=" + self.project_url + \
+            ";moment>=" + from_date + ";moment<=" + to_date + updated + "&order=name,desc"
+
+    def __iter_pages(self, url, expand=None):
+        return iter_pages(self.client, url, self.headers, expand=expand)
+
+    def __get_positions(self, url):
+        if url is None:
+            return []
+
+        positions = []
+        for rows in self.__iter_pages(url):
+            positions.extend(rows)
+
+        return positions
+
+    def __resolve_positions(self, blocks):
+        """
+        Возвращает строки позиций для списка полей документов (positions / returnToCommissionerPositions).
+        Если позиции пришли в документе целиком через expand - берём их оттуда,
+        иначе догружаем по ссылке.
+        """
+        return resolve_blocks(blocks, self.__get_positions, self.max_workers if self.concurrent else 1)
+
+    def __get_entities(self, url):
+        entities = []
+        for rows in self.__iter_pages(url):
+            entities.extend(rows)
+
+        return entities
+
+    def __load_assortment(self, positions_lists):
+        """
+        Подгружает карточки товаров для позиций: сначала из кэша,
+        неизвестные и устаревшие - из МС пачками по типу сущности.
+        """
+        with self._assortment_lock:
+            self.__load_missing_assortment(positions_lists)
+
+    def __load_missing_assortment(self, positions_lists):
+        hrefs = set()
+        for rows in positions_lists:
+            for row in rows:
+                href = meta_href(row.get("assortment"))
+                if href and href not in self.assortment:
+                    hrefs.add(href)
+
+        if not hrefs:
+            return
+
+        cached = self.assortment_cache.get_many(hrefs)
+        for href, (article, name) in cached.items():
+            self.assortment[href] = (intern_text(article), intern_text(name))
+        missing = [href for href in hrefs if href not in self.assortment]
+
+        CACHE_REQUESTS.inc(len(cached), cache="assortment", result="hit")
+        CACHE_REQUESTS.inc(len(missing), cache="assortment", result="miss")
+        if not missing:
+            return
+
+        # Группируем по коллекции: .../entity/product, .../entity/variant и т.д.
+        by_collection = dict()
+        for href in missing:
+            collection, entity_id = href.rsplit("/", 1)
+            by_collection.setdefault(collection, []).append(entity_id)
+
+        urls = list()
+        for collection, ids in by_collection.items():
+            for i in range(0, len(ids), ASSORTMENT_BATCH_SIZE):
+                batch = ids[i:i + ASSORTMENT_BATCH_SIZE]
+                urls.append(collection + "?filter=" + ";".join("id=" + entity_id for entity_id in batch))
+
+        if self.concurrent and len(urls) > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                batches = list(executor.map(self.__get_entities, urls))
+        else:
+            batches = [self.__get_entities(url) for url in urls]
+
+        cards = dict()
+        for entities in batches:
+            for entity in entities:
+                cards[meta_href(entity)] = (intern_text(entity.get("article")), intern_text(entity.get("name")))
+
+        # То, что не вернулось фильтром, запрашиваем поштучно
+        for href in missing:
+            if href not in cards:
+                entity = get_json(self.client, href, self.headers)
+                cards[href] = (intern_text(entity.get("article")), intern_text(entity.get("name")))
+
+        self.assortment_cache.put_many(cards)
+        self.assortment.update(cards)
+
+    def __assortment_card(self, assortment):
+        # Позиция пришла с развёрнутой карточкой
+        if "name" in assortment:
+            return intern_text(assortment.get("article")), intern_text(assortment.get("name"))
+
+        return self.assortment.get(meta_href(assortment), (None, None))
+
+    def __report_progress(self, stage, documents):
+        # Подпериоды загружаются параллельно
+        with self._progress_lock:
+            self.documents_fetched += documents
+            fetched = self.documents_fetched
+
+        if self.progress_callback:
+            self.progress_callback(stage, fetched)
+
+    def __plan_ranges(self, base_url):
+        """
+        Подпериоды загрузки документов. Число документов за весь период узнаём одним запросом с limit=1,
+        период делим так, чтобы на подпериод приходилось около REPORT_RANGE_DOCUMENTS документов.
+        """
+        from_date, to_date = self.curr_from_date, self.curr_to_date
+        min_range = timedelta(days=REPORT_RANGE_MIN_DAYS)
+
+        if not self.concurrent or to_date - from_date < 2 * min_range:
+            return [(from_date, to_date)]
+
+        url = self.__period_url(base_url, from_date.strftime(MS_MOMENT_FORMAT), to_date.strftime(MS_MOMENT_FORMAT))
+        page = get_json(self.client, with_params(url, limit=1), self.headers)
+        size = page.get("meta", {}).get("size") or 0
+
+        parts = min(math.ceil(size / REPORT_RANGE_DOCUMENTS), int((to_date - from_date) / min_range))
+        if parts <= 1:
+            return [(from_date, to_date)]
+
+        logger.info(f"Период {from_date} - {to_date} ({size} документов) загружается частями: {parts}")
+        return split_period(from_date, to_date, parts)
+
+    def __range_documents(self, url, stage, is_refound=False, nsp=False):
+        """Документы подпериода в порядке МС (name,desc) по мере загрузки страниц: (номер, href, updated, позиции)"""
+        # Постранично получаем документы сразу с позициями
+        for page in self.__iter_pages(url, expand="positions"):
+            # Если позиции отсутствуют, документ пропускаем
+            rows = [row for row in page if row.get("positions")]
+
+            # Позиции, не поместившиеся в документ, догружаем
+            all_positions = self.__resolve_positions([row.get("positions") for row in rows])
+            self.__load_assortment(all_positions)
+
+            self.__report_progress(stage, len(page))
+
+            for row, rows_positions in zip(rows, all_positions):
+                positions = list()
+                self.__fill_local_positions(positions, rows_positions, is_refound=is_refound, nsp=nsp)
+                yield row.get("name"), meta_href(row), row.get("updated"), positions
+
+    def __fetch_documents(self, base_url, period_url, stage, is_refound=False, nsp=False):
+        """
+        Документы проекта за период: подпериоды загружаются параллельно и сливаются в общий порядок name,desc,
+        документы с границ подпериодов (попавшие в оба) берутся один раз.
+        """
+        ranges = self.__plan_ranges(base_url)
+
+        if len(ranges) == 1:
+            parts = [self.__range_documents(period_url, stage, is_refound, nsp)]
+        else:
+            urls = [
+                self.__period_url(base_url, from_date.strftime(MS_MOMENT_FORMAT), to_date.strftime(MS_MOMENT_FORMAT))
+                for from_date, to_date in ranges
+            ]
+
+            with ThreadPoolExecutor(max_workers=min(len(urls), self.max_workers)) as executor:
+                parts = list(executor.map(lambda url: list(self.__range_documents(url, stage, is_refound, nsp)), urls))
+
+        seen = set()
+        for document in heapq.merge(*parts, key=itemgetter(0), reverse=True):
+            if document[1] in seen:
+                continue
+            seen.add(document[1])
 
-        return r.json()
+            yield document
 
     def get_demands(self):
-        # Запрос в мой склад, получить все
-        all_demands = self.__make_request(method="GET", url=self.url_filtered_demands, headers=self.headers)
+        if self.replica is not None:
+            self.__fill_from_replica("demand", "Отгрузка № ", "Отгрузки",
+                                     self.current_demand_numbers, self.current_positions_in_demands)
+            logger.info("DEMANDS TRUE")
+            return
 
-        # Идём по каждой отгрузке
-        for row in all_demands.get("rows"):
-            positions_url = row.get("positions").get("meta").get("href") if row.get("positions") else None
+        for name, href, updated, positions in self.__fetch_documents(self.base_url_demand, self.url_filtered_demands,
+                                                                     "Отгрузки"):
+            self.current_demand_numbers.append("Отгрузка № " + name)
+            self.current_positions_in_demands.extend(positions)
 
-            # Если позиции отсутствуют, переходим к следующему документу
-            if positions_url is None:
-                continue
+        logger.info("DEMANDS TRUE")
 
-            self.current_demand_numbers.append("Отгрузка № " + row.get("name"))
+    def __sync_commission_index(self):
+        """Догружает в индекс отчёты комиссионера, изменённые после последней синхронизации"""
+        url = self.base_url_comission_report + f"?filter=agent={self.agent_url}"
 
-            # Запрашиваем позиции документа
-            demands_positions = self.__make_request(method="GET", url=positions_url + "?expand=assortment", headers=self.headers)
+        watermark = self.commission_index.watermark(self.agent_url)
+        if watermark:
+            # Фильтр МС принимает время с точностью до секунды
+            url += f";updated>={watermark[:19]}"
 
-            self.__fill_local_positions(
-                self.current_positions_in_demands,
-                demands_positions.get("rows")
-            )
+        for page in self.__iter_pages(url + "&order=updated"):
+            self.commission_index.update(self.agent_url, page)
 
-        logger.info("DEMANDS TRUE")
+    def __candidate_comission_reports(self):
+        if self.commission_index is None:
+            for page in self.__iter_pages(self.url_comission_report):
+                yield from page
+            return
 
-    def get_comission_reports(self):
-        all_comission_reports = self.__make_request(method="GET", url=self.url_comission_report, headers=self.headers)
+        # Проект без сопоставленного контрагента - отчётов комиссионера нет
+        if self.agent_url is None:
+            return
 
-        target_report_list = list()
+        self.__sync_commission_index()
+        yield from self.commission_index.overlapping(self.agent_url, self.curr_from_date, self.curr_to_date)
 
-        # Выбираем отчёты комиссионера подходящие под период
-        if all_comission_reports.get("rows"):
-            for report in all_comission_reports.get("rows"):
-                start = report.get("commissionPeriodStart")
-                end = report.get("commissionPeriodEnd")
+    def get_comission_reports(self):
+        if self.replica is not None:
+            self.__comission_from_replica()
+            logger.info("COMMISSION TRUE")
+            return
 
-                if start:
-                    start = datetime.fromisoformat(start.replace(" ", "T"))
+        target_report_list = self.__target_comission_reports()
 
-                if end:
-                    end = datetime.fromisoformat(end.replace(" ", "T"))
+        for name, href, updated, positions, refounds in self.__comission_documents(target_report_list):
+            # Записываем номера документов
+            if not refounds and not positions:
+                continue
+            self.current_comission_numbers.append("Отчёт комиссионера № " + name)
 
-                # Захватываем периоды в отчёте комиссионера
-                if start and end:
-                    if end >= self.curr_from_date and start <= self.curr_to_date:
-                        target_report_list.append(report)
+            # Сначала проданные позиции, потом возвраты в отчёте комиссионера
+            self.current_positions_in_comission.extend(positions)
+            self.current_refounds_in_comission.extend(refounds)
 
         if target_report_list:
-            for report in target_report_list:
-
-                # Инициализируем переменные
-                positions = dict()
-                refounds = dict()
-
-                # Получили проданные позиции из отчёта комиссионера
-                url_positions = report.get('positions').get("meta").get("href")
-                if url_positions:
-                    positions = self.__make_request(
-                        method="GET",
-                        url=url_positions + "?expand=assortment",
-                        headers=self.headers,
-                    )
-                # Получили возвращённые позиции из отчёта комиссионера
-                url_refounds = report.get('returnToCommissionerPositions').get("meta").get("href")
-                if url_refounds:
-                    refounds = self.__make_request(
-                        method="GET",
-                        url=url_refounds + "?expand=assortment",
-                        headers=self.headers
-                    )
-                # Записываем номера документов
-                if refounds.get("rows") or positions.get("rows"):
-                    self.current_comission_numbers.append("Отчёт комиссионера № " + report.get("name"))
-                else:
-                    continue
-
-                # Сначала идём по проданным позициям
-                self.__fill_local_positions(
-                    self.current_positions_in_comission,
-                    positions.get("rows")
-                )
-
-                # Потом по возвратам в отчёте комиссионера
-                self.__fill_local_positions(
-                    self.current_refounds_in_comission,
-                    refounds.get("rows"),
-                    is_refound=True
-                )
+            self.__report_progress("Отчёты комиссионера", len(target_report_list))
 
         logger.info("COMMISSION TRUE")
 
-    def get_refounds(self):
-        # Запрос в мой склад, получить все
-        all_demands = self.__make_request(
-            method="GET",
-            url=self.url_filtered_refounds,
-            headers=self.headers)
-
-        # Идём по каждой отгрузке
-        for row in all_demands.get("rows"):
-            positions_url = row.get("positions").get("meta").get("href") if row.get("positions") else None
-
-            # Если позиции отсутствуют, переходим к следующему документу
-            if positions_url is None:
+    def __comission_documents(self, reports):
+        """Позиции отчётов комиссионера: (номер, href, updated, проданные позиции, возвраты) в порядке reports"""
+        if not reports:
+            return []
+
+        # Для каждого отчёта два блока: проданные позиции и возвраты
+        blocks = list()
+        for report in reports:
+            blocks.append(report.get('positions'))
+            blocks.append(report.get('returnToCommissionerPositions'))
+
+        all_positions = self.__resolve_positions(blocks)
+        self.__load_assortment(all_positions)
+
+        documents = list()
+        for i, report in enumerate(reports):
+            positions = list()
+            refounds = list()
+            self.__fill_local_positions(positions, all_positions[2 * i])
+            self.__fill_local_positions(refounds, all_positions[2 * i + 1], is_refound=True)
+
+            documents.append((report.get("name"), meta_href(report), report.get("updated"), positions, refounds))
+
+        return documents
+
+    def __load_from_cache(self):
+        """
+        Данные отчёта через кэш: первый отчёт за проект и период загружается целиком,
+        повторный - только документы, изменённые (updated) после прошлого раза, остальные берутся из кэша
+        """
+        key = (self.project_url, self.curr_from_date.isoformat(), self.curr_to_date.isoformat())
+        snapshot = self.result_cache.load(key, self.__revalidate)
+
+        for name, href, updated, positions in snapshot["demand"]:
+            self.current_demand_numbers.append("Отгрузка № " + name)
+            self.current_positions_in_demands.extend(positions)
+
+        for name, href, updated, positions, refounds in snapshot["commissionreportin"]:
+            if not refounds and not positions:
                 continue
+            self.current_comission_numbers.append("Отчёт комиссионера № " + name)
+            self.current_positions_in_comission.extend(positions)
+            self.current_refounds_in_comission.extend(refounds)
+
+        for name, href, updated, positions in snapshot["salesreturn"]:
+            self.current_refound_numbers.append("Возврат покупателя № " + name)
+            self.current_positions_in_refounds.extend(positions)
+
+    def __revalidate(self, previous, unchanged):
+        """unchanged - группы, по которым не было событий вебхуков: берутся из кэша без запросов в МС"""
+        previous = previous or dict()
+        snapshot = {group: previous[group] for group in unchanged}
+
+        if "demand" not in snapshot:
+            snapshot["demand"] = self.__revalidate_documents(self.base_url_demand, self.url_filtered_demands,
+                                                             "Отгрузки", previous.get("demand"))
+        if "commissionreportin" not in snapshot:
+            snapshot["commissionreportin"] = self.__revalidate_comission(previous.get("commissionreportin"))
+        if "salesreturn" not in snapshot:
+            snapshot["salesreturn"] = self.__revalidate_documents(self.base_url_refound, self.url_filtered_refounds,
+                                                                  "Возвраты покупателей", previous.get("salesreturn"),
+                                                                  is_refound=True, nsp=True)
+
+        return snapshot
+
+    def __revalidate_documents(self, base_url, period_url, stage, cached, is_refound=False, nsp=False):
+        if cached is None:
+            return list(self.__fetch_documents(base_url, period_url, stage, is_refound, nsp))
+
+        # Список документов периода без позиций: страница до 1000 документов
+        current = list()
+        for page in self.__iter_pages(period_url):
+            current.extend((row.get("name"), meta_href(row), row.get("updated")) for row in page)
+            self.__report_progress(stage, len(page))
+
+        cached_by_href = {document[1]: document for document in cached}
+        changed = {href: updated for name, href, updated in current
+                   if href not in cached_by_href or cached_by_href[href][2] != updated}
+
+        # Изменённые и новые документы - одним запросом периода с фильтром по updated (МС принимает секунды)
+        fresh = dict()
+        if changed:
+            updated_from = min(changed.values())[:19]
+            url = self.__period_url(base_url, self.curr_from_date.strftime(MS_MOMENT_FORMAT),
+                                    self.curr_to_date.strftime(MS_MOMENT_FORMAT), updated_from=updated_from)
+            for document in self.__range_documents(url, stage, is_refound, nsp):
+                if document[1] in changed:
+                    fresh[document[1]] = document
+
+        documents = [fresh.get(href) or cached_by_href.get(href) for name, href, updated in current]
+        documents = [document for document in documents if document is not None]
+
+        CACHE_REQUESTS.inc(len(documents) - len(fresh), cache="report_documents", result="hit")
+        CACHE_REQUESTS.inc(len(fresh), cache="report_documents", result="miss")
+        logger.info(f"{stage}: из кэша {len(documents) - len(fresh)}, догружено {len(fresh)}, "
+                    f"удалено {len(set(cached_by_href) - {href for name, href, updated in current})}")
+
+        return documents
+
+    def __revalidate_comission(self, cached):
+        # Заголовки отчётов комиссионера приходят с updated (из индекса или запросом в МС)
+        reports = self.__target_comission_reports()
+        self.__report_progress("Отчёты комиссионера", len(reports))
+
+        cached_by_href = {document[1]: document for document in cached or ()}
+        changed = [report for report in reports
+                   if cached_by_href.get(meta_href(report), (None, None, None))[2] != report.get("updated")]
+        fresh = {document[1]: document for document in self.__comission_documents(changed)}
+
+        return [fresh.get(meta_href(report)) or cached_by_href[meta_href(report)] for report in reports]
+
+    def __stream_documents(self, period_url, stage, numbers, number_prefix, is_refound=False, nsp=False):
+        """Позиции документов периода по мере загрузки страниц; номера документов копятся в numbers"""
+        for name, href, updated, positions in self.__range_documents(period_url, stage, is_refound, nsp):
+            numbers.append(number_prefix + name)
+            yield from positions
+
+    def __iter_block(self, block):
+        """Строки блока позиций документа: из самого документа, если пришли целиком, иначе постранично по ссылке"""
+        rows = inline_rows(block)
+        if rows is not None:
+            yield rows
+        elif meta_href(block):
+            yield from self.__iter_pages(meta_href(block))
+
+    def __stream_comission_positions(self, reports, field, is_refound=False):
+        for report in reports:
+            for rows in self.__iter_block(report.get(field)):
+                self.__load_assortment([rows])
+
+                positions = list()
+                self.__fill_local_positions(positions, rows, is_refound=is_refound)
+                yield from positions
+
+    def __existing_comission_reports(self, reports):
+        """
+        Заголовки из индекса сверяются со списком отчётов периода в МС (без позиций): удалённые после индексации
+        отчёты выбрасываются и из выборки, и из индекса. Без индекса заголовки уже из МС.
+        Индекс чистится только по списку, все страницы которого получены: ошибка МС (MoySkladError)
+        прерывает отчёт и не трогает индекс - водяной знак updated не вернул бы удалённые по ошибке записи.
+        """
+        if self.commission_index is None or not reports:
+            return reports
+
+        existing = {meta_href(row) for page in self.__iter_pages(self.url_comission_report) for row in page}
+
+        removed = [meta_href(report) for report in reports if meta_href(report) not in existing]
+        if removed:
+            self.commission_index.remove(removed)
+            logger.info(f"Отчёты комиссионера удалены в МС и убраны из индекса: {len(removed)}")
+
+        return [report for report in reports if meta_href(report) in existing]
+
+    def __stream_comission(self):
+        """
+        Генераторы позиций отчётов комиссионера для секции B: проданные по всем отчётам и возвраты.
+        Отчёты выбираются сразу, пустые (по размеру блоков в заголовке) пропускаются.
+        """
+        reports = list()
+        for report in self.__target_comission_reports():
+            sizes = [(report.get(field) or {}).get("meta", {}).get("size")
+                     for field in ("positions", "returnToCommissionerPositions")]
+            if any(size is None or size > 0 for size in sizes):
+                reports.append(report)
+                self.current_comission_numbers.append("Отчёт комиссионера № " + report.get("name"))
+
+        self.__report_progress("Отчёты комиссионера", len(reports))
+
+        return (
+            self.__stream_comission_positions(reports, "positions"),
+            self.__stream_comission_positions(reports, "returnToCommissionerPositions", is_refound=True)
+        )
+
+    def __target_comission_reports(self):
+        target_report_list = list()
 
-            self.current_refound_numbers.append("Возврат покупателя № " + row.get("name"))
+        # Выбираем отчёты комиссионера подходящие под период
+        for report in self.__candidate_comission_reports():
+            start = report.get("commissionPeriodStart")
+            end = report.get("commissionPeriodEnd")
 
-            # Запрашиваем позиции документа
-            refounds_positions = self.__make_request(
-                method="GET",
-                url=positions_url + "?expand=assortment",
-                headers=self.headers)
+            if start:
+                start = datetime.fromisoformat(start.replace(" ", "T"))
 
-            self.__fill_local_positions(
-                self.current_positions_in_refounds,
-                refounds_positions.get("rows"),
-                is_refound=True,
-                nsp=True
-            )
+            if end:
+                end = datetime.fromisoformat(end.replace(" ", "T"))
+
+            # Захватываем периоды в отчёте комиссионера
+            if start and end:
+                if end >= self.curr_from_date and start <= self.curr_to_date:
+                    target_report_list.append(report)
+
+        # Оба конвейера и кэш отчётов получают одинаковый набор: без удалённых в МС отчётов
+        return self.__existing_comission_reports(target_report_list)
+
+    def get_refounds(self):
+        if self.replica is not None:
+            self.__fill_from_replica("salesreturn", "Возврат покупателя № ", "Возвраты покупателей",
+                                     self.current_refound_numbers, self.current_positions_in_refounds,
+                                     is_refound=True, nsp=True)
+            logger.info("REFOUNDS TRUE")
+            return
+
+        for name, href, updated, positions in self.__fetch_documents(self.base_url_refound, self.url_filtered_refounds,
+                                                                     "Возвраты покупателей", is_refound=True, nsp=True):
+            self.current_refound_numbers.append("Возврат покупателя № " + name)
+            self.current_positions_in_refounds.extend(positions)
 
         logger.info("REFOUNDS TRUE")
 
+    def __check_replica(self):
+        for entity in ENTITY_POSITIONS:
+            synced_at = self.replica.synced_at(entity)
+            if synced_at is None:
+                raise RuntimeError(f"Реплика документов ещё не синхронизирована ({entity}), отчёт из реплики невозможен")
+
+            logger.info(f"Реплика {entity} синхронизирована {int(time.time() - synced_at)} с назад")
+
+    def __fill_from_replica(self, entity, number_prefix, stage, numbers, container, is_refound=False, nsp=False):
+        documents = self.replica.documents(entity, self.project_url, self.curr_from_date, self.curr_to_date)
+        for name, positions in documents:
+            numbers.append(number_prefix + name)
+            self.__append_positions(container, positions.get("positions", []), is_refound, nsp)
+
+        self.__report_progress(stage, len(documents))
+
+    def __comission_from_replica(self):
+        # Проект без сопоставленного контрагента - отчётов комиссионера нет
+        if self.agent_url is None:
+            return
+
+        reports = self.replica.commission_reports(self.agent_url, self.curr_from_date, self.curr_to_date)
+        for name, positions in reports:
+            sold = positions.get("positions", [])
+            refounds = positions.get("returntocommissionerpositions", [])
+            if not sold and not refounds:
+                continue
+
+            self.current_comission_numbers.append("Отчёт комиссионера № " + name)
+            self.__append_positions(self.current_positions_in_comission, sold)
+            self.__append_positions(self.current_refounds_in_comission, refounds, is_refound=True)
+
+        self.__report_progress("Отчёты комиссионера", len(reports))
+
     def __fill_local_positions(self, container_positions, rows, is_refound=False, nsp=False):
-        for row in rows:
-            temp_position = dict()
-
-            if is_refound:
-                temp_position["art"] = row.get("assortment").get("article")
-                temp_position["name"] = row.get("assortment").get("name")
-                temp_position["price"] = -float(row.get("price")) / 100
-                temp_position["quantity"] = -float(row.get("quantity"))
-                if nsp:
-                    temp_position["NSP"] = "НСП"
+        self.__append_positions(
+            container_positions,
+            (self.__assortment_card(row.get("assortment")) + (row.get("price"), row.get("quantity")) for row in rows),
+            is_refound,
+            nsp
+        )
+
+    @staticmethod
+    def __append_positions(container_positions, rows, is_refound=False, nsp=False):
+        """rows - (артикул, наименование, цена в копейках, количество)"""
+        sign = -1 if is_refound else 1
+        nsp_mark = "НСП" if is_refound and nsp else None
+
+        for article, name, price, quantity in rows:
+            container_positions.append(Position(
+                art=intern_text(article),
+                name=intern_text(name),
+                price=sign * float(price) / 100,
+                quantity=sign * float(quantity),
+                nsp=nsp_mark
+            ))
+
+    @contextmanager
+    def __phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - started
+            REPORT_PHASE_SECONDS.observe(self.timings[name], phase=name)
+
+    def generate_report(self, project: str, aggregate=False, output=None, report_format="xlsx"):
+        """
+        Формирует отчёт и возвращает имя файла. По умолчанию файл пишется в app/temp,
+        если передан output (файловый объект) - книга пишется в него, на диск ничего не попадает.
+        report_format - xlsx (по шаблону), csv или jsonl (строки позиций без шаблона).
+        """
+        if report_format not in REPORT_FORMATS:
+            raise ValueError(f"Неизвестный формат отчёта: {report_format}")
+
+        started = time.perf_counter()
+        try:
+            filename = self.__build_report(project, aggregate, output, report_format)
+        except Exception:
+            REPORTS.inc(status="error")
+            raise
+
+        REPORTS.inc(status="ok")
+        REPORT_SECONDS.observe(time.perf_counter() - started)
+        return filename
+
+    def generate_summary(self):
+        """
+        Итоги по группам позиций и число документов, без записи файла.
+        Данные загружаются тем же путём, что и для отчёта (API или реплика, collect или stream).
+        """
+        streaming, groups = self.__load_sections()
+
+        with self.__phase("summary"):
+            sections = {name: summarize_positions(positions) for name, positions in zip(SECTION_NAMES, groups)}
+
+        return {
+            "sections": sections,
+            "documents": {
+                "demand": len(self.current_demand_numbers),
+                "commission": len(self.current_comission_numbers),
+                "customer_return": len(self.current_refound_numbers),
+            },
+            "timings": self.timings,
+        }
+
+    def __load_sections(self):
+        """
+        Группы позиций отчёта в порядке SECTION_NAMES: списками (collect, реплика)
+        или генераторами по мере загрузки страниц (stream)
+        """
+        if self.replica is not None:
+            self.__check_replica()
+
+        # Потоковый конвейер: позиции не копятся, а идут из МС прямо в запись xlsx
+        streaming = self.pipeline == "stream" and self.replica is None
+
+        if streaming:
+            demands = self.__stream_documents(self.url_filtered_demands, "Отгрузки",
+                                              self.current_demand_numbers, "Отгрузка № ")
+            comission, comission_refounds = self.__stream_comission()
+            refounds = self.__stream_documents(self.url_filtered_refounds, "Возвраты покупателей",
+                                               self.current_refound_numbers, "Возврат покупателя № ",
+                                               is_refound=True, nsp=True)
+        else:
+            if self.replica is None and self.result_cache is not None:
+                with self.__phase("cache"):
+                    self.__load_from_cache()
             else:
-                temp_position["art"] = row.get("assortment").get("article")
-                temp_position["name"] = row.get("assortment").get("name")
-                temp_position["price"] = float(row.get("price")) / 100
-                temp_position["quantity"] = float(row.get("quantity"))
+                with self.__phase("demands"):
+                    self.get_demands()
+                with self.__phase("commission"):
+                    self.get_comission_reports()
+                with self.__phase("refounds"):
+                    self.get_refounds()
+
+            self.__log_summary()
+
+            demands = self.current_positions_in_demands
+            comission = self.current_positions_in_comission
+            comission_refounds = self.current_refounds_in_comission
+            refounds = self.current_positions_in_refounds
+
+        return streaming, (demands, comission, comission_refounds, refounds)
+
+    def __build_report(self, project, aggregate, output=None, report_format="xlsx"):
+        streaming, (demands, comission, comission_refounds, refounds) = self.__load_sections()
+
+        # Свёртка по артикулу: одна строка на товар в каждой группе позиций
+        # (в потоковом режиме в памяти остаются только итоги по артикулам)
+        if aggregate:
+            with self.__phase("aggregate"):
+                demands = aggregate_by_article(demands)
+                comission = aggregate_by_article(comission)
+                comission_refounds = aggregate_by_article(comission_refounds)
+                refounds = aggregate_by_article(refounds)
+
+        # Метка времени для читаемости, uuid - чтобы отчёты, готовые в одну секунду, не перезаписали друг друга
+        timestamp = int(time.time())
+        filename = f"report_{timestamp}_{uuid.uuid4().hex}.{report_format}"
+
+        if output is None:
+            # --- Создаём папку temp, если её нет ---
+            base_dir = os.path.dirname(os.path.abspath(__file__))  # это app/
+            temp_dir = os.path.join(base_dir, "temp")
+            os.makedirs(temp_dir, exist_ok=True)
+
+            # Полный путь до отчёта
+            output = os.path.join(temp_dir, filename)
 
-            container_positions.append(temp_position)
+        if report_format == "xlsx":
+            rows = self.__write_excel(project, output, streaming, aggregate,
+                                      demands, comission, comission_refounds, refounds)
+        else:
+            rows = self.__write_flat(report_format, output, streaming,
+                                     demands, comission, comission_refounds, refounds)
 
-    def generate_report(self, project: str):
-        self.get_demands()
-        self.get_comission_reports()
-        self.get_refounds()
+        self.rows_written = rows
+        for section, count in rows.items():
+            ROWS_WRITTEN.inc(count, section=section)
 
-        logger.info("##############################################")
-        logger.info(f"DOC NUMBERS DEMANDS  {self.current_demand_numbers}")
-        logger.info(f"COUNT DOCS DEMANDS {len(self.current_demand_numbers)}")
-        logger.info(f"TOTAL DEMANDS POSITIONS {len(self.current_positions_in_demands)} \n\n")
+        if streaming:
+            self.__log_summary(rows)
 
-        logger.info(f"DOC NUMBERS COMISSION {self.current_comission_numbers}")
-        logger.info(f"COUNT DOCS COMISSIONS {len(self.current_comission_numbers)}")
-        logger.info(f"TOTAL COMISSION POSITIONS {len(self.current_positions_in_comission)}")
-        logger.info(f"TOTAL COMISSION REFOUNDS POSITIONS {len(self.current_refounds_in_comission)} \n\n")
+        return filename
 
-        logger.info(f"DOC NUMBERS REFOUNDS {self.current_refound_numbers}")
-        logger.info(f"COUNT DOCS REFOUNDS {len(self.current_refound_numbers)}")
-        logger.info(f"TOTAL REFOUNDS POSITIONS {len(self.current_positions_in_refounds)} \n\n")
+    def __write_excel(self, project, output, streaming, aggregate, demands, comission, comission_refounds, refounds):
+        # Строки начала секций берём из разобранного шаблона
+        anchors = get_template_layout(TEMPLATE_PATH).anchors
 
-        #max_height = max(len(self.current_positions_in_demands), len(self.current_refound_numbers))
+        if streaming and not aggregate:
+            data_b = chain(comission, comission_refounds, refounds)
+        else:
+            data_b = ChainedSequence(comission, comission_refounds, refounds)
 
         sections = {
-            'A': {'start_row': 5, 'data': self.current_positions_in_demands},  # колонки 1-4
-            'B': {
-                'start_row': 5,
-                'data': self.current_positions_in_comission +
-                        self.current_refounds_in_comission +
-                        self.current_positions_in_refounds
-            },  # колонки 5-8
-            'C': {'start_row': 8, 'data': self.current_demand_numbers},
-            'D': {'start_row': 10, 'data': self.current_comission_numbers + self.current_refound_numbers}
+            'A': {'start_row': anchors['A'], 'data': demands},  # колонки 1-4
+            'B': {'start_row': anchors['B'], 'data': data_b},  # колонки 5-8
+            'C': {'start_row': anchors['C'], 'data': self.current_demand_numbers},
+            'D': {'start_row': anchors['D'], 'data': ChainedSequence(self.current_comission_numbers, self.current_refound_numbers)}
         }
 
-        timestamp = int(time.time())
-        filename = f"report_{timestamp}.xlsx"
-
-        # --- Создаём папку temp, если её нет ---
-        base_dir = os.path.dirname(os.path.abspath(__file__))  # это app/
-        temp_dir = os.path.join(base_dir, "temp")
-        os.makedirs(temp_dir, exist_ok=True)
-
-        # Полный путь до отчёта
-        filepath = os.path.join(temp_dir, filename)
-
-        fill_excel_report(
-            template_path=os.path.join(base_dir, 'шаблон.xlsx'),
-            output_path=filepath,
-            sections=sections,
-            project_name=project,
-            from_date=self.curr_from_date,
-            to_date=self.curr_to_date
+        # Потоковому конвейеру нужен потоковый писатель: прежний вставляет строки в готовый лист
+        write_report = write_excel_report if EXCEL_ENGINE == "stream" or streaming else fill_excel_report
+        with self.__phase("stream" if streaming else "excel"):
+            rows = write_report(
+                template_path=TEMPLATE_PATH,
+                output_path=output,
+                sections=sections,
+                project_name=project,
+                from_date=self.curr_from_date,
+                to_date=self.curr_to_date
+            )
+
+        # Прежний писатель строки не считает
+        if rows is None:
+            rows = {section: len(content['data']) for section, content in sections.items()}
+
+        return rows
+
+    def __write_flat(self, report_format, output, streaming, demands, comission, comission_refounds, refounds):
+        """CSV/JSON Lines: те же группы позиций и номера документов, что и в секциях A-D книги"""
+        with self.__phase("stream" if streaming else report_format):
+            rows = write_flat_report(
+                report_format,
+                output,
+                positions=zip(SECTION_NAMES, (demands, comission, comission_refounds, refounds)),
+                documents=chain(self.current_demand_numbers, self.current_comission_numbers,
+                                self.current_refound_numbers)
+            )
+
+        # Счёт строк - по секциям книги, как у писателей Excel
+        return {
+            'A': rows["demand"],
+            'B': rows["commission"] + rows["commission_return"] + rows["customer_return"],
+            'C': len(self.current_demand_numbers),
+            'D': len(self.current_comission_numbers) + len(self.current_refound_numbers),
+        }
+
+    def __log_summary(self, rows=None):
+        if rows is None:
+            positions = (
+                f"отгрузок {len(self.current_demand_numbers)} (позиций {len(self.current_positions_in_demands)}), "
+                f"отчётов комиссионера {len(self.current_comission_numbers)} "
+                f"(позиций {len(self.current_positions_in_comission)}, возвратов {len(self.current_refounds_in_comission)}), "
+                f"возвратов покупателей {len(self.current_refound_numbers)} "
+                f"(позиций {len(self.current_positions_in_refounds)})"
+            )
+        else:
+            positions = (
+                f"отгрузок {len(self.current_demand_numbers)}, отчётов комиссионера {len(self.current_comission_numbers)}, "
+                f"возвратов покупателей {len(self.current_refound_numbers)}, строк A {rows['A']}, B {rows['B']}"
+            )
+
+        logger.info(
+            f"Данные отчёта загружены: {positions}, "
+            f"этапы, с: {', '.join(f'{name} {seconds:.2f}' for name, seconds in self.timings.items())}"
         )
-        return filename
 
 
 
@@ -0,0 +1,298 @@
+"""
+Хранилище готовых отчётов для /download_report: файл под уникальным id и метаданные (проект, период, размер).
+Отчёты живут REPORT_TTL секунд и скачиваются сколько угодно раз (в том числе докачкой по Range),
+фоновая уборка удаляет просроченные и самые старые отчёты сверх REPORT_STORE_MAX_MB.
+
+local - метаданные в памяти процесса: для одного процесса приложения.
+shared - метаданные в json рядом с файлом: для нескольких воркеров или контейнеров с общей папкой REPORT_STORE_DIR,
+скачивание может прийти на любой из них. Там же (в jobs/) хранятся статусы заданий на отчёты,
+чтобы опрос /jobs/<id> тоже мог прийти на любой воркер.
+"""
+import json
+import os
+from abc import ABC, abstractmethod
+import threading
+import time
+import uuid
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Хранилище отчётов: local или shared
+REPORT_STORE = os.environ.get("REPORT_STORE", "local")
+# Папка отчётов; для shared - общая для всех воркеров (том, NFS)
+REPORT_STORE_DIR = os.environ.get("REPORT_STORE_DIR", os.path.join(BASE_DIR, "temp"))
+# Сколько хранить отчёт, сек
+REPORT_TTL = int(os.environ.get("REPORT_TTL", 86400))
+# Предельный общий размер отчётов, МБ
+REPORT_STORE_MAX_MB = int(os.environ.get("REPORT_STORE_MAX_MB", 2048))
+# Как часто запускать уборку, сек
+REPORT_GC_INTERVAL = int(os.environ.get("REPORT_GC_INTERVAL", 300))
+
+METADATA_SUFFIX = ".json"
+TEMP_SUFFIX = ".tmp"
+# Подпапка статусов заданий в общем хранилище
+JOBS_DIR = "jobs"
+
+
+class ReportStore(ABC):
+    """
+    Общая часть хранилищ: файлы отчётов в папке, имя файла - {id}.{расширение}.
+    Где лежат метаданные, решают наследники (_put_metadata, _get_metadata, _delete_metadata, _all_metadata).
+    Файл пишется во временный и переименовывается, метаданные появляются после файла:
+    отчёт с метаданными всегда дописан целиком.
+    """
+
+    def __init__(self, directory=REPORT_STORE_DIR, ttl=REPORT_TTL, max_bytes=REPORT_STORE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, report_id, extension):
+        return os.path.join(self.directory, f"{report_id}.{extension}")
+
+    def save(self, write, extension, **metadata):
+        """
+        write(файловый объект) пишет отчёт и может вернуть имя файла для скачивания.
+        metadata - проект, период и прочее для статуса и уборки. Возвращает метаданные сохранённого отчёта с id.
+        """
+        report_id = uuid.uuid4().hex
+        path = self.path(report_id, extension)
+        temp_path = f"{path}{TEMP_SUFFIX}"
+
+        try:
+            with open(temp_path, "wb") as f:
+                filename = write(f)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        created_at = time.time()
+        metadata.update(
+            id=report_id,
+            extension=extension,
+            filename=filename or f"report_{int(created_at)}_{report_id}.{extension}",
+            size=os.path.getsize(path),
+            created_at=created_at,
+            expires_at=created_at + self.ttl,
+        )
+        self._put_metadata(metadata)
+
+        logger.info(f"Отчёт {report_id} сохранён: {metadata['filename']}, {metadata['size'] / 1024:.0f} КБ")
+        return metadata
+
+    def get(self, report_id):
+        """Метаданные и путь к файлу отчёта (metadata, path) или None, если отчёта нет или он просрочен"""
+        if not report_id.isalnum():
+            return None
+
+        metadata = self._get_metadata(report_id)
+        if metadata is None or metadata["expires_at"] <= time.time():
+            return None
+
+        path = self.path(report_id, metadata["extension"])
+        return (metadata, path) if os.path.exists(path) else None
+
+    def delete(self, report_id):
+        metadata = self._get_metadata(report_id)
+        self._delete_metadata(report_id)
+        if metadata is not None:
+            remove_quietly(self.path(report_id, metadata["extension"]))
+
+    def collect(self, now=None):
+        """
+        Уборка: просроченные отчёты, затем самые старые, пока общий размер больше max_bytes,
+        и файлы без метаданных (брошенные при сбое) старше ttl. Возвращает число удалённых отчётов.
+        """
+        now = now or time.time()
+        reports = sorted(self._all_metadata(), key=lambda metadata: metadata["created_at"])
+
+        removed = 0
+        total = sum(metadata["size"] for metadata in reports)
+        for metadata in reports:
+            if metadata["expires_at"] > now and total <= self.max_bytes:
+                continue
+            self.delete(metadata["id"])
+            total -= metadata["size"]
+            removed += 1
+
+        known = {f"{metadata['id']}.{metadata['extension']}" for metadata in reports}
+        orphans = 0
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename in known or filename.endswith(METADATA_SUFFIX) or not os.path.isfile(path):
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    remove_quietly(path)
+                    orphans += 1
+            except FileNotFoundError:
+                pass
+
+        if removed or orphans:
+            logger.info(f"Уборка отчётов: удалено {removed}, брошенных файлов {orphans}, "
+                        f"осталось {total / 1024 / 1024:.1f} МБ")
+        return removed
+
+    def start(self, interval=REPORT_GC_INTERVAL):
+        """Фоновая уборка раз в interval секунд"""
+        threading.Thread(target=self.__run, args=(interval,), daemon=True).start()
+
+    def __run(self, interval):
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                logger.exception(f"Не удалось убрать старые отчёты: {e}")
+            time.sleep(interval)
+
+    @abstractmethod
+    def _put_metadata(self, metadata):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _get_metadata(self, report_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _delete_metadata(self, report_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _all_metadata(self):
+        raise NotImplementedError
+
+
+class LocalReportStore(ReportStore):
+    """Метаданные в памяти: отчёт виден только процессу, который его построил; после перезапуска файлы убираются"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metadata = dict()
+        self._lock = threading.Lock()
+
+    def _put_metadata(self, metadata):
+        with self._lock:
+            self._metadata[metadata["id"]] = metadata
+
+    def _get_metadata(self, report_id):
+        with self._lock:
+            return self._metadata.get(report_id)
+
+    def _delete_metadata(self, report_id):
+        with self._lock:
+            self._metadata.pop(report_id, None)
+
+    def _all_metadata(self):
+        with self._lock:
+            return list(self._metadata.values())
+
+
+class SharedReportStore(ReportStore):
+    """
+    Метаданные в {id}.json рядом с файлом: отчёт видят все воркеры с той же папкой.
+    Уборку могут запускать несколько воркеров одновременно - уже удалённые файлы пропускаются.
+    """
+
+    def __metadata_path(self, report_id):
+        return os.path.join(self.directory, f"{report_id}{METADATA_SUFFIX}")
+
+    def _put_metadata(self, metadata):
+        write_json(self.__metadata_path(metadata["id"]), metadata)
+
+    def _get_metadata(self, report_id):
+        try:
+            with open(self.__metadata_path(report_id), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _delete_metadata(self, report_id):
+        remove_quietly(self.__metadata_path(report_id))
+
+    def _all_metadata(self):
+        reports = list()
+        for filename in os.listdir(self.directory):
+            if filename.endswith(METADATA_SUFFIX):
+                metadata = self._get_metadata(filename[:-len(METADATA_SUFFIX)])
+                if metadata is not None:
+                    reports.append(metadata)
+        return reports
+
+    def __job_path(self, job_id):
+        return os.path.join(self.directory, JOBS_DIR, f"{job_id}{METADATA_SUFFIX}")
+
+    def put_job(self, job):
+        """Сохраняет статус задания (словарь с id, см. Job.to_dict)"""
+        path = self.__job_path(job["id"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json(path, job)
+
+    def get_job(self, job_id):
+        """Статус задания или None"""
+        if not job_id.isalnum():
+            return None
+
+        try:
+            with open(self.__job_path(job_id), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def collect(self, now=None):
+        """Кроме отчётов, убирает статусы заданий старше ttl"""
+        removed = super().collect(now)
+
+        now = now or time.time()
+        directory = os.path.join(self.directory, JOBS_DIR)
+        if os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                path = os.path.join(directory, filename)
+                try:
+                    if now - os.path.getmtime(path) > self.ttl:
+                        remove_quietly(path)
+                except FileNotFoundError:
+                    pass
+
+        return removed
+
+
+def write_json(path, data):
+    """Пишет json во временный файл и переименовывает: читатель не увидит недописанный файл"""
+    temp_path = f"{path}.{uuid.uuid4().hex}{TEMP_SUFFIX}"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+REPORT_STORES = {
+    "local": LocalReportStore,
+    "shared": SharedReportStore,
+}
+
+_shared_store = None
+_shared_lock = threading.Lock()
+
+
+def get_report_store():
+    """Хранилище отчётов процесса по REPORT_STORE"""
+    global _shared_store
+
+    with _shared_lock:
+        if _shared_store is None:
+            if REPORT_STORE not in REPORT_STORES:
+                raise ValueError(f"Неизвестное хранилище отчётов: {REPORT_STORE}")
+            _shared_store = REPORT_STORES[REPORT_STORE]()
+
+    return _shared_store
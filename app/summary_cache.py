@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from app.cache_generation import GenerationWatch
+from app.metrics import CACHE_REQUESTS
+
+
+class SummaryCache:
+    """
+    Итоги отчётов в памяти процесса: ключ - (проект, начало, конец периода).
+    Запись живёт ttl секунд, при переполнении вытесняется самая давно запрошенная.
+    События документов и товаров, принятые другими воркерами (поколение generation), сбрасывают все итоги.
+    """
+
+    def __init__(self, ttl=300, max_entries=256, generation=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._watch = GenerationWatch(generation) if generation is not None else None
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if self._watch is not None and self._watch.changes() & {"documents", "products"}:
+            self.invalidate()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                CACHE_REQUESTS.inc(cache="summary", result="hit")
+                return entry[1]
+
+        CACHE_REQUESTS.inc(cache="summary", result="miss")
+        return None
+
+    def put(self, key, summary):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), summary)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, periods=None):
+        """
+        periods(проект, начало, конец) -> True для затронутых итогов; без аргумента сбрасывается всё.
+        Возвращает число удалённых записей.
+        """
+        with self._lock:
+            keys = [key for key in self._entries
+                    if periods is None or periods(key[0], datetime.fromisoformat(key[1]), datetime.fromisoformat(key[2]))]
+            for key in keys:
+                del self._entries[key]
+
+        return len(keys)
+
+    def acknowledge(self, old, new):
+        """Событие, сменившее поколение old на new, уже учтено точечно (принято этим воркером)"""
+        if self._watch is not None:
+            self._watch.acknowledge(old, new)
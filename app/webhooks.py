@@ -0,0 +1,272 @@
+"""
+Вебхуки мой склад: события изменения документов, товаров и проектов сбрасывают ровно те записи кэшей,
+на которые они влияют, вместо периодического опроса API.
+
+Вебхуки регистрируются в мой склад на урл вида {BASE_URL}/webhooks/moysklad?token={WEBHOOK_TOKEN}
+для сущностей demand, salesreturn, commissionreportin, product, project (действия CREATE, UPDATE, DELETE).
+"""
+import os
+import queue
+import threading
+from datetime import datetime
+from app.report_generator import MAP_PROJECT_AGENT
+from app.ms_client import get_ms_client, response_json
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Секрет в урле вебхука; без него приём вебхуков выключен
+WEBHOOK_TOKEN = os.environ.get("WEBHOOK_TOKEN")
+
+# Типы сущностей, события по которым обрабатываются
+WEBHOOK_ENTITIES = ("demand", "salesreturn", "commissionreportin", "product", "project")
+
+# Тип сущности -> вид события в поколениях кэшей (app/cache_generation.py), остальные - documents
+GENERATION_BY_ENTITY = {"product": "products", "project": "projects"}
+
+
+def parse_moment(value):
+    """Время мой склад ('2026-01-05 10:00:00.000') -> datetime"""
+    return datetime.fromisoformat(value.replace(" ", "T")) if value else None
+
+
+def project_id(project):
+    """Проект как ссылка или как id -> id"""
+    return project.rsplit("/", 1)[-1] if project else None
+
+
+def document_periods(project, moment):
+    """periods(проект, начало, конец) для документа проекта с моментом moment"""
+    project = project_id(project)
+    moment = parse_moment(moment)
+
+    def periods(period_project, from_date, to_date):
+        return project_id(period_project) == project and from_date <= moment <= to_date
+
+    return periods
+
+
+def commission_periods(agent, period_start, period_end):
+    """periods(проект, начало, конец) для отчёта комиссионера контрагента agent за его период"""
+    start = parse_moment(period_start)
+    end = parse_moment(period_end)
+    agents = {project_id(project): project_agent for project, project_agent in MAP_PROJECT_AGENT.items()}
+
+    def periods(period_project, from_date, to_date):
+        return (agents.get(project_id(period_project)) == agent and start is not None and end is not None
+                and end >= from_date and start <= to_date)
+
+    return periods
+
+
+class WebhookProcessor:
+    """
+    Разбирает события вебхуков и сбрасывает затронутые записи:
+    project - список проектов; product - карточку в кэше и документы снимков отчётов с этим товаром;
+    demand, salesreturn, commissionreportin - снимки отчётов, итоги и готовые отчёты тех проектов и периодов,
+    в которые документ входил или попал. Для созданных и изменённых документов проект и период
+    узнаются одним запросом документа.
+    События обрабатываются в фоновом потоке, чтобы мой склад быстро получил ответ.
+    Кэши в памяти других воркеров узнают о событии по новому поколению (generation, см. app/cache_generation.py).
+    """
+
+    def __init__(self, token, project_cache=None, assortment_cache=None, report_cache=None, summary_cache=None,
+                 precomputed=None, commission_index=None, replica=None, client=None, generation=None):
+        self.token = token
+        self.project_cache = project_cache
+        self.assortment_cache = assortment_cache
+        self.report_cache = report_cache
+        self.summary_cache = summary_cache
+        self.precomputed = precomputed
+        self.commission_index = commission_index
+        self.replica = replica
+        self.client = client or get_ms_client()
+        self.generation = generation
+
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def submit(self, payload):
+        """Ставит события в очередь фоновой обработки, возвращает число принятых событий"""
+        events = [event for event in payload.get("events") or []
+                  if event.get("meta", {}).get("type") in WEBHOOK_ENTITIES]
+
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self.__run, daemon=True)
+                self._worker.start()
+
+        for event in events:
+            self._queue.put(event)
+
+        return len(events)
+
+    def join(self):
+        """Ждёт обработки всех принятых событий"""
+        self._queue.join()
+
+    def __run(self):
+        while True:
+            event = self._queue.get()
+            try:
+                self.handle(event)
+            except Exception as e:
+                logger.exception(f"Не удалось обработать событие вебхука {event}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def handle(self, event):
+        entity = event.get("meta", {}).get("type")
+        href = event.get("meta", {}).get("href")
+        action = event.get("action")
+
+        handled = False
+        try:
+            if entity == "project":
+                if self.project_cache is not None:
+                    self.project_cache.invalidate()
+                logger.info(f"Вебхук: {action} проекта, список проектов обновляется")
+            elif entity == "product":
+                self.__product_changed(href, action)
+            elif entity == "commissionreportin":
+                self.__comission_changed(href, action)
+            else:
+                self.__document_changed(entity, href, action)
+            handled = True
+        finally:
+            # Новое поколение - и после ошибки: другие воркеры сбросят кэши целиком
+            if self.generation is not None:
+                self.__publish(GENERATION_BY_ENTITY.get(entity, "documents"), handled)
+
+    def __publish(self, kind, handled):
+        old, new = self.generation.bump(kind)
+        if not handled:
+            return
+
+        # Этот воркер событие уже учёл точечно
+        for cache in (self.report_cache, self.summary_cache, self.project_cache):
+            if cache is not None:
+                cache.acknowledge(old, new)
+
+    def __get(self, href):
+        r = self.client.get(href, headers=self.headers)
+        if r.status_code == 404:
+            return None
+
+        return response_json(r, href)
+
+    def __product_changed(self, href, action):
+        # Старые артикул и наименование (даже с истёкшим сроком) - по ним находим позиции в снимках отчётов
+        card = None
+        if self.assortment_cache is not None:
+            card = self.assortment_cache.peek(href)
+            self.assortment_cache.invalidate([href])
+
+        # Реплика хранит карточку в каждой позиции: обновляем её до перерасчёта снимков,
+        # итоги и готовые отчёты периодов документов с товаром сбрасываем
+        replica_periods = list()
+        product = None if action == "DELETE" or self.replica is None else self.__get(href)
+        if product is not None:
+            for entity, project, moment, agent, period_start, period_end in self.replica.update_card(
+                    href, product.get("article"), product.get("name")):
+                if entity == "commissionreportin":
+                    replica_periods.append(commission_periods(agent, period_start, period_end))
+                elif moment is not None:
+                    replica_periods.append(document_periods(project, moment))
+
+        affected = 0
+        touched = set()
+        if card is not None and self.report_cache is not None:
+            article, name = card
+
+            def uses_product(document):
+                return any(position.art == article and position.name == name
+                           for positions in document[3:] for position in positions)
+
+            for group in ("demand", "commissionreportin", "salesreturn"):
+                touched |= self.report_cache.periods_with(group, documents=uses_product)
+                affected += self.report_cache.mark_stale(group, documents=uses_product)
+
+        periods = None
+        if replica_periods:
+            def periods(period_project, from_date, to_date):
+                return any(matches(period_project, from_date, to_date) for matches in replica_periods)
+
+        summaries, prepared = self.__invalidate_periods(touched, periods)
+        logger.info(f"Вебхук: {action} товара {href}, снимков отчётов {affected}, итогов {summaries}, "
+                    f"готовых отчётов {prepared}, документов реплики {len(replica_periods)}")
+
+    def __document_changed(self, entity, href, action):
+        document = None if action == "DELETE" else self.__get(href)
+
+        project, moment = None, None
+        if document is not None:
+            project = (document.get("project") or {}).get("meta", {}).get("href")
+            moment = document.get("moment")
+        elif self.replica is not None:
+            # Удалённый документ в МС уже не спросить - проект и момент помнит реплика
+            project, moment = self.replica.document(href) or (None, None)
+            self.replica.remove([href])
+
+        periods = document_periods(project, moment) if moment is not None else None
+        self.__invalidate(entity, href, periods, deleted=document is None)
+
+    def __comission_changed(self, href, action):
+        document = None if action == "DELETE" else self.__get(href)
+
+        header = document
+        if document is None and self.commission_index is not None:
+            # Удалённый отчёт: контрагент и период - из индекса, пока запись не убрана
+            header = self.commission_index.header(href)
+            self.commission_index.remove([href])
+        if document is None and self.replica is not None:
+            self.replica.remove([href])
+        # Изменённый заголовок индекс периодов догрузит сам по водяному знаку updated
+
+        periods = None
+        if header is not None:
+            periods = commission_periods((header.get("agent") or {}).get("meta", {}).get("href"),
+                                         header.get("commissionPeriodStart"), header.get("commissionPeriodEnd"))
+
+        self.__invalidate("commissionreportin", href, periods, deleted=document is None)
+
+    def __invalidate(self, group, href, periods, deleted=False):
+        """
+        Снимки отчётов - по документу и по периодам; итоги и готовые отчёты - по тем же периодам
+        и по периодам снимков, где документ был раньше. Период удалённого документа известен из реплики,
+        индекса отчётов комиссионера или снимков; если его не знает никто, ничего не сбрасывается -
+        итоги и готовые отчёты обновятся по своему сроку жизни.
+        """
+        affected = 0
+        touched = set()
+        if self.report_cache is not None:
+            # Где документ был раньше, знают только снимки
+            touched = self.report_cache.periods_with(group, href)
+            affected = self.report_cache.mark_stale(group, periods=periods,
+                                                    documents=lambda document: document[1] == href)
+
+        if deleted and periods is None and not touched:
+            logger.info(f"Вебхук: период удалённого {group} {href} неизвестен, итоги и готовые отчёты не сброшены")
+
+        summaries, prepared = self.__invalidate_periods(touched, periods)
+        logger.info(f"Вебхук: {group} {href}, снимков отчётов {affected}, итогов {summaries}, "
+                    f"готовых отчётов {prepared}")
+
+    def __invalidate_periods(self, touched, periods):
+        """
+        Сбрасывает итоги и готовые отчёты периодов touched ({(id проекта, начало, конец)})
+        и тех, для которых periods(проект, начало, конец) - True. Возвращает (итогов, готовых отчётов)
+        """
+        if not touched and periods is None:
+            return 0, 0
+
+        def affects(period_project, from_date, to_date):
+            if (project_id(period_project), from_date, to_date) in touched:
+                return True
+            return periods is not None and periods(period_project, from_date, to_date)
+
+        summaries = self.summary_cache.invalidate(affects) if self.summary_cache is not None else 0
+        prepared = self.precomputed.invalidate(affects) if self.precomputed is not None else 0
+        return summaries, prepared
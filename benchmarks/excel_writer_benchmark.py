@@ -0,0 +1,95 @@
+"""
+Сравнение движков записи Excel: fill_excel_report (insert_rows + copy_row_style)
+и write_excel_report (потоковая запись за один проход).
+
+Каждый замер идёт в отдельном процессе, чтобы пиковое потребление памяти (RSS) не смешивалось.
+
+Запуск из корня проекта:
+    python -m benchmarks.excel_writer_benchmark
+    python -m benchmarks.excel_writer_benchmark --positions 10000 100000 --engines stream
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_PATH = os.path.join(ROOT_DIR, "app", "шаблон.xlsx")
+
+
+def make_sections(positions):
+    """Синтетические данные: половина позиций в отгрузках, половина в отчётах и возвратах"""
+    half = positions // 2
+    demands = [
+        {'art': f"ART-{i % 3000}", 'name': f"Товар {i % 3000}", 'price': 100.0 + i % 50, 'quantity': 1.0 + i % 5}
+        for i in range(half)
+    ]
+    refounds = [
+        {'art': f"ART-{i % 3000}", 'name': f"Товар {i % 3000}", 'price': -(100.0 + i % 50), 'quantity': -1.0,
+         **({'NSP': 'НСП'} if i % 4 == 0 else {})}
+        for i in range(positions - half)
+    ]
+    documents = max(1, positions // 20)
+
+    return {
+        'A': {'start_row': 5, 'data': demands},
+        'B': {'start_row': 5, 'data': refounds},
+        'C': {'start_row': 8, 'data': [f"Отгрузка № {i:05d}" for i in range(documents)]},
+        'D': {'start_row': 10, 'data': [f"Возврат покупателя № {i:05d}" for i in range(documents)]},
+    }
+
+
+def run_single(engine, positions):
+    sys.path.insert(0, ROOT_DIR)
+    from app.excel_filler import fill_excel_report
+    from app.excel_writer import write_excel_report
+
+    write_report = write_excel_report if engine == "stream" else fill_excel_report
+    sections = make_sections(positions)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = os.path.join(temp_dir, "report.xlsx")
+
+        started = time.perf_counter()
+        write_report(TEMPLATE_PATH, output_path, sections, "BENCH", "2026-01-01 00:00:00", "2026-01-31 23:59:00")
+        elapsed = time.perf_counter() - started
+
+        size = os.path.getsize(output_path)
+
+    # ru_maxrss в Linux - килобайты
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(json.dumps({"engine": engine, "positions": positions, "seconds": elapsed,
+                      "peak_rss_mb": peak_rss_mb, "file_kb": size / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--positions", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--engines", nargs="+", default=["openpyxl", "stream"], choices=["openpyxl", "stream"])
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.engines[0], args.positions[0])
+        return
+
+    print(f"{'движок':<10} {'позиций':>10} {'время, с':>10} {'пик RSS, МБ':>12} {'файл, КБ':>10}")
+    for positions in args.positions:
+        for engine in args.engines:
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.excel_writer_benchmark", "--single",
+                 "--engines", engine, "--positions", str(positions)],
+                cwd=ROOT_DIR, capture_output=True, text=True, check=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{result['engine']:<10} {result['positions']:>10} {result['seconds']:>10.2f} "
+                  f"{result['peak_rss_mb']:>12.1f} {result['file_kb']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
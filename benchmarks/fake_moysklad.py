@@ -0,0 +1,445 @@
+"""
+Локальная заглушка JSON API мой склад для замеров без обращения к api.moysklad.ru.
+
+Отдаёт синтетические отгрузки, возвраты покупателей, отчёты комиссионера, их позиции,
+карточки товаров и проекты. Поддерживает постраничную выборку (limit/offset/nextHref),
+expand=positions[.assortment], простые фильтры (moment, updated, id, project, agent, периоды отчётов комиссионера),
+gzip и, по желанию, лимиты мой склад: 45 запросов за 3 секунды и 5 параллельных запросов.
+
+Запуск отдельно:
+    python -m benchmarks.fake_moysklad --port 8085 --documents 300 --positions 20 --latency 0.05
+"""
+import argparse
+import gzip
+import json
+import threading
+import time
+from collections import deque, Counter
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+API_PREFIX = "/api/remap/1.2"
+
+# Лимиты мой склад
+RATE_LIMIT_REQUESTS = 45
+RATE_LIMIT_WINDOW = 3.0
+PARALLEL_LIMIT = 5
+
+MOMENT_FORMAT = "%Y-%m-%d %H:%M:%S.000"
+
+
+class Scale:
+    """Объём синтетических данных"""
+
+    def __init__(self, documents=300, refounds=None, positions=20, products=3000, commission_reports=24,
+                 commission_positions=None, inline_positions=100,
+                 period_start="2026-01-01 00:00:00", period_end="2026-01-31 23:59:00"):
+        self.documents = documents
+        self.refounds = documents // 10 if refounds is None else refounds
+        self.positions = positions
+        self.products = products
+        # Отчёты комиссионера - помесячные, последний - за месяц периода, остальные в прошлом
+        self.commission_reports = commission_reports
+        self.commission_positions = positions * 10 if commission_positions is None else commission_positions
+        # Сколько позиций мой склад вкладывает в документ при expand
+        self.inline_positions = inline_positions
+        self.period_start = datetime.fromisoformat(period_start)
+        self.period_end = datetime.fromisoformat(period_end)
+
+
+class FakeMoySklad:
+    def __init__(self, scale=None, latency=0.0, enforce_limits=False, host="127.0.0.1", port=0, project=None, agent=None):
+        self.scale = scale or Scale()
+        self.latency = latency
+        self.enforce_limits = enforce_limits
+
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.base_url = f"http://{host}:{self.server.server_address[1]}{API_PREFIX}"
+        # Проект документов и контрагент (комиссионер) - по ним работают фильтры project= и agent=
+        self.project = project or self.__href("project", "OZON")
+        self.agent = agent or self.__href("counterparty", "OZON")
+
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self._active = 0
+        self.reset_stats()
+
+        # Изменённые карточки товаров: номер -> {article, name}
+        self.products = dict()
+
+        self.documents = {
+            "demand": self.__make_documents("demand", self.scale.documents),
+            "salesreturn": self.__make_documents("salesreturn", self.scale.refounds),
+            "commissionreportin": self.__make_commission_reports(),
+        }
+
+    # ---------------------------------------------------------------- данные
+
+    def __href(self, *parts):
+        return "/".join((self.base_url, "entity") + parts)
+
+    def __make_documents(self, entity, count):
+        span = (self.scale.period_end - self.scale.period_start).total_seconds()
+        documents = list()
+
+        for i in range(count):
+            moment = self.scale.period_start + timedelta(seconds=span * i / max(1, count))
+            doc_id = f"{entity}-{i:06d}"
+            documents.append({
+                "meta": {"href": self.__href(entity, doc_id), "type": entity},
+                "id": doc_id,
+                "name": f"{i + 1:05d}",
+                "moment": moment.strftime(MOMENT_FORMAT),
+                "updated": moment.strftime(MOMENT_FORMAT),
+                "project": {"meta": {"href": self.project, "type": "project"}},
+                "agent": {"meta": {"href": self.agent, "type": "counterparty"}},
+                "positions": {"meta": {"href": self.__href(entity, doc_id, "positions"),
+                                       "size": self.scale.positions}},
+            })
+
+        return documents
+
+    def __make_commission_reports(self):
+        reports = list()
+        month_start = self.scale.period_start.replace(day=1)
+
+        for i in range(self.scale.commission_reports):
+            # i = 0 - самый старый отчёт
+            months_back = self.scale.commission_reports - 1 - i
+            year, month = divmod(month_start.year * 12 + month_start.month - 1 - months_back, 12)
+            start = datetime(year, month + 1, 1)
+            end = (start + timedelta(days=32)).replace(day=1) - timedelta(seconds=1)
+            doc_id = f"commissionreportin-{i:06d}"
+
+            reports.append({
+                "meta": {"href": self.__href("commissionreportin", doc_id), "type": "commissionreportin"},
+                "id": doc_id,
+                "name": f"{i + 1:05d}",
+                "moment": end.strftime(MOMENT_FORMAT),
+                "updated": end.strftime(MOMENT_FORMAT),
+                "agent": {"meta": {"href": self.agent, "type": "counterparty"}},
+                "commissionPeriodStart": start.strftime(MOMENT_FORMAT),
+                "commissionPeriodEnd": end.strftime(MOMENT_FORMAT),
+                "positions": {"meta": {"href": self.__href("commissionreportin", doc_id, "positions"),
+                                       "size": self.scale.commission_positions}},
+                "returnToCommissionerPositions": {
+                    "meta": {"href": self.__href("commissionreportin", doc_id, "returntocommissionerpositions"),
+                             "size": max(1, self.scale.commission_positions // 10)}},
+            })
+
+        return reports
+
+    def __product(self, number, expanded=True):
+        product = {"meta": {"href": self.__href("product", f"product-{number:06d}"), "type": "product"}}
+        if expanded:
+            product.update({
+                "id": f"product-{number:06d}",
+                "article": f"ART-{number:06d}",
+                "name": f"Товар {number}",
+            })
+            product.update(self.products.get(number, {}))
+        return product
+
+    def __positions(self, entity, doc_id, kind, expand_assortment):
+        number = int(doc_id.rsplit("-", 1)[1])
+        if kind == "positions":
+            size = self.scale.commission_positions if entity == "commissionreportin" else self.scale.positions
+        else:
+            size = max(1, self.scale.commission_positions // 10)
+
+        rows = list()
+        for j in range(size):
+            product = (number * 7919 + j * 31) % self.scale.products
+            rows.append({
+                "quantity": 1 + (number + j) % 3,
+                "price": 10000 + product * 10,
+                "assortment": self.__product(product, expanded=expand_assortment),
+            })
+        return rows
+
+    # ---------------------------------------------------------------- изменения (для вебхуков)
+
+    def touch(self, entity, index, moment=None):
+        """Отмечает документ изменённым (updated - сейчас), по желанию переносит его moment; возвращает href"""
+        document = self.documents[entity][index]
+        document["updated"] = datetime.now().strftime(MOMENT_FORMAT)
+        if moment is not None:
+            document["moment"] = moment
+        return document["meta"]["href"]
+
+    def delete(self, entity, index):
+        """Удаляет документ, возвращает его href"""
+        return self.documents[entity].pop(index)["meta"]["href"]
+
+    def product_href(self, number):
+        return self.__product(number, expanded=False)["meta"]["href"]
+
+    def rename_product(self, number, article=None, name=None):
+        """Меняет артикул и (или) наименование товара, возвращает его href"""
+        changes = self.products.setdefault(number, dict())
+        if article is not None:
+            changes["article"] = article
+        if name is not None:
+            changes["name"] = name
+        return self.product_href(number)
+
+    # ---------------------------------------------------------------- фильтры
+
+    @staticmethod
+    def __parse_filter(value):
+        conditions = list()
+        for part in (value or "").split(";"):
+            for operator in (">=", "<=", "="):
+                if operator in part:
+                    key, operand = part.split(operator, 1)
+                    conditions.append((key, operator, operand))
+                    break
+        return conditions
+
+    @staticmethod
+    def __matches(document, conditions):
+        ids = [operand for key, operator, operand in conditions if key == "id"]
+        if ids and document.get("id") not in ids:
+            return False
+
+        for key, operator, operand in conditions:
+            if key in ("project", "agent") and key in document:
+                if document[key]["meta"]["href"] != operand:
+                    return False
+            if key in ("moment", "updated", "commissionPeriodStart", "commissionPeriodEnd"):
+                value = document.get(key, "")[:19]
+                if operator == ">=" and value < operand[:19]:
+                    return False
+                if operator == "<=" and value > operand[:19]:
+                    return False
+        return True
+
+    # ---------------------------------------------------------------- ответы
+
+    def handle(self, path, query):
+        """Возвращает (статус, тело) для пути API"""
+        parts = path[len(API_PREFIX):].strip("/").split("/")
+        limit = int(query.get("limit", ["1000"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+        expand = query.get("expand", [""])[0]
+
+        if len(parts) < 2 or parts[0] != "entity":
+            return 404, {"errors": [{"error": "Неизвестный ресурс"}]}
+
+        entity = parts[1]
+
+        # Позиции документа
+        if len(parts) == 4:
+            rows = self.__positions(entity, parts[2], parts[3], "assortment" in expand)
+            return 200, self.__page(path, query, rows, limit, offset)
+
+        # Одна сущность по ссылке
+        if len(parts) == 3:
+            if entity == "product":
+                return 200, self.__product(int(parts[2].rsplit("-", 1)[1]))
+            for document in self.documents.get(entity, []):
+                if document["id"] == parts[2]:
+                    return 200, document
+            return 404, {"errors": [{"error": "Объект не найден"}]}
+
+        conditions = self.__parse_filter(query.get("filter", [""])[0])
+
+        if entity == "project":
+            rows = [{"meta": {"href": self.__href("project", name)}, "name": name} for name in ("OZON", "WB", "YANDEX")]
+            return 200, self.__page(path, query, rows, limit, offset)
+
+        if entity == "product":
+            ids = [operand for key, operator, operand in conditions if key == "id"]
+            rows = [self.__product(int(product_id.rsplit("-", 1)[1])) for product_id in ids]
+            return 200, self.__page(path, query, rows, limit, offset)
+
+        if entity not in self.documents:
+            return 404, {"errors": [{"error": "Неизвестная сущность"}]}
+
+        rows = [document for document in self.documents[entity] if self.__matches(document, conditions)]
+
+        order = query.get("order", [""])[0]
+        if order.startswith("name"):
+            rows = sorted(rows, key=lambda document: document["name"], reverse=order.endswith("desc"))
+        elif order.startswith("updated"):
+            rows = sorted(rows, key=lambda document: document["updated"])
+
+        page = self.__page(path, query, rows, limit, offset)
+
+        if "positions" in expand:
+            expand_assortment = "assortment" in expand
+            expanded = list()
+            for document in page["rows"]:
+                document = dict(document)
+                for key in ("positions", "returnToCommissionerPositions"):
+                    if key in document:
+                        kind = "positions" if key == "positions" else "returntocommissionerpositions"
+                        inline = self.__positions(entity, document["id"], kind, expand_assortment)
+                        document[key] = {"meta": document[key]["meta"], "rows": inline[:self.scale.inline_positions]}
+                expanded.append(document)
+            page["rows"] = expanded
+
+        return 200, page
+
+    def __page(self, path, query, rows, limit, offset):
+        meta = {"size": len(rows), "limit": limit, "offset": offset}
+
+        if offset + limit < len(rows):
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query["offset"] = str(offset + limit)
+            next_query["limit"] = str(limit)
+            meta["nextHref"] = (f"{self.base_url}{path[len(API_PREFIX):]}?" +
+                                "&".join(f"{key}={value}" for key, value in next_query.items()))
+
+        return {"meta": meta, "rows": rows[offset:offset + limit]}
+
+    # ---------------------------------------------------------------- лимиты и статистика
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.rejected = 0
+            self.max_parallel = 0
+            self.endpoints = Counter()
+
+    def acquire(self):
+        """Учитывает запрос, возвращает None или (причина отказа, через сколько мс повторить)"""
+        now = time.monotonic()
+        with self._lock:
+            self.requests += 1
+            self._active += 1
+            self.max_parallel = max(self.max_parallel, self._active)
+
+            while self._recent and now - self._recent[0] > RATE_LIMIT_WINDOW:
+                self._recent.popleft()
+
+            if self.enforce_limits:
+                if self._active > PARALLEL_LIMIT:
+                    self.rejected += 1
+                    return "Превышено ограничение на количество параллельных запросов", 100
+                if len(self._recent) >= RATE_LIMIT_REQUESTS:
+                    self.rejected += 1
+                    retry = int((RATE_LIMIT_WINDOW - (now - self._recent[0])) * 1000) + 1
+                    return "Превышено ограничение на количество запросов", retry
+
+            self._recent.append(now)
+            return None
+
+    def release(self, sent, endpoint):
+        with self._lock:
+            self._active -= 1
+            self.bytes_sent += sent
+            self.endpoints[endpoint] += 1
+
+    def remaining(self):
+        with self._lock:
+            return max(0, RATE_LIMIT_REQUESTS - len(self._recent))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "bytes_sent": self.bytes_sent,
+                "rejected": self.rejected,
+                "max_parallel": self.max_parallel,
+                "endpoints": dict(self.endpoints),
+            }
+
+    # ---------------------------------------------------------------- сервер
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        query = {key: [unquote(value) for value in values] for key, values in parse_qs(url.query).items()}
+        parts = url.path[len(API_PREFIX):].strip("/").split("/")
+        endpoint = "/".join(parts[:2]) + ("/" + parts[3] if len(parts) == 4 else "")
+
+        rejection = fake.acquire()
+        headers = {}
+        sent = 0
+        try:
+            if rejection:
+                message, retry_ms = rejection
+                status, body = 429, {"errors": [{"error": message, "code": 1049}]}
+                headers["X-Lognex-Retry-TimeInterval"] = str(retry_ms)
+                headers["X-Lognex-Retry-After"] = str(retry_ms)
+            else:
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, body = fake.handle(url.path, query)
+
+            headers["X-RateLimit-Limit"] = str(RATE_LIMIT_REQUESTS)
+            headers["X-RateLimit-Remaining"] = str(fake.remaining())
+            sent = self.__send(status, body, headers)
+        finally:
+            fake.release(sent, endpoint)
+
+    def __send(self, status, body, headers):
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            payload = gzip.compress(payload, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+        return len(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8085)
+    parser.add_argument("--documents", type=int, default=300)
+    parser.add_argument("--positions", type=int, default=20)
+    parser.add_argument("--products", type=int, default=3000)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа в секундах")
+    parser.add_argument("--enforce-limits", action="store_true", help="включить лимиты мой склад")
+    parser.add_argument("--project", help="ссылка на проект документов (по умолчанию - проект OZON заглушки)")
+    parser.add_argument("--agent", help="ссылка на контрагента-комиссионера")
+    args = parser.parse_args()
+
+    fake = FakeMoySklad(
+        Scale(documents=args.documents, positions=args.positions, products=args.products),
+        latency=args.latency, enforce_limits=args.enforce_limits, port=args.port,
+        project=args.project, agent=args.agent
+    )
+    print(f"Заглушка мой склад: {fake.base_url}", flush=True)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
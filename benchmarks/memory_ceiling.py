@@ -0,0 +1,120 @@
+"""
+Проверка потолка памяти потокового конвейера (REPORT_PIPELINE=stream).
+
+Отчёт строится на локальной заглушке мой склад при растущем числе документов за период.
+Заглушка работает в отдельном процессе, отчёт - в своём, измеряется пиковая память процесса отчёта.
+Пиковая память потокового конвейера не должна расти вместе с числом позиций: если самый большой отчёт
+занимает больше самого маленького более чем на --tolerance, команда завершится с ошибкой.
+Для сравнения тот же замер выполняется и для прежнего конвейера (collect).
+
+Запуск из корня проекта:
+    python -m benchmarks.memory_ceiling
+    python -m benchmarks.memory_ceiling --documents 500 2000 8000 --tolerance 0.15
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PERIOD_FROM = "2026-01-01 00:00:00"
+PERIOD_TO = "2026-01-31 23:59:00"
+
+
+def run_single(args):
+    """Один отчёт против уже запущенной заглушки, печатает строки по секциям и пиковую память"""
+    sys.path.insert(0, ROOT_DIR)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.environ["ASSORTMENT_CACHE_PATH"] = os.path.join(temp_dir, "assortment.sqlite")
+        os.environ["COMMISSION_INDEX_PATH"] = os.path.join(temp_dir, "commission_index.sqlite")
+
+        from app import report_generator
+        from app.report_generator import ReportGenerator, MAP_PROJECT_AGENT
+
+        rg = ReportGenerator(token="benchmark", api_url=args.api_url, pipeline=args.pipeline)
+        rg.set_urls(project=next(iter(MAP_PROJECT_AGENT)), from_date=PERIOD_FROM, to_date=PERIOD_TO)
+        file_name = rg.generate_report(project="BENCH")
+
+        os.remove(os.path.join(os.path.dirname(report_generator.__file__), "temp", file_name))
+
+    print(json.dumps({
+        "positions": rg.rows_written["A"] + rg.rows_written["B"],
+        # ru_maxrss в Linux - килобайты
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure(documents, args):
+    sys.path.insert(0, ROOT_DIR)
+    from app.report_generator import MAP_PROJECT_AGENT
+
+    project = next(iter(MAP_PROJECT_AGENT))
+    port = free_port()
+    fake = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_moysklad", "--port", str(port), "--documents", str(documents),
+         "--positions", str(args.positions), "--project", project, "--agent", MAP_PROJECT_AGENT[project]],
+        cwd=ROOT_DIR, stdout=subprocess.PIPE, text=True
+    )
+    try:
+        # Заглушка печатает адрес, когда готова принимать запросы
+        api_url = fake.stdout.readline().strip().rsplit(" ", 1)[-1]
+
+        results = dict()
+        for pipeline in ("collect", "stream"):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.memory_ceiling", "--single", "--api-url", api_url,
+                 "--pipeline", pipeline],
+                cwd=ROOT_DIR, capture_output=True, text=True, check=True
+            ).stdout
+            results[pipeline] = json.loads(output.strip().splitlines()[-1])
+        return results
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, nargs="+", default=[250, 1000, 4000], help="отгрузок за период")
+    parser.add_argument("--positions", type=int, default=20, help="позиций в документе")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="допустимый рост пиковой памяти потокового конвейера от меньшего отчёта к большему")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--api-url", help=argparse.SUPPRESS)
+    parser.add_argument("--pipeline", default="stream", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args)
+        return
+
+    print(f"{'позиций':>8} {'collect, МБ':>12} {'stream, МБ':>11}")
+
+    stream_rss = list()
+    for documents in args.documents:
+        results = measure(documents, args)
+        stream_rss.append(results["stream"]["peak_rss_mb"])
+        print(f"{results['stream']['positions']:>8} {results['collect']['peak_rss_mb']:>12.1f} "
+              f"{results['stream']['peak_rss_mb']:>11.1f}")
+
+    growth = stream_rss[-1] / stream_rss[0] - 1
+    print(f"\nрост пиковой памяти stream: {growth:.1%} (допустимо {args.tolerance:.0%})")
+
+    if growth > args.tolerance:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Сквозной замер ReportGenerator.generate_report на локальной заглушке мой склад.
+
+Для каждого сценария в отдельном процессе поднимается заглушка (benchmarks/fake_moysklad.py),
+кэши создаются заново во временной папке, и выводятся:
+время отчёта целиком и по этапам, время записи Excel, число запросов, объём ответов,
+отказы по лимитам и пиковая память процесса.
+
+Запуск из корня проекта:
+    python -m benchmarks.report_benchmark
+    python -m benchmarks.report_benchmark --documents 300 1000 --latency 0.05 --enforce-limits
+    python -m benchmarks.report_benchmark --replica     # отчёт из локальной реплики после синхронизации
+    python -m benchmarks.report_benchmark --save bench.json
+    python -m benchmarks.report_benchmark --baseline bench.json   # сравнение с сохранёнными результатами
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# На сколько результат может быть хуже базового, прежде чем считаться регрессией
+REGRESSION_THRESHOLD = 0.2
+
+PERIOD_FROM = "2026-01-01 00:00:00"
+PERIOD_TO = "2026-01-31 23:59:00"
+
+
+def run_single(args):
+    sys.path.insert(0, ROOT_DIR)
+    from benchmarks.fake_moysklad import FakeMoySklad, Scale
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Кэши - во временной папке, каждый замер начинается с холодного кэша
+        os.environ["ASSORTMENT_CACHE_PATH"] = os.path.join(temp_dir, "assortment.sqlite")
+        os.environ["COMMISSION_INDEX_PATH"] = os.path.join(temp_dir, "commission_index.sqlite")
+
+        from app import report_generator
+        from app.report_generator import ReportGenerator, MAP_PROJECT_AGENT
+        from app.assortment_cache import AssortmentCache
+        from app.commission_index import CommissionIndex
+        from app.replica import Replica, ReplicaSync
+        from app.report_cache import ReportCache
+
+        project = next(iter(MAP_PROJECT_AGENT))
+        scale = Scale(documents=args.documents[0], positions=args.positions, products=args.products)
+
+        with FakeMoySklad(scale, latency=args.latency, enforce_limits=args.enforce_limits,
+                          project=project, agent=MAP_PROJECT_AGENT[project]) as fake:
+            assortment_cache = AssortmentCache(path=os.path.join(temp_dir, "assortment.sqlite"))
+            commission_index = CommissionIndex(path=os.path.join(temp_dir, "commission_index.sqlite"))
+
+            replica, sync_seconds = None, None
+            if args.replica:
+                replica = Replica(path=os.path.join(temp_dir, "replica.sqlite"))
+                started = time.perf_counter()
+                ReplicaSync(token="benchmark", replica=replica, api_url=fake.base_url).sync()
+                sync_seconds = time.perf_counter() - started
+
+            # Свой кэш данных отчётов на сценарий: прогоны после первого только перепроверяют документы
+            result_cache = ReportCache()
+
+            runs = list()
+            for run in range(args.runs):
+                fake.reset_stats()
+
+                rg = ReportGenerator(token="benchmark", api_url=fake.base_url,
+                                     assortment_cache=assortment_cache, commission_index=commission_index,
+                                     replica=replica, use_replica=args.replica, pipeline=args.pipeline,
+                                     result_cache=result_cache, use_result_cache=args.result_cache)
+                rg.set_urls(project=project, from_date=PERIOD_FROM, to_date=PERIOD_TO)
+
+                started = time.perf_counter()
+                file_name = rg.generate_report(project="BENCH", report_format=args.report_format)
+                elapsed = time.perf_counter() - started
+
+                os.remove(os.path.join(os.path.dirname(report_generator.__file__), "temp", file_name))
+
+                stats = fake.stats()
+                runs.append({
+                    "seconds": elapsed,
+                    "timings": rg.timings,
+                    "requests": stats["requests"],
+                    "bytes": stats["bytes_sent"],
+                    "rejected": stats["rejected"],
+                    "max_parallel": stats["max_parallel"],
+                    "positions": rg.rows_written['A'] + rg.rows_written['B'],
+                })
+
+    print(json.dumps({
+        "documents": args.documents[0],
+        "runs": runs,
+        "sync_seconds": sync_seconds,
+        # ru_maxrss в Linux - килобайты
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def scenario_key(result):
+    return str(result["documents"])
+
+
+def print_results(results, baseline):
+    print(f"{'докум.':>7} {'прогон':>6} {'позиций':>8} {'всего, с':>9} {'запись, с':>9} {'запросов':>9} "
+          f"{'ответы, КБ':>11} {'отказов':>8} {'паралл.':>8} {'RSS, МБ':>8}")
+
+    regressions = list()
+    for result in results:
+        for i, run in enumerate(result["runs"]):
+            # В потоковом конвейере загрузка и запись Excel идут вместе
+            timings = run['timings']
+            excel = timings.get('excel', timings.get('stream', timings.get('csv', timings.get('jsonl', 0))))
+            print(f"{result['documents']:>7} {i + 1:>6} {run['positions']:>8} {run['seconds']:>9.2f} "
+                  f"{excel:>9.2f} {run['requests']:>9} {run['bytes'] / 1024:>11.0f} "
+                  f"{run['rejected']:>8} {run['max_parallel']:>8} {result['peak_rss_mb']:>8.1f}")
+
+        if result.get("sync_seconds") is not None:
+            print(f"{'':>7} синхронизация реплики до отчётов: {result['sync_seconds']:.2f} с")
+
+        base = baseline.get(scenario_key(result))
+        if not base:
+            continue
+
+        # Сравниваем первый (холодный) прогон
+        current, previous = result["runs"][0], base["runs"][0]
+        for name, now, before in (
+            ("время", current["seconds"], previous["seconds"]),
+            ("запросы", current["requests"], previous["requests"]),
+            ("объём ответов", current["bytes"], previous["bytes"]),
+            ("память", result["peak_rss_mb"], base["peak_rss_mb"]),
+        ):
+            if before and now > before * (1 + REGRESSION_THRESHOLD):
+                regressions.append(f"{result['documents']} документов: {name} {before:.2f} -> {now:.2f}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, nargs="+", default=[100, 300], help="отгрузок за период")
+    parser.add_argument("--positions", type=int, default=20, help="позиций в документе")
+    parser.add_argument("--products", type=int, default=3000, help="карточек товаров в каталоге")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа заглушки, с")
+    parser.add_argument("--enforce-limits", action="store_true", help="лимиты мой склад: 45 запросов/3 с, 5 параллельных")
+    parser.add_argument("--runs", type=int, default=2, help="прогонов на сценарий (первый - с холодным кэшем)")
+    parser.add_argument("--replica", action="store_true", help="строить отчёт из локальной реплики (REPORT_SOURCE=replica)")
+    parser.add_argument("--pipeline", choices=("collect", "stream"), default="collect",
+                        help="конвейер отчёта (REPORT_PIPELINE)")
+    parser.add_argument("--format", dest="report_format", choices=("xlsx", "csv", "jsonl"), default="xlsx",
+                        help="формат отчёта")
+    parser.add_argument("--result-cache", action="store_true", help="кэш данных отчётов по проекту и периоду")
+    parser.add_argument("--save", help="сохранить результаты в json")
+    parser.add_argument("--baseline", help="json с прошлыми результатами для поиска регрессий")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args)
+        return
+
+    results = list()
+    for documents in args.documents:
+        command = [sys.executable, "-m", "benchmarks.report_benchmark", "--single",
+                   "--documents", str(documents), "--positions", str(args.positions),
+                   "--products", str(args.products), "--latency", str(args.latency), "--runs", str(args.runs),
+                   "--pipeline", args.pipeline, "--format", args.report_format]
+        if args.enforce_limits:
+            command.append("--enforce-limits")
+        if args.replica:
+            command.append("--replica")
+        if args.result_cache:
+            command.append("--result-cache")
+
+        output = subprocess.run(command, cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    baseline = dict()
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = {scenario_key(result): result for result in json.load(f)}
+
+    regressions = print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if regressions:
+        print("\nРегрессии относительно базовых результатов:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Проверка сброса кэшей вебхуками на локальной заглушке мой склад.
+
+Приложение работает с доверием к вебхукам (REPORT_CACHE_TRUST_WEBHOOKS=1): повторный отчёт без событий
+берётся из кэша данных отчётов без запросов в мой склад, поэтому изменение видно только после события.
+Для каждого случая отчёт строится в кэш, документ или товар меняется в заглушке, событие уходит
+в /webhooks/moysklad (benchmarks/webhook_simulator.py), и отчёт строится заново:
+    - удаление отгрузки (DELETE) - её номера и позиций в отчёте больше нет;
+    - перенос отгрузки за пределы периода (UPDATE с новым moment) - её нет в отчёте;
+    - переименование товара (UPDATE товара) - в отчёте новое наименование, прежнего нет.
+Если хоть одна проверка не прошла, команда завершится с ошибкой.
+
+Запуск из корня проекта:
+    python -m benchmarks.webhook_check
+    python -m benchmarks.webhook_check --documents 100 --positions 10
+"""
+import argparse
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PERIOD_FROM = "2026-01-01 00:00:00"
+PERIOD_TO = "2026-01-31 23:59:00"
+# Момент, куда переносится отгрузка: за пределами периода
+MOVED_MOMENT = "2026-03-01 12:00:00.000"
+
+WEBHOOK_TOKEN = "webhook-check"
+
+
+class Checker:
+    """Отчёт через кэш приложения и события вебхуков в приложение"""
+
+    def __init__(self, fake, project, simulator, processor):
+        self.fake = fake
+        self.project = project
+        self.simulator = simulator
+        self.processor = processor
+        self.failures = list()
+
+    def build(self):
+        """Строки отчёта (jsonl) и число запросов в заглушку за время построения"""
+        from app.report_generator import ReportGenerator
+
+        self.fake.reset_stats()
+        rg = ReportGenerator(token="webhook-check", api_url=self.fake.base_url)
+        rg.set_urls(project=self.project, from_date=PERIOD_FROM, to_date=PERIOD_TO)
+
+        output = io.BytesIO()
+        rg.generate_report(project="CHECK", output=output, report_format="jsonl")
+        rows = [json.loads(line) for line in output.getvalue().decode("utf-8").splitlines()]
+        return rows, self.fake.requests
+
+    def send(self, response):
+        """Ответ вебхука принят, события обработаны"""
+        self.check("вебхук принят", response.status_code == 200 and response.get_json().get("accepted") == 1)
+        self.processor.join()
+
+    def check(self, title, ok):
+        print(f"{'OK' if ok else 'ОШИБКА'}: {title}")
+        if not ok:
+            self.failures.append(title)
+
+
+def documents(rows):
+    return {row["document"] for row in rows if row["section"] == "document"}
+
+
+def names(rows):
+    return {row["name"] for row in rows if row["section"] != "document"}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run(args):
+    sys.path.insert(0, ROOT_DIR)
+    from benchmarks.fake_moysklad import FakeMoySklad, Scale, API_PREFIX
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Окружение приложения - до его импорта: настройки читаются при загрузке модулей
+        os.environ.update({
+            "MS_API_URL": f"http://127.0.0.1:{port}{API_PREFIX}",
+            "REPORT_CACHE_TRUST_WEBHOOKS": "1",
+            "WEBHOOK_TOKEN": WEBHOOK_TOKEN,
+            "ASSORTMENT_CACHE_PATH": os.path.join(temp_dir, "assortment.sqlite"),
+            "COMMISSION_INDEX_PATH": os.path.join(temp_dir, "commission_index.sqlite"),
+            "CACHE_GENERATION_PATH": os.path.join(temp_dir, "generation.json"),
+            "REPORT_STORE_DIR": os.path.join(temp_dir, "reports"),
+            "PRECOMPUTE_DIR": os.path.join(temp_dir, "precomputed"),
+        })
+        for name, value in (("TOKEN_MS", "webhook-check"), ("VALID_USERNAME", "check"), ("VALID_PASSWORD", "check"),
+                            ("SECRET_FOR_FORM", "webhook-check"), ("BASE_URL", "http://127.0.0.1:5000")):
+            os.environ.setdefault(name, value)
+
+        from app.report_generator import MAP_PROJECT_AGENT
+        from benchmarks.webhook_simulator import WebhookSimulator
+
+        # Документы заглушки - в первом проекте приложения и у его комиссионера
+        project = next(iter(MAP_PROJECT_AGENT))
+        scale = Scale(documents=args.documents, positions=args.positions, commission_reports=3)
+        with FakeMoySklad(scale, port=port, project=project, agent=MAP_PROJECT_AGENT[project]) as fake:
+            import app.app as application
+
+            client = application.app.test_client()
+            simulator = WebhookSimulator(fake, "/webhooks/moysklad", WEBHOOK_TOKEN, post=client.post)
+            checker = Checker(fake, project, simulator, application.webhook_processor)
+
+            check_delete(checker)
+            check_moved(checker)
+            check_product(checker)
+
+            return checker.failures
+
+
+def check_delete(checker):
+    rows, _ = checker.build()
+    rows, requests = checker.build()
+    checker.check("повторный отчёт без событий - из кэша, без запросов в мой склад", requests == 0)
+
+    number = "Отгрузка № " + checker.fake.documents["demand"][0]["name"]
+    checker.check(f"до удаления в отчёте есть {number}", number in documents(rows))
+
+    checker.send(checker.simulator.delete("demand", 0))
+    after, _ = checker.build()
+    checker.check(f"после DELETE в отчёте нет {number}", number not in documents(after))
+    checker.check("после DELETE позиций отгрузки в отчёте нет",
+                  len(after) == len(rows) - checker.fake.scale.positions - 1)
+
+
+def check_moved(checker):
+    rows, _ = checker.build()
+    number = "Отгрузка № " + checker.fake.documents["demand"][0]["name"]
+    checker.check(f"до переноса в отчёте есть {number}", number in documents(rows))
+
+    checker.send(checker.simulator.update("demand", 0, moment=MOVED_MOMENT))
+    after, _ = checker.build()
+    checker.check(f"после переноса за пределы периода в отчёте нет {number}", number not in documents(after))
+
+
+def check_product(checker):
+    rows, _ = checker.build()
+    old_name = next(row["name"] for row in rows if row["section"] != "document")
+    product_number = int(old_name.rsplit(" ", 1)[-1])
+    new_name = f"{old_name} (переименован)"
+
+    checker.send(checker.simulator.product(product_number, name=new_name))
+    after, _ = checker.build()
+    checker.check(f"после изменения товара в отчёте «{new_name}»", new_name in names(after))
+    checker.check(f"после изменения товара в отчёте нет «{old_name}»", old_name not in names(after))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=40, help="отгрузок за период")
+    parser.add_argument("--positions", type=int, default=5, help="позиций в документе")
+    args = parser.parse_args()
+
+    failures = run(args)
+    print(f"\nпроверок не прошло: {len(failures)}" if failures else "\nвсе проверки прошли")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
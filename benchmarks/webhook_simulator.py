@@ -0,0 +1,90 @@
+"""
+Имитация вебхуков мой склад для проверки сброса кэшей без настоящего аккаунта.
+
+Тело запроса - как у мой склад: {"auditContext": {...}, "events": [{"meta": {"type", "href"}, "action", ...}]}.
+Вместе с заглушкой (benchmarks/fake_moysklad.py) документ сначала меняется в заглушке, затем уходит событие.
+
+Отправить события в запущенное приложение:
+    python -m benchmarks.webhook_simulator --url http://127.0.0.1:5000/webhooks/moysklad --token <WEBHOOK_TOKEN> \\
+        --type demand --action UPDATE --href <ссылка на документ> [--href ...]
+"""
+import argparse
+import json
+import uuid
+from datetime import datetime
+import requests
+
+ACTIONS = ("CREATE", "UPDATE", "DELETE")
+
+
+def webhook_payload(events):
+    """events - [(тип сущности, href, действие)] -> тело вебхука мой склад"""
+    return {
+        "auditContext": {
+            "meta": {"type": "audit", "href": f"https://api.moysklad.ru/api/audit/1.2/audit/{uuid.uuid4()}"},
+            "uid": "simulator@example",
+            "moment": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "events": [
+            {
+                "meta": {"type": entity, "href": href},
+                "action": action,
+                "accountId": "00000000-0000-0000-0000-000000000000",
+            }
+            for entity, href, action in events
+        ],
+    }
+
+
+def send_events(url, token, events, post=None):
+    """
+    Отправляет события на урл вебхука. post - своя функция отправки (например, post тестового клиента Flask),
+    по умолчанию requests.post. Возвращает ответ.
+    """
+    body = webhook_payload(events)
+    if post is not None:
+        return post(f"{url}?token={token}", json=body)
+
+    return requests.post(url, params={"token": token}, json=body, timeout=10)
+
+
+class WebhookSimulator:
+    """Меняет данные заглушки мой склад и отправляет соответствующее событие"""
+
+    def __init__(self, fake, url, token, post=None):
+        self.fake = fake
+        self.url = url
+        self.token = token
+        self.post = post
+
+    def update(self, entity, index, moment=None):
+        return self.__send(entity, self.fake.touch(entity, index, moment), "UPDATE")
+
+    def delete(self, entity, index):
+        return self.__send(entity, self.fake.delete(entity, index), "DELETE")
+
+    def product(self, number, article=None, name=None):
+        return self.__send("product", self.fake.rename_product(number, article, name), "UPDATE")
+
+    def project(self):
+        return self.__send("project", self.fake.project, "UPDATE")
+
+    def __send(self, entity, href, action):
+        return send_events(self.url, self.token, [(entity, href, action)], post=self.post)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", required=True, help="урл вебхука приложения")
+    parser.add_argument("--token", required=True, help="WEBHOOK_TOKEN приложения")
+    parser.add_argument("--type", required=True, help="тип сущности: demand, salesreturn, commissionreportin, product, project")
+    parser.add_argument("--action", choices=ACTIONS, default="UPDATE")
+    parser.add_argument("--href", action="append", required=True, help="ссылка на сущность (можно несколько)")
+    args = parser.parse_args()
+
+    response = send_events(args.url, args.token, [(args.type, href, args.action) for href in args.href])
+    print(response.status_code, json.dumps(response.json(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()